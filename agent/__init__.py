@@ -0,0 +1 @@
+"""Agent package: rule-based and LLM-assisted cybersecurity event scoring."""
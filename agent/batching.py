@@ -0,0 +1,148 @@
+"""Micro-batching and de-duplication of concurrent /evaluate-event requests.
+
+Requests that arrive within a few milliseconds of each other are collected
+into one batch (bounded by a maximum size), scored together in a worker
+thread, and each caller is resolved with its own result. Clients keep
+sending one event per request and still get batch-level throughput.
+
+Identical requests that are already in flight are not queued again; later
+callers await the first caller's result (single-flight).
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BatchItem = Tuple[str, Dict[str, Any]]
+
+
+class MicroBatcher:
+    """Coalesce concurrent scoring requests into batches."""
+
+    def __init__(
+        self,
+        score_batch: Callable[[List[BatchItem]], List[Any]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        max_concurrent_batches: int = 4,
+    ):
+        """
+        Args:
+            score_batch: Blocking function scoring a list of (event_type, data)
+                and returning one result per item, in order.
+            max_batch_size: Upper bound on events per batch.
+            max_wait_ms: How long to hold the first request of a batch while
+                waiting for more to arrive.
+            max_concurrent_batches: Batches scored at the same time.
+        """
+        self.score_batch = score_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight: set = set()
+
+    def start(self) -> None:
+        """Start the collector task on the running event loop."""
+        if self._collector is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._collector = asyncio.get_running_loop().create_task(self._collect())
+
+    async def stop(self) -> None:
+        """Stop collecting and wait for batches already being scored."""
+        if self._collector is None:
+            return
+        self._collector.cancel()
+        try:
+            await self._collector
+        except asyncio.CancelledError:
+            pass
+        self._collector = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def submit(self, event_type: str, data: Dict[str, Any]) -> Any:
+        """Queue one event and wait for its individual result."""
+        if self._collector is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((event_type, data), future))
+        return await future
+
+    async def _collect(self) -> None:
+        """Group queued requests into batches and hand them to scoring tasks."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._slots.acquire()
+            task = loop.create_task(self._score(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _score(self, batch: List[Tuple[BatchItem, asyncio.Future]]) -> None:
+        """Score one batch off the event loop and resolve every caller."""
+        items = [item for item, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, self.score_batch, items)
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch scorer returned {len(results)} results for {len(batch)} events")
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} events failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        if len(batch) > 1:
+            logger.info(f"Scored micro-batch of {len(batch)} events")
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue  # Caller went away
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class SingleFlight:
+    """Share one in-flight evaluation among concurrent callers with the same key."""
+
+    def __init__(self):
+        """Initialize with no work in flight."""
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.shared = 0  # Callers served by another caller's evaluation
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        """Run ``work()`` unless an identical call is in flight, then await its result."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(work())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+
+        # Shield so one caller disconnecting does not cancel the others' result
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        """Drop a finished evaluation so later requests are scored afresh."""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
@@ -0,0 +1,72 @@
+"""Gunicorn settings for serving the agent with multiple worker processes.
+
+Run with: gunicorn -c gunicorn.conf.py main:app
+
+- Worker count defaults to the CPUs actually available to the container
+  (affinity mask and cgroup CPU quota), override with AGENT_WORKERS.
+- The app is preloaded and warmed once in the master, then forked.
+- `kill -HUP <master>` (./manage.sh restart-agent-workers) gracefully
+  replaces workers. They are forked from the app already imported in the
+  master, so this is a restart, not a reload: code and settings read at
+  import stay the same. Changing them means replacing the container
+  (`docker-compose up -d --build agent`; the code is baked into the image).
+"""
+import math
+import multiprocessing
+import os
+
+
+def available_cpus() -> int:
+    """Return the number of CPUs this process may use, honouring cgroup quotas."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        # cgroup v1
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+
+    return max(1, cpus)
+
+
+bind = f"0.0.0.0:{os.getenv('AGENT_PORT', '8000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("AGENT_WORKERS", "0")) or available_cpus()
+
+# Import and warm the app once in the master; workers inherit it copy-on-write
+preload_app = True
+
+# LLM calls may take up to 60s; give in-flight requests time to finish on worker restart/shutdown
+timeout = 120
+graceful_timeout = 60
+keepalive = 5
+
+accesslog = None
+loglevel = "info"
+
+
+def when_ready(server):
+    """Warm scoring paths (and the Ollama model) once before workers fork."""
+    import main
+    main.warm_up()
+    server.log.info(f"Agent ready with {workers} workers")
+
+
+def post_fork(server, worker):
+    """Log worker start; per-process state (Ollama session) is recreated lazily."""
+    server.log.info(f"Agent worker started (pid {worker.pid})")
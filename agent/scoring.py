@@ -0,0 +1,293 @@
+"""Deterministic rule-based risk scoring shared by the agent and the backend.
+
+This module has no web or LLM dependencies so the backend can import it and
+score events in-process (``INPROCESS_SCORING=true``) with exactly the same
+weights the agent applies over HTTP.
+"""
+import os
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+from zoneinfo import ZoneInfo
+from pydantic import BaseModel
+
+# Night-time logins are judged in the site's local time
+SITE_TIMEZONE = ZoneInfo(os.getenv("SITE_TIMEZONE", "UTC"))
+
+SUSPICIOUS_PORTS = frozenset({4444, 1337, 31337, 6667, 6697})
+
+
+class AnalysisResult(BaseModel):
+    """Analysis result structure."""
+    event_type: str
+    risk_score: int
+    severity: str
+    reasoning: str
+    recommended_action: str
+
+
+def login_hour(data: Dict[str, Any]) -> Optional[int]:
+    """
+    Return the site-local hour of a login event.
+
+    Uses the ``local_hour`` precomputed at ingest when present; otherwise parses
+    the ISO timestamp (aware values are converted to SITE_TIMEZONE, naive values
+    are already site-local).
+    """
+    hour = data.get("local_hour")
+    if hour is not None:
+        return int(hour)
+
+    timestamp = data.get("timestamp")
+    if not timestamp:
+        return None
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(SITE_TIMEZONE)
+    return parsed.hour
+
+
+def analyze_login_event(data: Dict[str, Any]) -> AnalysisResult:
+    """Analyze login event and calculate risk score."""
+    score = 0
+    reasons = []
+
+    # Failed login: +30
+    if data.get("status") == "FAIL":
+        score += 30
+        reasons.append("Failed login attempt (+30)")
+
+    # Burst failure: +20
+    if data.get("is_burst_failure"):
+        score += 20
+        reasons.append("3rd+ failure in short time window (+20)")
+
+    # Night time (site-local hour)
+    hour = login_hour(data)
+    if hour is not None and 0 <= hour <= 5:
+        score += 10
+        reasons.append("Login during 00:00-05:00 hours (+10)")
+
+    # Admin account: +40
+    if data.get("is_admin"):
+        score += 40
+        reasons.append("Admin account targeted (+40)")
+
+    # Suspicious IP: +30
+    if data.get("is_suspicious_ip"):
+        score += 30
+        reasons.append("Suspicious source IP detected (+30)")
+
+    # Credential stuffing: +25
+    if data.get("is_credential_stuffing"):
+        score += 25
+        reasons.append("Many accounts failing from this source IP (credential stuffing) (+25)")
+
+    # Determine severity
+    if score <= 20:
+        severity = "low"
+    elif score <= 40:
+        severity = "medium"
+    elif score <= 70:
+        severity = "high"
+    else:
+        severity = "critical"
+
+    # Generate reasoning
+    reasoning = "; ".join(reasons) if reasons else "Normal login activity detected"
+
+    # Recommended action
+    if severity == "critical":
+        action = "IMMEDIATE: Lock account, investigate source IP, review all recent activity from this user/IP"
+    elif severity == "high":
+        action = "Investigate login source, verify user identity, consider temporary account restriction"
+    elif severity == "medium":
+        action = "Monitor account for additional suspicious activity, verify with user if unexpected"
+    else:
+        action = "Continue normal monitoring, log event for baseline analysis"
+
+    return AnalysisResult(
+        event_type="login",
+        risk_score=score,
+        severity=severity,
+        reasoning=reasoning,
+        recommended_action=action
+    )
+
+
+def analyze_firewall_event(data: Dict[str, Any]) -> AnalysisResult:
+    """Analyze firewall event and calculate risk score."""
+    score = 0
+    reasons = []
+
+    # Connection spike/repeated denial: +20
+    if data.get("is_connection_spike"):
+        score += 20
+        reasons.append("Repeated connection attempts/denials detected (+20)")
+
+    # Malicious IP range: +40
+    if data.get("is_malicious_range"):
+        score += 40
+        reasons.append("Known malicious IP range detected (+40)")
+
+    # Port scan: +35
+    if data.get("is_port_scan"):
+        score += 35
+        reasons.append("Port scanning activity detected (+35)")
+
+    # Lateral movement: +25
+    if data.get("is_lateral_movement"):
+        score += 25
+        reasons.append("Internal lateral movement detected (+25)")
+
+    # Suspicious ports
+    if data.get("port") in SUSPICIOUS_PORTS:
+        score += 20
+        reasons.append(f"Unusual port {data.get('port')} detected (+20)")
+
+    # Determine severity
+    if score <= 20:
+        severity = "low"
+    elif score <= 40:
+        severity = "medium"
+    elif score <= 70:
+        severity = "high"
+    else:
+        severity = "critical"
+
+    # Generate reasoning
+    reasoning = "; ".join(reasons) if reasons else "Normal firewall activity detected"
+
+    # Recommended action
+    if severity == "critical":
+        action = "IMMEDIATE: Block source IP, isolate affected systems, conduct full network scan"
+    elif severity == "high":
+        action = "Block suspicious IP, investigate destination systems, review firewall rules"
+    elif severity == "medium":
+        action = "Monitor source IP, verify legitimacy of connection attempts, update IDS rules"
+    else:
+        action = "Continue normal monitoring, maintain firewall logs for analysis"
+
+    return AnalysisResult(
+        event_type="firewall",
+        risk_score=score,
+        severity=severity,
+        reasoning=reasoning,
+        recommended_action=action
+    )
+
+
+def analyze_patch_event(data: Dict[str, Any]) -> AnalysisResult:
+    """Analyze patch level event and calculate risk score."""
+    score = 0
+    reasons = []
+
+    # Missing critical patches: +50
+    if data.get("missing_critical", 0) > 0:
+        score += 50
+        reasons.append(f"{data.get('missing_critical')} critical patches missing (+50)")
+
+    # Missing high patches: +35
+    if data.get("missing_high", 0) > 0:
+        score += 35
+        reasons.append(f"{data.get('missing_high')} high-priority patches missing (+35)")
+
+    # Outdated patches (>60 days)
+    last_patch = data.get("last_patch_date", "")
+    if last_patch:
+        try:
+            from datetime import datetime, date
+            if isinstance(last_patch, str):
+                patch_date = datetime.fromisoformat(last_patch).date()
+            else:
+                patch_date = last_patch
+            days_old = (date.today() - patch_date).days
+            if days_old > 60:
+                score += 15
+                reasons.append(f"Patches outdated by {days_old} days (+15)")
+        except:
+            pass
+
+    # Update failures: +20
+    if data.get("update_failures", 0) > 0:
+        score += 20
+        reasons.append(f"{data.get('update_failures')} update failures detected (+20)")
+
+    # Unsupported OS: +40
+    if data.get("is_unsupported"):
+        score += 40
+        reasons.append(f"Unsupported OS: {data.get('os')} (+40)")
+
+    # Determine severity
+    if score <= 20:
+        severity = "low"
+    elif score <= 40:
+        severity = "medium"
+    elif score <= 70:
+        severity = "high"
+    else:
+        severity = "critical"
+
+    # Generate reasoning
+    reasoning = "; ".join(reasons) if reasons else "System patch level acceptable"
+
+    # Recommended action
+    if severity == "critical":
+        action = "URGENT: Isolate system, apply critical patches immediately, scan for exploitation signs"
+    elif severity == "high":
+        action = "Schedule emergency patching within 24 hours, restrict system access until patched"
+    elif severity == "medium":
+        action = "Schedule patching within 1 week, monitor system for suspicious activity"
+    else:
+        action = "Continue normal patch management schedule, maintain update monitoring"
+
+    return AnalysisResult(
+        event_type="patch",
+        risk_score=score,
+        severity=severity,
+        reasoning=reasoning,
+        recommended_action=action
+    )
+
+
+RULE_ANALYZERS = {
+    "login": analyze_login_event,
+    "firewall": analyze_firewall_event,
+    "patch": analyze_patch_event,
+}
+
+
+def analyze_event(event_type: str, data: Dict[str, Any]) -> AnalysisResult:
+    """Score an event of any supported type with the deterministic rules."""
+    analyzer = RULE_ANALYZERS.get(event_type)
+    if analyzer is None:
+        raise ValueError(f"Unknown event type: {event_type}")
+    return analyzer(data)
+
+
+# Fields whose values determine the scoring result (score, severity and reasoning text)
+FEATURE_FIELDS = {
+    "login": ("status", "is_burst_failure", "is_admin", "is_suspicious_ip", "is_credential_stuffing"),
+    "firewall": ("is_connection_spike", "is_malicious_range", "is_port_scan", "is_lateral_movement"),
+    "patch": ("os", "last_patch_date", "missing_critical", "missing_high", "update_failures", "is_unsupported"),
+}
+
+
+def feature_key(event_type: str, data: Dict[str, Any]) -> Tuple:
+    """
+    Canonical key of everything that influences an event's verdict.
+
+    Events with equal keys score identically (e.g. the repeated failures of a
+    brute-force burst, or every probe of a port scan), so identical in-flight
+    requests can share one evaluation.
+    """
+    values = tuple(data.get(field) for field in FEATURE_FIELDS.get(event_type, ()))
+    if event_type == "login":
+        hour = login_hour(data)
+        values += (hour is not None and 0 <= hour <= 5,)
+    elif event_type == "firewall":
+        port = data.get("port")
+        values += (port if port in SUSPICIOUS_PORTS else None,)
+    return (event_type,) + values
@@ -0,0 +1,169 @@
+"""Adaptive limit on concurrent requests to the agent.
+
+A fixed number of dispatch threads either leaves the agent idle (too few)
+or queues requests inside Ollama until they time out (too many). The
+limiter adjusts the number of requests in flight with AIMD (additive
+increase, multiplicative decrease), driven by observed latency:
+
+- While the smoothed latency stays within LATENCY_TOLERANCE times the
+  baseline (the lowest recent latency, i.e. the agent's unqueued service
+  time), each response grows the limit by 1/limit, about one per round trip.
+- Above that, requests are queueing at the agent, and the limit shrinks by
+  BACKOFF_RATIO.
+- A timeout, connection error or 5xx/429 shrinks it by ERROR_BACKOFF_RATIO.
+
+Decreases happen at most once per tolerated round trip (baseline times
+LATENCY_TOLERANCE), so the responses already in flight when the limit drops
+do not shrink it again. The limit settles near the agent's
+saturation point in both rule-based mode (milliseconds) and LLM mode
+(seconds) without configuration.
+
+SingleFlight shares one in-flight request among the threads that would send
+an identical one.
+"""
+import math
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit driven by request latency and errors."""
+
+    LATENCY_TOLERANCE = 2.0  # Latency above baseline * tolerance counts as queueing
+    BACKOFF_RATIO = 0.9  # Limit multiplier when latency rises
+    ERROR_BACKOFF_RATIO = 0.5  # Limit multiplier on timeouts and overload errors
+    SMOOTHING = 0.1  # EWMA weight of each new latency sample
+    BASELINE_WINDOW = 500  # Samples after which the baseline is re-measured
+
+    def __init__(self, initial: int = 10, min_limit: int = 1, max_limit: int = 64, adaptive: bool = True):
+        """
+        Args:
+            initial: Starting limit.
+            min_limit: The limit never drops below this.
+            max_limit: The limit never grows above this (size thread pools to it).
+            adaptive: False keeps the limit fixed at ``initial``.
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.adaptive = adaptive
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+        self._baseline: Optional[float] = None  # Lowest latency of the previous window
+        self._window_min = math.inf
+        self._window_samples = 0
+        self._smoothed: Optional[float] = None
+        self._last_decrease = 0.0
+        self.completed = 0
+        self.errors = 0
+
+    @property
+    def limit(self) -> int:
+        """Current number of requests allowed in flight."""
+        return int(self._limit)
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[float]:
+        """Block until a request may start; returns its start time for release(), or None after ``timeout`` seconds."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._in_flight < int(self._limit), timeout):
+                return None
+            self._in_flight += 1
+        return time.monotonic()
+
+    def release(self, started: float, overloaded: bool = False) -> None:
+        """
+        Finish a request started at ``started``.
+
+        ``overloaded`` marks failures that indicate the agent is saturated
+        (timeouts, refused connections, 5xx/429).
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._cond:
+            self._in_flight -= 1
+            self.completed += 1
+            if overloaded:
+                self.errors += 1
+            if self.adaptive:
+                self._adjust(latency, overloaded, now)
+            self._cond.notify_all()
+
+    def _adjust(self, latency: float, overloaded: bool, now: float) -> None:
+        """Apply one AIMD step (called with the lock held)."""
+        if overloaded:
+            self._decrease(self.ERROR_BACKOFF_RATIO, now)
+            return
+
+        self._smoothed = latency if self._smoothed is None else (
+            self.SMOOTHING * latency + (1 - self.SMOOTHING) * self._smoothed)
+        self._window_min = min(self._window_min, latency)
+        self._window_samples += 1
+        if self._baseline is None or self._window_samples >= self.BASELINE_WINDOW:
+            # Re-measure so the baseline follows mode changes (rule-based <-> LLM)
+            self._baseline = self._window_min
+            self._window_min = math.inf
+            self._window_samples = 0
+
+        # The smoothed latency is the signal: single lucky or unlucky responses do not move the limit
+        if self._smoothed <= self._baseline * self.LATENCY_TOLERANCE:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+        else:
+            self._decrease(self.BACKOFF_RATIO, now)
+
+    def _decrease(self, ratio: float, now: float) -> None:
+        """Shrink the limit, at most once per tolerated round trip."""
+        if self._baseline is not None and now - self._last_decrease < self._baseline * self.LATENCY_TOLERANCE:
+            return
+        self._limit = max(self.min_limit, self._limit * ratio)
+        self._last_decrease = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current limit, bounds and latency statistics."""
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "in_flight": self._in_flight,
+                "baseline_latency_ms": None if self._baseline is None else round(self._baseline * 1000, 1),
+                "smoothed_latency_ms": None if self._smoothed is None else round(self._smoothed * 1000, 1),
+                "completed": self.completed,
+                "errors": self.errors,
+            }
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent threads with the same key."""
+
+    def __init__(self):
+        """Initialize with no calls in flight."""
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.shared = 0  # Calls answered with another caller's result
+
+    def run(self, key: Hashable, work: Callable[[], Any]) -> Any:
+        """Return ``work()``, or the result (or exception) of an identical call already in flight."""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = work()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]  # Later calls are made afresh
@@ -0,0 +1,75 @@
+"""Coordination between backend replicas.
+
+Only one replica may generate synthetic events, or every cycle would run
+once per replica. The generator is whichever replica holds a PostgreSQL
+session-level advisory lock. The lock lives as long as the connection that
+took it, so when the leader dies another replica takes over at its next
+attempt. Dispatch needs no leader: every replica drains the dispatch outbox,
+and FOR UPDATE SKIP LOCKED hands each event to exactly one of them.
+"""
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from typing import Optional
+
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+GENERATION_LOCK_KEY = 492_0001  # Advisory lock id for the generation leader
+
+
+class LeaderLock:
+    """Hold a PostgreSQL advisory lock to act as the single leader for a task."""
+
+    def __init__(self, key: int = GENERATION_LOCK_KEY):
+        """Create the lock; it is acquired lazily by is_leader()."""
+        self.key = key
+        self._conn: Optional[Connection] = None
+
+    def is_leader(self) -> bool:
+        """Return True if this process holds the lock, trying to take it if not."""
+        if engine.dialect.name != "postgresql":
+            return True  # Single-process databases have nothing to coordinate
+
+        if self._conn is not None:
+            try:
+                self._conn.execute(text("SELECT 1"))
+                self._conn.commit()
+                return True
+            except Exception as e:
+                logger.warning(f"Lost leader connection, lock released: {e}")
+                self._close()
+
+        conn = engine.connect()
+        try:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+            conn.commit()  # Session-level lock: survives the commit, not the connection
+        except Exception:
+            conn.close()
+            raise
+        if not acquired:
+            conn.close()
+            return False
+        self._conn = conn
+        logger.info(f"Acquired leader lock {self.key}")
+        return True
+
+    def release(self) -> None:
+        """Give up leadership."""
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+            self._conn.commit()
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        """Drop the lock's connection."""
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
@@ -0,0 +1,366 @@
+"""Cross-source incident correlation.
+
+The agent scores each login, firewall and patch event on its own, but the
+incidents analysts care about span sources: a port scan from an IP, then
+failed logins from that IP against a device that is missing critical
+patches. The engine joins events across types as they are ingested:
+
+- Reconnaissance (a port scan, or traffic from a malicious range) from a
+  source IP, followed within CORRELATION_WINDOW by failed logins from the
+  same IP, opens an incident for (source IP, target device).
+- The incident escalates to critical when an admin account is targeted,
+  when the device is unpatched (missing critical patches or on an
+  unsupported OS, from patch_levels), or when a later login from the IP on
+  the device succeeds.
+
+Recent reconnaissance, failed logins and successful logins are kept in
+time-bucketed indexes. Each arriving event is matched against the few
+buckets its window spans, whichever side arrives first, so the cost per
+event does not grow with table size, no self-join is ever run, and the
+result does not depend on which batch is observed first. Incidents are
+written to correlated_incidents, and updated in place while they stay
+active; an incident counts as saved only once the transaction writing it
+has committed. Active incidents live in memory, so a new incident first
+looks for an open row of its source and device (within the window of it,
+left by an earlier process before a restart or leader handover) and
+extends that row instead of adding a second one.
+"""
+import json
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from .models import CorrelatedIncident, FirewallLog, LoginEvent, PatchLevel
+from .timeutils import to_utc, utcnow
+from .trackers import TimeBucketIndex
+
+
+def _stored_utc(value: datetime) -> datetime:
+    """A stored timestamp as aware UTC (SQLite returns it naive, but it was written as UTC)."""
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+class Recon(NamedTuple):
+    """A reconnaissance firewall event."""
+    timestamp: datetime
+    event_id: int
+
+
+class Failure(NamedTuple):
+    """A failed login."""
+    timestamp: datetime
+    event_id: int
+    username: str
+    device_id: str
+    is_admin: bool
+
+
+class Success(NamedTuple):
+    """A successful login."""
+    timestamp: datetime
+    event_id: int
+
+
+@dataclass
+class Incident:
+    """An incident being built in memory; ``id`` is set once it is stored (and committed)."""
+    src_ip: str
+    device_id: str
+    first_seen: datetime
+    last_seen: datetime
+    id: Optional[int] = None
+    firewall_ids: Set[int] = field(default_factory=set)
+    failure_ids: Set[int] = field(default_factory=set)
+    success_ids: Set[int] = field(default_factory=set)
+    accounts: Set[str] = field(default_factory=set)
+    admin_targeted: bool = False
+    unpatched_device: bool = False
+    login_succeeded: bool = False
+    prior: Optional[CorrelatedIncident] = None  # Stored row this incident extends, as an earlier process left it
+    version: int = 0  # Bumped on every change
+    saved_version: int = -1  # Version last committed to the database
+
+    @property
+    def dirty(self) -> bool:
+        """Changed since it was last saved."""
+        return self.version != self.saved_version
+
+    @property
+    def firewall_events(self) -> int:
+        """Reconnaissance events matched, including those of the adopted row."""
+        return len(self.firewall_ids) + (self.prior.firewall_events if self.prior else 0)
+
+    @property
+    def failed_logins(self) -> int:
+        """Failed logins matched, including those of the adopted row."""
+        return len(self.failure_ids) + (self.prior.failed_logins if self.prior else 0)
+
+    @property
+    def account_count(self) -> int:
+        """Distinct accounts that failed (a lower bound across an adopted row, whose accounts are not stored)."""
+        return max(len(self.accounts), self.prior.accounts if self.prior else 0)
+
+    @property
+    def admin(self) -> bool:
+        """An admin account was targeted, here or in the adopted row."""
+        return self.admin_targeted or bool(self.prior and self.prior.admin_targeted)
+
+    @property
+    def breached(self) -> bool:
+        """A later login succeeded, here or in the adopted row."""
+        return self.login_succeeded or bool(self.prior and self.prior.login_succeeded)
+
+    @property
+    def severity(self) -> str:
+        """critical when the target is privileged, exposed or breached; high otherwise."""
+        if self.admin or self.unpatched_device or self.breached:
+            return "critical"
+        return "high"
+
+    def summary(self) -> str:
+        """One-line description for the dashboard."""
+        details = [f"{self.account_count} account{'s' if self.account_count != 1 else ''}"]
+        if self.admin:
+            details.append("admin targeted")
+        if self.unpatched_device:
+            details.append("device unpatched")
+        if self.breached:
+            details.append("a later login succeeded")
+        return (f"Reconnaissance from {self.src_ip} ({self.firewall_events} firewall events) followed by "
+                f"{self.failed_logins} failed logins on {self.device_id} ({', '.join(details)})")
+
+
+class CorrelationEngine:
+    """Incremental join of firewall reconnaissance, failed logins and patch posture."""
+
+    CORRELATION_WINDOW = timedelta(minutes=30)  # Failed logins this long after reconnaissance are joined
+    BUCKET = timedelta(minutes=5)
+    RETENTION = 2 * CORRELATION_WINDOW  # Late events within this of the newest are still joined
+    EVIDENCE_IDS = 20  # Event ids of each type stored with an incident
+
+    def __init__(self):
+        """Initialize with empty indexes."""
+        self.recon = TimeBucketIndex(self.BUCKET, self.RETENTION)  # Recon per source IP
+        self.failures = TimeBucketIndex(self.BUCKET, self.RETENTION)  # Failed logins per source IP
+        self.successes = TimeBucketIndex(self.BUCKET, self.RETENTION)  # Successful logins per (source IP, device)
+        self.posture: Dict[str, bool] = {}  # device_id -> unpatched, as last seen
+        self._incidents: Dict[Tuple[str, str], Incident] = {}  # Active incidents by (src_ip, device_id)
+        self._closed: List[Incident] = []  # Replaced by a newer incident before being saved
+        self._newest: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def observe(self, events: List[Any]) -> None:
+        """Join a batch of stored events (ids assigned) with the recent events of other types."""
+        with self._lock:
+            for event in events:
+                if isinstance(event, FirewallLog):
+                    self._firewall(event)
+                elif isinstance(event, LoginEvent):
+                    self._login(event)
+                elif isinstance(event, PatchLevel):
+                    self._patch(event)
+
+    def _seen(self, timestamp: datetime) -> None:
+        """Advance the newest event time."""
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+
+    def _firewall(self, event: FirewallLog) -> None:
+        """Index reconnaissance and join it with failed logins that followed it."""
+        if not (event.is_port_scan or event.is_malicious_range):
+            return
+        timestamp = to_utc(event.timestamp)
+        self._seen(timestamp)
+        recon = Recon(timestamp, event.id)
+        if not self.recon.add(event.src_ip, timestamp, recon):
+            return
+        end = timestamp + self.CORRELATION_WINDOW
+        for failure in self.failures.query(event.src_ip, timestamp, end):
+            if timestamp <= failure.timestamp <= end:
+                self._match(event.src_ip, recon, failure)
+
+    def _login(self, event: LoginEvent) -> None:
+        """Index failed logins and join them with earlier reconnaissance; index successes for incident targets."""
+        timestamp = to_utc(event.timestamp)
+        self._seen(timestamp)
+        if event.status != "FAIL":
+            success = Success(timestamp, event.id)
+            key = (event.src_ip, event.device_id)
+            if self.successes.add(key, timestamp, success):
+                incident = self._incidents.get(key)
+                if incident is not None:
+                    self._check_success(incident, success)
+            return
+
+        failure = Failure(timestamp, event.id, event.username, event.device_id, bool(event.is_admin))
+        if not self.failures.add(event.src_ip, timestamp, failure):
+            return
+        start = timestamp - self.CORRELATION_WINDOW
+        for recon in self.recon.query(event.src_ip, start, timestamp):
+            if start <= recon.timestamp <= timestamp:
+                self._match(event.src_ip, recon, failure)
+
+    def _patch(self, event: PatchLevel) -> None:
+        """Record a device's posture and apply it to its active incidents."""
+        unpatched = bool(event.missing_critical) or bool(event.is_unsupported)
+        self.posture[event.device_id] = unpatched
+        for (_, device_id), incident in self._incidents.items():
+            if device_id == event.device_id and incident.unpatched_device != unpatched:
+                incident.unpatched_device = unpatched
+                incident.version += 1
+
+    def _match(self, src_ip: str, recon: Recon, failure: Failure) -> None:
+        """Add a (reconnaissance, failed login) pair to the incident for its source and device."""
+        key = (src_ip, failure.device_id)
+        first, last = min(recon.timestamp, failure.timestamp), max(recon.timestamp, failure.timestamp)
+        incident = self._incidents.get(key)
+        if incident is None or first > incident.last_seen + self.CORRELATION_WINDOW:
+            if incident is not None and incident.dirty:
+                self._closed.append(incident)
+            incident = Incident(src_ip, failure.device_id, first, last,
+                                unpatched_device=self.posture.get(failure.device_id, False))
+            self._incidents[key] = incident
+        incident.first_seen = min(incident.first_seen, first)
+        incident.last_seen = max(incident.last_seen, last)
+        incident.firewall_ids.add(recon.event_id)
+        incident.failure_ids.add(failure.event_id)
+        incident.accounts.add(failure.username)
+        incident.admin_targeted = incident.admin_targeted or failure.is_admin
+        incident.version += 1
+        if not incident.login_succeeded:
+            end = incident.last_seen + self.CORRELATION_WINDOW
+            for success in self.successes.query(key, incident.first_seen, end):
+                if self._check_success(incident, success):
+                    break
+
+    def _check_success(self, incident: Incident, success: Success) -> bool:
+        """Mark the incident breached if ``success`` came during it or within the window after; returns True if so."""
+        if (incident.login_succeeded
+                or not incident.first_seen <= success.timestamp <= incident.last_seen + self.CORRELATION_WINDOW):
+            return False
+        incident.login_succeeded = True
+        incident.success_ids.add(success.event_id)
+        incident.version += 1
+        return True
+
+    def write(self, db: Session) -> List[Tuple[Incident, int, Optional[int]]]:
+        """
+        Write new and changed incidents in the caller's transaction.
+
+        A new incident extends the open row of its source and device, if an
+        earlier process left one (see _adopt). Returns (incident, version
+        written, new id) for each; pass it to saved() once the transaction
+        has committed. Until then the incidents stay dirty and new ones have
+        no id, so a rollback loses nothing.
+        """
+        with self._lock:
+            self._load_posture(db)
+            written = []
+            updated_at = utcnow()
+            for incident in self._closed + list(self._incidents.values()):
+                if not incident.dirty:
+                    continue
+                new_id = None
+                if incident.id is None:
+                    self._adopt(db, incident)
+                row = self._row(incident, updated_at)
+                if incident.id is not None:
+                    db.execute(update(CorrelatedIncident), [{"id": incident.id, **row}])
+                elif incident.prior is not None:
+                    new_id = incident.prior.id
+                    db.execute(update(CorrelatedIncident), [{"id": new_id, **row}])
+                else:
+                    new_id = db.execute(insert(CorrelatedIncident).returning(CorrelatedIncident.id), row).scalar_one()
+                written.append((incident, incident.version, new_id))
+            return written
+
+    def _adopt(self, db: Session, incident: Incident) -> None:
+        """
+        Find the stored row a new incident continues: same source and device, within the window of it.
+
+        Only rows from before this engine existed can match (its own rows are
+        kept in memory for as long as they can be extended). The row is read
+        afresh on every attempt, so a rolled-back write counts it only once.
+        """
+        window = self.CORRELATION_WINDOW
+        incident.prior = db.execute(
+            select(CorrelatedIncident)
+            .where(CorrelatedIncident.src_ip == incident.src_ip,
+                   CorrelatedIncident.device_id == incident.device_id,
+                   CorrelatedIncident.last_seen >= incident.first_seen - window,
+                   CorrelatedIncident.first_seen <= incident.last_seen + window,
+                   CorrelatedIncident.id.not_in([other.id for other in self._closed + list(self._incidents.values())
+                                                 if other.id is not None]))
+            .order_by(CorrelatedIncident.last_seen.desc())
+            .limit(1)
+        ).scalar_one_or_none()
+        if incident.prior is not None:
+            db.expunge(incident.prior)  # A detached snapshot: later commits must not refresh or expire it
+
+    def saved(self, written: List[Tuple[Incident, int, Optional[int]]]) -> None:
+        """Record that the incidents returned by write() were committed."""
+        with self._lock:
+            for incident, version, new_id in written:
+                if new_id is not None:
+                    incident.id = new_id
+                incident.saved_version = max(incident.saved_version, version)
+            self._closed = [incident for incident in self._closed if incident.dirty]
+            self._expire()
+
+    def _load_posture(self, db: Session) -> None:
+        """Look up patch posture for devices in new incidents that no patch event has reported yet."""
+        unknown = {incident.device_id for incident in self._incidents.values()
+                   if incident.id is None and incident.device_id not in self.posture}
+        if not unknown:
+            return
+        found = db.execute(select(PatchLevel.device_id, PatchLevel.missing_critical, PatchLevel.is_unsupported)
+                           .where(PatchLevel.device_id.in_(unknown))).all()
+        for device_id, missing_critical, is_unsupported in found:
+            self.posture[device_id] = bool(missing_critical) or bool(is_unsupported)
+        for device_id in unknown:
+            self.posture.setdefault(device_id, False)  # No patch record: not known to be unpatched
+        for incident in self._incidents.values():
+            if incident.id is None and self.posture[incident.device_id]:
+                incident.unpatched_device = True
+
+    def _row(self, incident: Incident, updated_at: datetime) -> Dict[str, Any]:
+        """Column values of an incident."""
+        firewall_ids = set(incident.firewall_ids)
+        login_ids = incident.failure_ids | incident.success_ids
+        first_seen, last_seen = incident.first_seen, incident.last_seen
+        if incident.prior is not None:
+            evidence = json.loads(incident.prior.evidence)
+            firewall_ids.update(evidence.get("firewall", []))
+            login_ids = login_ids | set(evidence.get("login", []))
+            first_seen = min(first_seen, _stored_utc(incident.prior.first_seen))
+            last_seen = max(last_seen, _stored_utc(incident.prior.last_seen))
+        return {
+            "src_ip": incident.src_ip,
+            "device_id": incident.device_id,
+            "severity": incident.severity,
+            "summary": incident.summary(),
+            "firewall_events": incident.firewall_events,
+            "failed_logins": incident.failed_logins,
+            "accounts": incident.account_count,
+            "admin_targeted": incident.admin,
+            "unpatched_device": incident.unpatched_device,
+            "login_succeeded": incident.breached,
+            "evidence": json.dumps({"firewall": sorted(firewall_ids)[:self.EVIDENCE_IDS],
+                                    "login": sorted(login_ids)[:self.EVIDENCE_IDS]}),
+            "first_seen": first_seen,
+            "last_seen": last_seen,
+            "updated_at": updated_at,
+        }
+
+    def _expire(self) -> None:
+        """Forget saved incidents that can no longer be extended."""
+        if self._newest is None:
+            return
+        cutoff = self._newest - self.RETENTION - self.CORRELATION_WINDOW
+        for key in [key for key, incident in self._incidents.items()
+                    if not incident.dirty and incident.last_seen < cutoff]:
+            del self._incidents[key]
@@ -1,10 +1,16 @@
 """Synthetic cybersecurity event data generator."""
 import random
 import logging
-from datetime import datetime, timedelta, date
-from typing import List
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Union
+from sqlalchemy import case
 from sqlalchemy.orm import Session
 from .models import LoginEvent, FirewallLog, PatchLevel
+from .ingest import dialect_insert, insert_events
+from . import outbox
+from .detection import Detectors
+from .ip_classifier import default_classifier
+from .timeutils import SITE_TIMEZONE, utcnow
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,9 +28,12 @@ class DataGenerator:
 
     ADMIN_USERS = {"admin", "root", "sysadmin", "netadmin"}
 
-    INTERNAL_IPS = [f"192.168.1.{i}" for i in range(1, 255)]
-    EXTERNAL_IPS = [f"203.0.113.{i}" for i in range(1, 255)]
-    MALICIOUS_IPS = [f"198.51.100.{i}" for i in range(1, 50)]
+    # Address pools come from the configured networks (INTERNAL/EXTERNAL/MALICIOUS_NETWORKS)
+    CLASSIFIER = default_classifier()
+    INTERNAL_IPS = CLASSIFIER.internal.hosts()
+    EXTERNAL_IPS = CLASSIFIER.external.hosts()
+    MALICIOUS_IPS = CLASSIFIER.malicious.hosts()
+    SOURCE_IPS = INTERNAL_IPS + EXTERNAL_IPS  # Built once, not per event
 
     DEVICE_IDS = [
         f"WIN-LAPTOP-{i:02d}" for i in range(1, 30)
@@ -47,62 +56,87 @@ class DataGenerator:
     PROTOCOLS = ["TCP", "UDP", "ICMP"]
     COMMON_PORTS = [22, 80, 443, 3389, 445, 139, 135, 3306, 5432, 8080, 8443]
     SUSPICIOUS_PORTS = [4444, 1337, 31337, 6667, 6697]
-
-    def __init__(self):
-        """Initialize generator with tracking state."""
-        self.last_brute_force = datetime.now() - timedelta(hours=13)
-        self.last_port_scan = datetime.now() - timedelta(hours=25)
-        self.failed_login_tracker = {}  # Track failed logins per user
+    FIREWALL_PORTS = COMMON_PORTS + SUSPICIOUS_PORTS
+    LATERAL_MOVEMENT_PORTS = frozenset({3389, 445, 139})
+
+    # Statistical patterns (shared with the vectorized LoadGenerator)
+    LOGIN_FAILURE_RATE = 0.15  # 10-20% failed logins
+    NIGHT_LOGIN_RATE = 0.22  # 15-30% of logins between 00:00-05:00
+    FIREWALL_ALLOW_RATE = 0.7
+    CONNECTION_SPIKE_RATE = 0.05  # LoadGenerator only; DataGenerator events are flagged by detection
+    DENY_SPIKE_RATE = 0.02  # Repeated denials from same IP (1-2 per day; LoadGenerator only)
+    LATERAL_MOVEMENT_RATE = 0.1
+    BRUTE_FORCE_INTERVAL_HOURS = 12
+    BRUTE_FORCE_ATTEMPTS = 5  # Rapid failed attempts per burst (reduced for LLM)
+    PORT_SCAN_INTERVAL_HOURS = 24
+    PORT_SCAN_PORTS = range(20, 35)  # Scan ports 20-34 (reduced for LLM)
+
+    def __init__(
+        self,
+        seed: Optional[Union[int, str]] = None,
+        clock: Callable[[], datetime] = utcnow,
+        recorder=None,
+    ):
+        """
+        Initialize generator with tracking state.
+
+        Args:
+            seed: Seed for reproducible runs. Each event type draws from its own
+                random stream, so one type's volume does not shift another's.
+                None uses fresh entropy.
+            clock: Returns the current time as aware UTC (e.g. a SimulatedClock
+                for reproducible timestamps).
+            recorder: Optional RunRecorder that writes every generated event.
+        """
+        self.seed = seed
+        self.login_rng = self._stream("login")
+        self.firewall_rng = self._stream("firewall")
+        self.patch_rng = self._stream("patch")
+        self.clock = clock
+        self.recorder = recorder
+        self.last_brute_force = clock() - timedelta(hours=13)
+        self.last_port_scan = clock() - timedelta(hours=25)
+        self.detectors = Detectors()  # Behavioural flags set before insert, incidents correlated after
+
+    def _stream(self, name: str) -> random.Random:
+        """Independent random stream for one event type."""
+        return random.Random(None if self.seed is None else f"{self.seed}-{name}")
 
     def generate_login_events(self, db: Session) -> List[LoginEvent]:
         """Generate 5-15 login events with realistic patterns (reduced for LLM processing)."""
-        num_events = random.randint(5, 15)
+        rng = self.login_rng
+        now = self.clock()
+        num_events = rng.randint(5, 15)
         events = []
 
         # Determine if we should inject a brute-force burst
-        hours_since_last_brute = (datetime.now() - self.last_brute_force).total_seconds() / 3600
-        should_brute_force = hours_since_last_brute >= 12
+        hours_since_last_brute = (now - self.last_brute_force).total_seconds() / 3600
+        should_brute_force = hours_since_last_brute >= self.BRUTE_FORCE_INTERVAL_HOURS
 
         for i in range(num_events):
             # Random base values
-            username = random.choice(self.USERNAMES)
-            src_ip = random.choice(self.INTERNAL_IPS + self.EXTERNAL_IPS)
-            device_id = random.choice(self.DEVICE_IDS)
-            auth_method = random.choice(self.AUTH_METHODS)
+            username = rng.choice(self.USERNAMES)
+            src_ip = rng.choice(self.SOURCE_IPS)
+            device_id = rng.choice(self.DEVICE_IDS)
+            auth_method = rng.choice(self.AUTH_METHODS)
 
             # Determine failure rate (10-20%)
-            is_failed = random.random() < 0.15
+            is_failed = rng.random() < self.LOGIN_FAILURE_RATE
 
             # Night time login (15-30% between 00:00-05:00)
-            if random.random() < 0.22:
-                hour = random.randint(0, 5)
-                minute = random.randint(0, 59)
-                second = random.randint(0, 59)
-                timestamp = datetime.now().replace(hour=hour, minute=minute, second=second)
+            if rng.random() < self.NIGHT_LOGIN_RATE:
+                hour = rng.randint(0, 5)
+                minute = rng.randint(0, 59)
+                second = rng.randint(0, 59)
+                timestamp = now.astimezone(SITE_TIMEZONE).replace(hour=hour, minute=minute, second=second)
             else:
-                timestamp = datetime.now() - timedelta(minutes=random.randint(0, 1800))
+                timestamp = now - timedelta(minutes=rng.randint(0, 1800))
 
             # Admin account (5%)
             is_admin = username in self.ADMIN_USERS
 
             # Suspicious IP (external IPs are more suspicious)
-            is_suspicious_ip = src_ip in self.EXTERNAL_IPS or src_ip in self.MALICIOUS_IPS
-
-            # Track failed logins for burst detection
-            is_burst_failure = False
-            if is_failed:
-                key = f"{username}_{src_ip}"
-                if key not in self.failed_login_tracker:
-                    self.failed_login_tracker[key] = []
-                self.failed_login_tracker[key].append(timestamp)
-
-                # Check for burst (3+ failures in 10 minutes)
-                recent_failures = [
-                    t for t in self.failed_login_tracker[key]
-                    if (timestamp - t).total_seconds() < 600
-                ]
-                if len(recent_failures) >= 3:
-                    is_burst_failure = True
+            is_suspicious_ip = self.CLASSIFIER.is_suspicious(src_ip)
 
             status = "FAIL" if is_failed else "SUCCESS"
 
@@ -113,7 +147,6 @@ class DataGenerator:
                 timestamp=timestamp,
                 device_id=device_id,
                 auth_method=auth_method,
-                is_burst_failure=is_burst_failure,
                 is_suspicious_ip=is_suspicious_ip,
                 is_admin=is_admin
             )
@@ -121,12 +154,12 @@ class DataGenerator:
 
         # Inject brute-force attack if needed
         if should_brute_force:
-            brute_user = random.choice(self.USERNAMES)
-            brute_ip = random.choice(self.EXTERNAL_IPS)
-            brute_device = random.choice(self.DEVICE_IDS)
+            brute_user = rng.choice(self.USERNAMES)
+            brute_ip = rng.choice(self.EXTERNAL_IPS)
+            brute_device = rng.choice(self.DEVICE_IDS)
 
-            for j in range(5):  # 5 rapid failed attempts (reduced for LLM)
-                timestamp = datetime.now() - timedelta(minutes=random.randint(0, 10))
+            for j in range(self.BRUTE_FORCE_ATTEMPTS):
+                timestamp = now - timedelta(minutes=rng.randint(0, 10))
                 event = LoginEvent(
                     username=brute_user,
                     src_ip=brute_ip,
@@ -140,46 +173,49 @@ class DataGenerator:
                 )
                 events.append(event)
 
-            self.last_brute_force = datetime.now()
+            self.last_brute_force = now
             logger.info(f"Injected brute-force attack targeting {brute_user} from {brute_ip}")
 
-        db.add_all(events)
+        self.detectors.inspect(events)  # Burst and credential-stuffing flags, as for any ingested logins
+        insert_events(db, events)  # COPY-based bulk insert; assigns event ids
+        outbox.enqueue(db, events)  # Recovered by the outbox worker if never analyzed
         db.commit()
+        self.detectors.correlate(events)
+        self.detectors.save(db)  # Correlated incidents, in a transaction of their own
+        if self.recorder:
+            self.recorder.record(now, events)
         logger.info(f"Generated {len(events)} login events")
         return events
 
     def generate_firewall_events(self, db: Session) -> List[FirewallLog]:
         """Generate 10-30 firewall events with attack patterns (reduced for LLM processing)."""
-        num_events = random.randint(10, 30)
+        rng = self.firewall_rng
+        now = self.clock()
+        num_events = rng.randint(10, 30)
         events = []
 
         # Determine if we should inject port scan
-        hours_since_last_scan = (datetime.now() - self.last_port_scan).total_seconds() / 3600
-        should_port_scan = hours_since_last_scan >= 24
+        hours_since_last_scan = (now - self.last_port_scan).total_seconds() / 3600
+        should_port_scan = hours_since_last_scan >= self.PORT_SCAN_INTERVAL_HOURS
 
         for i in range(num_events):
-            src_ip = random.choice(self.INTERNAL_IPS + self.EXTERNAL_IPS)
-            dst_ip = random.choice(self.INTERNAL_IPS)
-            port = random.choice(self.COMMON_PORTS + self.SUSPICIOUS_PORTS)
-            protocol = random.choice(self.PROTOCOLS)
-            action = "ALLOW" if random.random() < 0.7 else "DENY"
-            timestamp = datetime.now() - timedelta(minutes=random.randint(0, 1800))
+            src_ip = rng.choice(self.SOURCE_IPS)
+            dst_ip = rng.choice(self.INTERNAL_IPS)
+            port = rng.choice(self.FIREWALL_PORTS)
+            protocol = rng.choice(self.PROTOCOLS)
+            action = "ALLOW" if rng.random() < self.FIREWALL_ALLOW_RATE else "DENY"
+            timestamp = now - timedelta(minutes=rng.randint(0, 1800))
 
             # Flags
             is_port_scan = False
             is_lateral_movement = False
-            is_malicious_range = src_ip in self.MALICIOUS_IPS
-            is_connection_spike = random.random() < 0.05
+            is_malicious_range = False  # Set by the firewall detector (networks and reputation feeds)
 
             # Lateral movement (internal to internal on suspicious ports)
-            if src_ip in self.INTERNAL_IPS and dst_ip in self.INTERNAL_IPS:
-                if port in [3389, 445, 139] and random.random() < 0.1:
+            if self.CLASSIFIER.is_internal(src_ip) and self.CLASSIFIER.is_internal(dst_ip):
+                if port in self.LATERAL_MOVEMENT_PORTS and rng.random() < self.LATERAL_MOVEMENT_RATE:
                     is_lateral_movement = True
 
-            # Repeated denials from same IP (1-2 per day)
-            if action == "DENY" and random.random() < 0.02:
-                is_connection_spike = True
-
             event = FirewallLog(
                 src_ip=src_ip,
                 dst_ip=dst_ip,
@@ -189,18 +225,17 @@ class DataGenerator:
                 timestamp=timestamp,
                 is_port_scan=is_port_scan,
                 is_lateral_movement=is_lateral_movement,
-                is_malicious_range=is_malicious_range,
-                is_connection_spike=is_connection_spike
+                is_malicious_range=is_malicious_range
             )
             events.append(event)
 
         # Inject port scan if needed
         if should_port_scan:
-            scanner_ip = random.choice(self.EXTERNAL_IPS)
-            target_ip = random.choice(self.INTERNAL_IPS)
+            scanner_ip = rng.choice(self.EXTERNAL_IPS)
+            target_ip = rng.choice(self.INTERNAL_IPS)
 
-            for port in range(20, 35):  # Scan ports 20-34 (reduced for LLM)
-                timestamp = datetime.now() - timedelta(seconds=random.randint(0, 300))
+            for port in self.PORT_SCAN_PORTS:
+                timestamp = now - timedelta(seconds=rng.randint(0, 300))
                 event = FirewallLog(
                     src_ip=scanner_ip,
                     dst_ip=target_ip,
@@ -215,81 +250,107 @@ class DataGenerator:
                 )
                 events.append(event)
 
-            self.last_port_scan = datetime.now()
+            self.last_port_scan = now
             logger.info(f"Injected port scan from {scanner_ip} targeting {target_ip}")
 
-        db.add_all(events)
+        self.detectors.inspect(events)  # Port-scan, spike and malicious-range flags, as for any ingested firewall logs
+        insert_events(db, events)  # COPY-based bulk insert; assigns event ids
+        outbox.enqueue(db, events)  # Recovered by the outbox worker if never analyzed
         db.commit()
+        self.detectors.correlate(events)
+        self.detectors.save(db)  # Heavy hitters and correlated incidents for the dashboard
+        if self.recorder:
+            self.recorder.record(now, events)
         logger.info(f"Generated {len(events)} firewall events")
         return events
 
     def generate_patch_levels(self, db: Session) -> List[PatchLevel]:
-        """Generate or update patch level data for devices (reduced sample for LLM processing)."""
-        events = []
-
-        # Check existing devices
-        existing_devices = {pl.device_id for pl in db.query(PatchLevel).all()}
+        """
+        Generate or update patch level data for devices (reduced sample for LLM processing).
+
+        All sampled devices are written with one INSERT ... ON CONFLICT (device_id)
+        DO UPDATE. Unknown devices are inserted with fresh values; known ones get
+        this cycle's update (patched or aged) if they drew one. Inserted and
+        updated rows are returned for dispatch; untouched devices are not.
+        """
+        rng = self.patch_rng
+        now = self.clock()
+        today = now.astimezone(SITE_TIMEZONE).date()
 
         # Only process a random sample of 8-12 devices per cycle (instead of all 52)
-        sampled_devices = random.sample(self.DEVICE_IDS, min(random.randint(8, 12), len(self.DEVICE_IDS)))
-        
+        sampled_devices = rng.sample(self.DEVICE_IDS, min(rng.randint(8, 12), len(self.DEVICE_IDS)))
+
+        rows = []
+        patched = []  # Known devices brought fully up to date
+        aged = {}  # Known devices whose last patch date moves back
         for device_id in sampled_devices:
-            if device_id in existing_devices:
-                # Update existing device (age patches)
-                device = db.query(PatchLevel).filter(PatchLevel.device_id == device_id).first()
-                
-                # Randomly update some devices
-                if random.random() < 0.3:
-                    device.last_patch_date = date.today()
-                    device.missing_critical = 0
-                    device.missing_high = 0
-                    device.update_failures = 0
-                else:
-                    # Age the patch date
-                    if random.random() < 0.1:
-                        days_old = random.randint(10, 30)
-                        device.last_patch_date = date.today() - timedelta(days=days_old)
-            else:
-                # Create new device
-                os_type = random.choice(self.OS_TYPES)
-                is_unsupported = os_type in self.UNSUPPORTED_OS
-
-                # 30% outdated
-                if random.random() < 0.3:
-                    days_old = random.randint(61, 365)
-                    last_patch = date.today() - timedelta(days=days_old)
-                else:
-                    days_old = random.randint(0, 60)
-                    last_patch = date.today() - timedelta(days=days_old)
-
-                # missing_critical (8-10% of devices)
-                missing_critical = 0
-                if random.random() < 0.09:
-                    missing_critical = random.randint(1, 5)
-
-                # missing_high (15-20% of devices)
-                missing_high = 0
-                if random.random() < 0.175:
-                    missing_high = random.randint(1, 10)
-
-                # Update failures
-                update_failures = 0
-                if random.random() < 0.15:
-                    update_failures = random.randint(1, 3)
-
-                event = PatchLevel(
-                    device_id=device_id,
-                    os=os_type,
-                    last_patch_date=last_patch,
-                    missing_critical=missing_critical,
-                    missing_high=missing_high,
-                    update_failures=update_failures,
-                    is_unsupported=is_unsupported
-                )
-                events.append(event)
+            # Values used if the device is new
+            os_type = rng.choice(self.OS_TYPES)
 
-        if events:
-            db.add_all(events)
+            # 30% outdated
+            if rng.random() < 0.3:
+                days_old = rng.randint(61, 365)
+            else:
+                days_old = rng.randint(0, 60)
+
+            # missing_critical (8-10% of devices)
+            missing_critical = 0
+            if rng.random() < 0.09:
+                missing_critical = rng.randint(1, 5)
+
+            # missing_high (15-20% of devices)
+            missing_high = 0
+            if rng.random() < 0.175:
+                missing_high = rng.randint(1, 10)
+
+            # Update failures
+            update_failures = 0
+            if rng.random() < 0.15:
+                update_failures = rng.randint(1, 3)
+
+            rows.append({
+                "device_id": device_id,
+                "os": os_type,
+                "last_patch_date": today - timedelta(days=days_old),
+                "missing_critical": missing_critical,
+                "missing_high": missing_high,
+                "update_failures": update_failures,
+                "is_unsupported": os_type in self.UNSUPPORTED_OS,
+                "updated_at": now.replace(tzinfo=None),  # Naive UTC column
+            })
+
+            # Update applied instead if the device already exists
+            if rng.random() < 0.3:
+                patched.append(device_id)
+            elif rng.random() < 0.1:
+                aged[device_id] = today - timedelta(days=rng.randint(10, 30))
+
+        stmt = dialect_insert(db, PatchLevel).values(rows)
+        table = PatchLevel.__table__
+        is_patched = table.c.device_id.in_(patched)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.device_id],
+            set_={
+                "last_patch_date": case(
+                    (is_patched, today),
+                    *[(table.c.device_id == device_id, aged_date) for device_id, aged_date in aged.items()],
+                    else_=table.c.last_patch_date,
+                ),
+                "missing_critical": case((is_patched, 0), else_=table.c.missing_critical),
+                "missing_high": case((is_patched, 0), else_=table.c.missing_high),
+                "update_failures": case((is_patched, 0), else_=table.c.update_failures),
+                "updated_at": stmt.excluded.updated_at,
+            },
+            where=table.c.device_id.in_(patched + list(aged)),
+        ).returning(*table.c)
+
+        # Detached copies: the dispatcher only reads their attributes
+        events = [PatchLevel(**row) for row in db.execute(stmt).mappings()]
+        outbox.enqueue(db, events)
         db.commit()
+        self.detectors.correlate(events)  # Patch posture of devices in incidents
+        self.detectors.save(db)
+        if self.recorder:
+            self.recorder.record(now, events)
         logger.info(f"Generated/updated {len(events)} patch level records")
         return events
@@ -1,6 +1,6 @@
 """Database configuration and connection management."""
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -13,6 +13,51 @@ engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Idempotent upgrades for databases created before a column or type change.
+# create_all() only creates missing tables; it never alters existing ones.
+SCHEMA_UPGRADES = [
+    # Event timestamps are timezone-aware UTC (legacy naive values were written as UTC)
+    """
+    DO $$
+    DECLARE col record;
+    BEGIN
+        FOR col IN
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE (table_name, column_name) IN (
+                ('login_events', 'timestamp'),
+                ('firewall_logs', 'timestamp'),
+                ('event_analyses', 'analyzed_at'))
+            AND data_type = 'timestamp without time zone'
+        LOOP
+            EXECUTE format(
+                'ALTER TABLE %I ALTER COLUMN %I TYPE TIMESTAMPTZ USING %I AT TIME ZONE ''UTC''',
+                col.table_name, col.column_name, col.column_name);
+        END LOOP;
+    END $$
+    """,
+    "ALTER TABLE login_events ADD COLUMN IF NOT EXISTS local_hour SMALLINT",
+    """
+    UPDATE login_events SET local_hour = EXTRACT(HOUR FROM timestamp AT TIME ZONE :site_tz)
+    WHERE local_hour IS NULL
+    """,
+    "ALTER TABLE dispatch_outbox ADD COLUMN IF NOT EXISTS last_error TEXT",
+    "ALTER TABLE login_events ADD COLUMN IF NOT EXISTS is_credential_stuffing BOOLEAN DEFAULT FALSE",
+    "ALTER TABLE entity_risk ADD COLUMN IF NOT EXISTS patch_score DOUBLE PRECISION",
+    "ALTER TABLE entity_risk ADD COLUMN IF NOT EXISTS patch_epoch DOUBLE PRECISION",
+    # One analysis per event: keep the earliest of any duplicates, then enforce it
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'event_analyses_event_type_event_id_key') THEN
+            DELETE FROM event_analyses a USING event_analyses b
+            WHERE a.event_type = b.event_type AND a.event_id = b.event_id AND a.id > b.id;
+            ALTER TABLE event_analyses
+                ADD CONSTRAINT event_analyses_event_type_event_id_key UNIQUE (event_type, event_id);
+        END IF;
+    END $$
+    """,
+]
+
 
 def get_db():
     """Get database session."""
@@ -23,6 +68,18 @@ def get_db():
         db.close()
 
 
+def upgrade_schema():
+    """Apply SCHEMA_UPGRADES (PostgreSQL only)."""
+    if engine.dialect.name != "postgresql":
+        return
+    from .timeutils import SITE_TIMEZONE
+    with engine.begin() as conn:
+        for statement in SCHEMA_UPGRADES:
+            params = {"site_tz": SITE_TIMEZONE.key} if ":site_tz" in statement else {}
+            conn.execute(text(statement), params)
+
+
 def init_db():
     """Initialize database tables."""
     Base.metadata.create_all(bind=engine)
+    upgrade_schema()
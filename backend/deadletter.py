@@ -0,0 +1,131 @@
+"""Dead-letter table for events that could not be scored.
+
+An event is dead-lettered when the agent rejects it outright (a 4xx response
+or a malformed result, which retrying will not fix) or when the outbox has
+already claimed it OUTBOX_MAX_ATTEMPTS times. The dead_letter_events row keeps
+the payload, the last error and the attempt count. The event leaves the
+outbox in the same transaction, so nothing retries it until it is re-driven:
+re-driving puts events back in the outbox, due at once and with a fresh
+attempt count, and deletes their dead-letter rows.
+
+Usage:
+    python -m backend.deadletter status
+    python -m backend.deadletter redrive [--type login] [--limit 1000] [--drain]
+"""
+import argparse
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.orm import Session
+
+from .models import DeadLetterEvent, DispatchOutbox
+from .ingest import dialect_insert
+from . import outbox
+from .timeutils import utcnow
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def bury(db: Session, entries: List[Dict[str, Any]]) -> None:
+    """
+    Dead-letter failed events and remove them from the outbox, in the caller's transaction.
+
+    Each entry has event_type, event_id, payload (the dict sent to the agent),
+    error and attempts. An event dead-lettered again replaces its earlier row.
+    """
+    if not entries:
+        return
+    failed_at = utcnow()
+    rows = [{"event_type": entry["event_type"], "event_id": entry["event_id"],
+             "payload": json.dumps(entry["payload"]), "error": entry["error"],
+             "attempts": entry["attempts"], "failed_at": failed_at} for entry in entries]
+    stmt = dialect_insert(db, DeadLetterEvent)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["event_type", "event_id"],
+        set_={name: stmt.excluded[name] for name in ("payload", "error", "attempts", "failed_at")},
+    ), rows)
+    outbox.ack(db, [(row["event_type"], row["event_id"]) for row in rows])
+
+
+def bury_exhausted(db: Session, claimed: List[Tuple[str, int, int]]) -> None:
+    """Dead-letter claimed outbox entries that ran out of attempts, and commit."""
+    from .event_dispatcher import event_to_data  # The dispatcher records failures through this module
+
+    keys = [(event_type, event_id) for event_type, event_id, _ in claimed]
+    errors = {(event_type, event_id): error for event_type, event_id, error in db.execute(
+        select(DispatchOutbox.event_type, DispatchOutbox.event_id, DispatchOutbox.last_error)
+        .where(tuple_(DispatchOutbox.event_type, DispatchOutbox.event_id).in_(keys)))}
+    attempts = {(event_type, event_id): count for event_type, event_id, count in claimed}
+
+    events = outbox.load_claimed(db, claimed)  # Also drops entries whose event was deleted
+    entries = []
+    for event in events:
+        event_type = outbox.EVENT_TYPES[type(event)]
+        key = (event_type, event.id)
+        entries.append({
+            "event_type": event_type,
+            "event_id": event.id,
+            "payload": {"type": event_type, "data": event_to_data(event)},
+            "error": errors.get(key) or "Not analyzed before the outbox visibility timeout",
+            "attempts": attempts[key] - 1,  # The current claim is not dispatched
+        })
+    bury(db, entries)
+    db.commit()
+    logger.warning(f"Dead-lettered {len(entries)} events after {outbox.MAX_ATTEMPTS} outbox attempts")
+
+
+def redrive(db: Session, event_type: Optional[str] = None, limit: Optional[int] = None) -> int:
+    """Move dead-lettered events back to the outbox (due at once) and commit; returns how many."""
+    query = select(DeadLetterEvent.id, DeadLetterEvent.event_type, DeadLetterEvent.event_id).order_by(DeadLetterEvent.id)
+    if event_type:
+        query = query.where(DeadLetterEvent.event_type == event_type)
+    if limit:
+        query = query.limit(limit)
+    rows = db.execute(query).all()
+    if not rows:
+        return 0
+
+    outbox.enqueue_keys(db, [(row.event_type, row.event_id) for row in rows], delay=0)
+    db.execute(delete(DeadLetterEvent).where(DeadLetterEvent.id.in_([row.id for row in rows])))
+    db.commit()
+    return len(rows)
+
+
+def status(db: Session) -> Dict[str, int]:
+    """Dead-lettered events per event type."""
+    return dict(db.execute(
+        select(DeadLetterEvent.event_type, func.count()).group_by(DeadLetterEvent.event_type)).all())
+
+
+def main() -> None:
+    """Inspect or re-drive dead-lettered events."""
+    from .database import SessionLocal, init_db
+    from .event_dispatcher import EventDispatcher
+
+    parser = argparse.ArgumentParser(description="Dead-letter table maintenance")
+    parser.add_argument("command", choices=["status", "redrive"])
+    parser.add_argument("--type", choices=sorted(outbox.OUTBOX_MODELS), help="Only this event type")
+    parser.add_argument("--limit", type=int, help="Re-drive at most this many events")
+    parser.add_argument("--drain", action="store_true", help="Dispatch re-driven events now instead of "
+                                                             "leaving them to the outbox workers")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.command == "status":
+            logger.info(f"Dead-lettered events: {status(db)}")
+        else:
+            logger.info(f"Re-drove {redrive(db, args.type, args.limit)} dead-lettered events to the outbox")
+            if args.drain:
+                dispatcher = EventDispatcher(db)
+                logger.info(f"Drained {outbox.drain(db, dispatcher.dispatch_events_parallel)} outbox events")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Streaming detectors that flag events between ingest and scoring.
+
+Detection used to happen inside DataGenerator while it invented events, so
+events from any other source (replayed exports, real log feeds) reached the
+agent with no behavioural flags at all. Detectors run on every batch just
+before it is inserted, keep bounded sliding-window state, and cost O(1)
+amortized per event. They only ever set flags: a flag that is already true
+on an incoming event (an injected attack, an upstream sensor) is kept.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from .correlation import CorrelationEngine
+from .ingest import upsert_rows
+from .ip_classifier import default_classifier
+from .models import LoginEvent, FirewallLog, HeavyHitter
+from .reputation import default_reputation
+from .sketches import TopK, WindowedCountMin, WindowedHyperLogLog
+from .timeutils import to_utc, utcnow
+from .trackers import FailedLoginTracker, SlidingWindowDistinct
+
+logger = logging.getLogger(__name__)
+
+
+class LoginDetector:
+    """Brute-force bursts per account and credential stuffing per source IP."""
+
+    STUFFING_WINDOW = timedelta(minutes=10)
+    STUFFING_ACCOUNTS = 5  # Distinct accounts failing from one IP within the window
+
+    def __init__(self, max_keys: int = 100_000):
+        """Initialize with empty windows of at most ``max_keys`` keys each."""
+        self.failures = FailedLoginTracker(max_keys=max_keys)  # Failures per (user, IP)
+        self.accounts = SlidingWindowDistinct(window=self.STUFFING_WINDOW, max_keys=max_keys)  # Failed users per IP
+        self._lock = threading.Lock()  # Callers may inspect batches from several threads
+
+    def inspect(self, events: List[LoginEvent]) -> None:
+        """Set is_burst_failure and is_credential_stuffing on failed logins, in timestamp order."""
+        with self._lock:
+            for event in sorted(events, key=lambda event: to_utc(event.timestamp)):
+                burst = stuffing = False
+                if event.status == "FAIL":
+                    timestamp = to_utc(event.timestamp)
+                    # Three or more failures for one account from one IP within ten minutes
+                    burst = self.failures.record_failure(event.username, event.src_ip, timestamp)
+                    # Many different accounts failing from one IP: a password list being sprayed
+                    stuffing = self.accounts.record(event.src_ip, event.username, timestamp) >= self.STUFFING_ACCOUNTS
+                event.is_burst_failure = bool(event.is_burst_failure) or burst
+                event.is_credential_stuffing = bool(event.is_credential_stuffing) or stuffing
+
+
+class FirewallDetector:
+    """
+    Port scans, connection spikes and known-bad sources per source IP.
+
+    Scans: each active source keeps two windowed HyperLogLogs, of distinct
+    destination ports (many ports probed: a vertical scan) and distinct
+    destination hosts (many hosts probed: a horizontal scan, or sweep). Either
+    count reaching its threshold marks the source's events as a port scan;
+    counts up to twice the thresholds are kept exact, so scans right at a
+    threshold are not missed to estimation error. A source costs about 2.5 KB
+    plus those few values; the least recently seen sources are evicted beyond
+    ``max_sources``. Events are taken in timestamp order, and an event older
+    than the window is not counted or flagged.
+
+    Spikes: connections and denials per source are counted in windowed
+    count-min sketches, whose memory is fixed however many sources appear.
+    Events from a source over either threshold, in the window ending at the
+    event, are connection spikes, and a top-K list of the busiest sources is
+    kept for the dashboard.
+
+    Known-bad sources: events from MALICIOUS_NETWORKS or from an address in
+    the threat-intel reputation feeds are marked as from a malicious range.
+    """
+
+    SCAN_WINDOW = timedelta(minutes=10)
+    SCAN_PORTS = 10  # Distinct destination ports from one source within the window
+    SWEEP_HOSTS = 10  # Distinct destination hosts from one source within the window
+    SPIKE_WINDOW = timedelta(minutes=10)
+    SPIKE_CONNECTIONS = 50  # Connections from one source within the window
+    SPIKE_DENIES = 10  # Denied connections from one source within the window
+    TOP_K = 20  # Heavy hitters kept for the dashboard
+
+    def __init__(self, max_sources: int = 10_000):
+        """Initialize with no tracked sources."""
+        self.max_sources = max_sources
+        self._sources: "OrderedDict[str, Tuple[WindowedHyperLogLog, WindowedHyperLogLog]]" = OrderedDict()
+        self.connections = WindowedCountMin(self.SPIKE_WINDOW)
+        self.denies = WindowedCountMin(self.SPIKE_WINDOW)
+        self.top = TopK(self.TOP_K)
+        self.classifier = default_classifier()
+        self.reputation = default_reputation()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of sources currently tracked."""
+        return len(self._sources)
+
+    def _source(self, src_ip: str) -> Tuple[WindowedHyperLogLog, WindowedHyperLogLog]:
+        """(ports, hosts) sketches of a source, created on first sight."""
+        sketches = self._sources.get(src_ip)
+        if sketches is None:
+            sketches = (WindowedHyperLogLog(self.SCAN_WINDOW, exact_limit=2 * self.SCAN_PORTS),
+                        WindowedHyperLogLog(self.SCAN_WINDOW, exact_limit=2 * self.SWEEP_HOSTS))
+            self._sources[src_ip] = sketches
+            if len(self._sources) > self.max_sources:
+                self._sources.popitem(last=False)
+        else:
+            self._sources.move_to_end(src_ip)
+        return sketches
+
+    def inspect(self, events: List[FirewallLog]) -> None:
+        """Set is_port_scan, is_connection_spike and is_malicious_range on firewall events, in arrival order."""
+        with self._lock:
+            for event in sorted(events, key=lambda event: to_utc(event.timestamp)):
+                if not event.is_malicious_range and (self.classifier.is_malicious(event.src_ip)
+                                                     or event.src_ip in self.reputation):
+                    event.is_malicious_range = True
+
+                timestamp = to_utc(event.timestamp)
+                ports, hosts = self._source(event.src_ip)
+                distinct_ports = ports.add(event.port, timestamp)
+                distinct_hosts = hosts.add(event.dst_ip, timestamp)
+                event.is_port_scan = (bool(event.is_port_scan) or distinct_ports >= self.SCAN_PORTS
+                                      or distinct_hosts >= self.SWEEP_HOSTS)
+
+                connections = self.connections.add(event.src_ip, timestamp)
+                if event.action == "DENY":
+                    denies = self.denies.add(event.src_ip, timestamp)
+                else:
+                    denies = self.denies.estimate(event.src_ip, timestamp)
+                self.top.offer(event.src_ip, self.connections.estimate(event.src_ip))  # Current window, late or not
+                event.is_connection_spike = (bool(event.is_connection_spike) or connections >= self.SPIKE_CONNECTIONS
+                                             or denies >= self.SPIKE_DENIES)
+
+    def heavy_hitters(self) -> List[Dict[str, Any]]:
+        """Busiest sources in the current window, largest first, with connection and denial counts."""
+        with self._lock:
+            top = self.top.refresh(self.connections.estimate)
+            return [{"src_ip": src_ip, "connections": connections, "denies": self.denies.estimate(src_ip)}
+                    for src_ip, connections in top]
+
+
+class Detectors:
+    """
+    The detectors for one ingest stream.
+
+    Each batch goes to the detector for its event type before it is inserted
+    (inspect), and to the correlation engine once it is committed
+    (correlate); save then stores incidents and heavy hitters.
+    """
+
+    def __init__(self):
+        """Create fresh detectors (state is kept for the lifetime of this object)."""
+        self.login = LoginDetector()
+        self.firewall = FirewallDetector()
+        self.correlation = CorrelationEngine()
+        self._save_lock = threading.Lock()
+
+    def inspect(self, events: List[Any]) -> None:
+        """Flag a batch of events of one type before it is inserted."""
+        if not events:
+            return
+        model = type(events[0])
+        if model is LoginEvent:
+            self.login.inspect(events)
+        elif model is FirewallLog:
+            self.firewall.inspect(events)
+
+    def correlate(self, events: List[Any]) -> None:
+        """Join a batch of inserted events (of any type, including patch levels) with recent events."""
+        self.correlation.observe(events)
+
+    def save(self, db: Session) -> None:
+        """
+        Store correlated incidents and the current heavy hitters, and commit.
+
+        Call after the batch's own transaction has committed: this is a
+        separate transaction, so a failure here never rolls back ingested
+        events (it is logged, and the next save writes what this one did not).
+        Saves from one Detectors are serialized; heavy hitters are upserted
+        and the sources no longer among them deleted.
+        """
+        with self._save_lock:
+            try:
+                written = self.correlation.write(db)
+                updated_at = utcnow()
+                rows = [{**hitter, "rank": rank, "updated_at": updated_at}
+                        for rank, hitter in enumerate(self.firewall.heavy_hitters(), start=1)]
+                upsert_rows(db, HeavyHitter, sorted(rows, key=lambda row: row["src_ip"]), key="src_ip")
+                db.execute(delete(HeavyHitter).where(HeavyHitter.src_ip.not_in([row["src_ip"] for row in rows])))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Failed to store correlated incidents and heavy hitters: {e}")
+                return
+            self.correlation.saved(written)
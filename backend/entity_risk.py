@@ -0,0 +1,167 @@
+"""Rolling risk per entity (user, source IP, device).
+
+Analyses are stored per event, so the current risk of a device or account
+could only be had by aggregating its whole history. Instead, every stored
+login or firewall analysis also adds its risk score to the users, IPs and
+devices its event names, in the entity_risk table, in the same transaction:
+
+    score = previous score * 0.5 ** (elapsed / half-life) + risk score
+
+Patch analyses describe a device's current state rather than something that
+happened, and the same posture is re-reported and re-analyzed every cycle.
+They are not summed: the latest one's risk score replaces the device's
+patch_score, and an entity's risk is its decayed score plus its patch_score.
+
+The decay is applied inside the upsert, so concurrent writers never lose an
+update, and readers get an entity's current risk from one primary-key lookup
+by decaying the stored score to the present (current_risk). Device rows also
+carry the device's patch posture from patch_levels.
+"""
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+from .models import EntityRisk, EventAnalysis, PatchLevel
+from .timeutils import utcnow
+
+HALF_LIFE_HOURS = float(os.getenv("ENTITY_RISK_HALF_LIFE_HOURS", "24"))  # Time for an entity's risk to halve
+HALF_LIFE_SECONDS = HALF_LIFE_HOURS * 3600
+
+ENTITY_TYPES = ("user", "ip", "device")
+
+
+def entity_keys(event_type: str, data: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """(entity_type, entity_id) pairs an event's risk is attributed to."""
+    if event_type == "login":
+        return [("user", data["username"]), ("ip", data["src_ip"]), ("device", data["device_id"])]
+    if event_type == "firewall":
+        return [("ip", data["src_ip"])]  # The destination is the target, not the actor
+    if event_type == "patch":
+        return [("device", data["device_id"])]
+    return []
+
+
+def decay(score: float, elapsed_seconds: float) -> float:
+    """Score decayed over ``elapsed_seconds``."""
+    return score * 0.5 ** (max(0.0, elapsed_seconds) / HALF_LIFE_SECONDS)
+
+
+def record(db: Session, scored: List[Tuple[EventAnalysis, Dict[str, Any]]]) -> None:
+    """
+    Add stored analyses to their entities' rolling risk, in the caller's transaction.
+
+    ``scored`` pairs each analysis with its event's data (the payload sent to
+    the agent). Updates to one entity within the batch are combined first, as
+    one upsert may not touch a row twice.
+    """
+    from .ingest import dialect_insert  # Needs numpy, which readers such as the dashboard do not install
+
+    rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for analysis, data in sorted(scored, key=lambda item: item[0].analyzed_at or utcnow()):
+        analyzed_at = analysis.analyzed_at or utcnow()
+        epoch = analyzed_at.timestamp()
+        for key in entity_keys(analysis.event_type, data):
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {"entity_type": key[0], "entity_id": key[1], "score": 0.0,
+                                   "peak_risk": 0, "events": 0, "patch_score": None, "patch_epoch": None,
+                                   "updated_epoch": epoch}
+            if analysis.event_type == "patch":
+                # A current level: the latest analysis replaces earlier ones instead of adding to them
+                row.update(patch_score=float(analysis.risk_score), patch_epoch=epoch)
+                row["score"] = decay(row["score"], epoch - row["updated_epoch"])
+            else:
+                row["score"] = decay(row["score"], epoch - row["updated_epoch"]) + analysis.risk_score
+                row["events"] += 1
+            row["peak_risk"] = max(row["peak_risk"], analysis.risk_score)
+            row.update(last_event_type=analysis.event_type, last_event_id=analysis.event_id,
+                       last_severity=analysis.severity, updated_at=analyzed_at, updated_epoch=epoch)
+    if not rows:
+        return
+
+    posture = _patch_posture(db, [entity_id for entity_type, entity_id in rows if entity_type == "device"])
+    for (entity_type, entity_id), row in rows.items():
+        row["unpatched"] = posture.get(entity_id) if entity_type == "device" else None
+
+    table = EntityRisk.__table__
+    stmt = dialect_insert(db, EntityRisk)
+    new = stmt.excluded
+    newer = new.updated_epoch >= table.c.updated_epoch
+    newer_patch = new.patch_epoch.is_not(None) & (table.c.patch_epoch.is_(None)
+                                                  | (new.patch_epoch >= table.c.patch_epoch))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["entity_type", "entity_id"],
+        set_={
+            # Decay the older of the two scores to the newer one's time, then add
+            "score": case(
+                (newer, table.c.score * func.power(0.5, (new.updated_epoch - table.c.updated_epoch) / HALF_LIFE_SECONDS)
+                 + new.score),
+                else_=table.c.score + new.score * func.power(0.5, (table.c.updated_epoch - new.updated_epoch)
+                                                             / HALF_LIFE_SECONDS),
+            ),
+            "peak_risk": case((new.peak_risk > table.c.peak_risk, new.peak_risk), else_=table.c.peak_risk),
+            "events": table.c.events + new.events,
+            "patch_score": case((newer_patch, new.patch_score), else_=table.c.patch_score),
+            "patch_epoch": case((newer_patch, new.patch_epoch), else_=table.c.patch_epoch),
+            "last_event_type": case((newer, new.last_event_type), else_=table.c.last_event_type),
+            "last_event_id": case((newer, new.last_event_id), else_=table.c.last_event_id),
+            "last_severity": case((newer, new.last_severity), else_=table.c.last_severity),
+            "unpatched": func.coalesce(new.unpatched, table.c.unpatched),
+            "updated_at": case((newer, new.updated_at), else_=table.c.updated_at),
+            "updated_epoch": case((newer, new.updated_epoch), else_=table.c.updated_epoch),
+        },
+    )
+    db.execute(stmt, sorted(rows.values(), key=lambda row: (row["entity_type"], row["entity_id"])))  # Fixed lock order
+
+
+def _patch_posture(db: Session, device_ids: List[str]) -> Dict[str, bool]:
+    """Whether each known device is unpatched (missing critical patches or on an unsupported OS)."""
+    if not device_ids:
+        return {}
+    return {device_id: bool(missing_critical) or bool(is_unsupported)
+            for device_id, missing_critical, is_unsupported in db.execute(
+                select(PatchLevel.device_id, PatchLevel.missing_critical, PatchLevel.is_unsupported)
+                .where(PatchLevel.device_id.in_(device_ids)))}
+
+
+def current_risk(db: Session, entity_type: str, entity_id: str,
+                 now: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """An entity's rolling risk decayed to ``now`` (default: the current time), or None if it has none."""
+    row = db.execute(select(EntityRisk).where(EntityRisk.entity_type == entity_type,
+                                              EntityRisk.entity_id == entity_id)).scalar_one_or_none()
+    return None if row is None else to_dict(row, now)
+
+
+def riskiest(db: Session, entity_type: Optional[str] = None, limit: int = 20,
+             now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Entities with the highest current risk, optionally of one type."""
+    now = now or utcnow()
+    current = (EntityRisk.score * func.power(0.5, (now.timestamp() - EntityRisk.updated_epoch) / HALF_LIFE_SECONDS)
+               + func.coalesce(EntityRisk.patch_score, 0.0))
+    query = select(EntityRisk).order_by(current.desc()).limit(limit)
+    if entity_type:
+        query = query.where(EntityRisk.entity_type == entity_type)
+    return [to_dict(row, now) for row in db.execute(query).scalars()]
+
+
+def to_dict(row: EntityRisk, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """API representation of an entity's risk, decayed to ``now``."""
+    now = now or utcnow()
+    event_risk = decay(row.score, now.timestamp() - row.updated_epoch)
+    return {
+        "entity_type": row.entity_type,
+        "entity_id": row.entity_id,
+        "risk": round(event_risk + (row.patch_score or 0.0), 1),
+        "event_risk": round(event_risk, 1),
+        "patch_risk": row.patch_score,
+        "peak_risk": row.peak_risk,
+        "events": row.events,
+        "last_event_type": row.last_event_type,
+        "last_event_id": row.last_event_id,
+        "last_severity": row.last_severity,
+        "unpatched": row.unpatched,
+        "updated_at": row.updated_at.isoformat(),
+    }
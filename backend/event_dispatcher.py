@@ -1,20 +1,245 @@
 """Event dispatcher to send events to AI agent for analysis."""
 import os
 import logging
+import random
+import time
 import requests
-from typing import Dict, Any, List
-from datetime import datetime
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlalchemy.orm import Session
 from .models import LoginEvent, FirewallLog, PatchLevel, EventAnalysis
 from .database import SessionLocal
+from .concurrency import AdaptiveConcurrencyLimiter, SingleFlight
+from .ingest import dialect_insert
+from . import deadletter, entity_risk, outbox
+from .timeutils import utcnow
+from .whitelist import WHITELIST_ENFORCED, whitelist
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 AGENT_URL = os.getenv("AGENT_URL", "http://agent:8000/evaluate-event")
 TIMEOUT = 30  # seconds
-MAX_WORKERS = int(os.getenv("DISPATCH_WORKERS", "10"))  # Concurrent dispatch threads
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "10"))  # Initial (or, non-adaptive, fixed) requests in flight
+DISPATCH_MIN_WORKERS = int(os.getenv("DISPATCH_MIN_WORKERS", "1"))
+DISPATCH_MAX_WORKERS = int(os.getenv("DISPATCH_MAX_WORKERS", "64"))
+# Adjust requests in flight to the agent's observed latency (see backend/concurrency.py)
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+# Dispatch thread pool size; the limiter decides how many of the threads talk to the agent at once
+MAX_WORKERS = DISPATCH_MAX_WORKERS if ADAPTIVE_CONCURRENCY else DISPATCH_WORKERS
+DISPATCH_RETRIES = int(os.getenv("DISPATCH_RETRIES", "3"))  # Extra attempts after a transient agent error
+RETRY_BASE_SECONDS = float(os.getenv("DISPATCH_RETRY_BASE_SECONDS", "0.5"))  # Backoff before the first retry
+RETRY_MAX_SECONDS = float(os.getenv("DISPATCH_RETRY_MAX_SECONDS", "10"))  # Longest backoff between retries
+# Longest a dispatch may take, counted from when its events were enqueued (inserted) or claimed from the
+# outbox, so waits in executor and stream queues count too; kept well under the outbox visibility
+# timeout so the recovery worker does not re-dispatch an event still being scored
+DISPATCH_DEADLINE_SECONDS = float(os.getenv("DISPATCH_DEADLINE_SECONDS", str(outbox.VISIBILITY_TIMEOUT / 2)))
+# Score with the agent's rule engine in this process instead of over HTTP.
+# Only valid when the agent runs rule-based (USE_LLM=false); LLM mode needs the agent service.
+INPROCESS_SCORING = os.getenv("INPROCESS_SCORING", "false").lower() == "true"
+# Send one agent request for concurrent events with identical scoring features (e.g. the probes of a port scan)
+DISPATCH_SINGLE_FLIGHT = os.getenv("DISPATCH_SINGLE_FLIGHT", "true").lower() == "true"
+
+# agent/ is mounted next to backend/ (see docker-compose.yml)
+if INPROCESS_SCORING:
+    from agent.scoring import analyze_event
+if DISPATCH_SINGLE_FLIGHT:
+    from agent.scoring import feature_key
+
+# Shared by every dispatch path in this process, so they compete for one limit
+limiter = AdaptiveConcurrencyLimiter(
+    initial=DISPATCH_WORKERS,
+    min_limit=DISPATCH_MIN_WORKERS,
+    max_limit=DISPATCH_MAX_WORKERS,
+    adaptive=ADAPTIVE_CONCURRENCY,
+)
+single_flight = SingleFlight()
+
+
+class DispatchFailed(requests.exceptions.RequestException):
+    """An agent request that failed for good, after ``attempts`` tries."""
+
+    def __init__(self, error: requests.exceptions.RequestException, attempts: int, transient: bool):
+        super().__init__(str(error), response=getattr(error, "response", None))
+        self.attempts = attempts
+        self.transient = transient  # The agent was unavailable or overloaded; the event may succeed later
+
+
+def is_overload_error(error: requests.exceptions.RequestException) -> bool:
+    """True for failures that mean the agent is saturated rather than the request is bad."""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (response.status_code >= 500 or response.status_code == 429)
+
+
+def dispatch_deadline() -> float:
+    """Monotonic time by which dispatches of events enqueued or claimed now must end."""
+    return time.monotonic() + DISPATCH_DEADLINE_SECONDS
+
+
+def request_analysis(payload: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Score an event payload, either in-process or via the agent's HTTP API.
+
+    Events matching the analyst whitelist are not sent: they get a zero-risk
+    result naming the whitelist entry. Events whose scoring features
+    (agent.scoring.feature_key) equal those of an event already being sent
+    share its request and result: all events of a burst are dispatched from
+    one process, so this holds however many agent workers serve them.
+    Transient errors (timeouts, connection errors, 5xx/429) are retried up to
+    DISPATCH_RETRIES times with jittered exponential backoff, all by
+    ``deadline`` (from dispatch_deadline() when the event was enqueued or
+    claimed; default: now). An event whose deadline passed while it waited
+    is not sent: the outbox recovery worker will own it. Raises
+    DispatchFailed when the request fails for good or is not sent.
+    """
+    reason = whitelist.match(payload["type"], payload["data"]) if WHITELIST_ENFORCED else None
+    if reason:
+        return {
+            "event_type": payload["type"],
+            "risk_score": 0,
+            "severity": "low",
+            "reasoning": f"Whitelisted {reason} (analyst approved); not scored",
+            "recommended_action": "No action required",
+        }
+
+    if INPROCESS_SCORING:
+        return analyze_event(payload["type"], payload["data"]).model_dump()
+
+    deadline = deadline or dispatch_deadline()
+    if time.monotonic() >= deadline:
+        # Queued too long: the recovery worker may claim the event any time now, so leave it to the outbox
+        error = requests.exceptions.Timeout("Dispatch deadline passed while queued; left to the outbox")
+        raise DispatchFailed(error, 0, transient=True)
+
+    if DISPATCH_SINGLE_FLIGHT:
+        key = feature_key(payload["type"], payload["data"])
+        return dict(single_flight.run(key, lambda: _request_with_retries(payload, deadline)))
+    return _request_with_retries(payload, deadline)
+
+
+def _request_with_retries(payload: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+    """Agent result for a payload, retrying transient errors until ``deadline`` (monotonic)."""
+    for attempt in range(1, DISPATCH_RETRIES + 2):
+        try:
+            return _post_analysis(payload, deadline)
+        except requests.exceptions.RequestException as e:
+            transient = is_overload_error(e)
+            # Full jitter, so retries from many threads do not hit the agent in step
+            backoff = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+            if not transient or attempt > DISPATCH_RETRIES or time.monotonic() + backoff >= deadline:
+                raise DispatchFailed(e, attempt, transient) from e
+            time.sleep(backoff)
+
+
+def _post_analysis(payload: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+    """One HTTP request to the agent, within the concurrency limit, ending by ``deadline`` (monotonic)."""
+    started = limiter.acquire(timeout=deadline - time.monotonic())
+    if started is None:
+        raise requests.exceptions.Timeout("Timed out waiting for a dispatch slot")
+    overloaded = False
+    try:
+        response = requests.post(AGENT_URL, json=payload, timeout=max(0.1, min(TIMEOUT, deadline - time.monotonic())))
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        overloaded = is_overload_error(e)
+        raise
+    finally:
+        limiter.release(started, overloaded)
+
+
+def store_analyses(db: Session, scored: List[Tuple[EventAnalysis, Dict[str, Any]]]) -> int:
+    """
+    Store analyses with their events' data and ack the events, in the caller's transaction.
+
+    An event that already has an analysis (a slow first dispatch and the
+    outbox recovery worker both scored it) keeps the first one; the duplicate
+    is dropped and not added to entity risk again. Returns how many were new.
+    """
+    if not scored:
+        return 0
+    columns = ["event_type", "event_id", "risk_score", "severity", "reasoning", "recommended_action", "analyzed_at"]
+    table = EventAnalysis.__table__
+    stmt = (dialect_insert(db, EventAnalysis)
+            .values([{name: getattr(analysis, name) for name in columns} for analysis, _ in scored])
+            .on_conflict_do_nothing(index_elements=["event_type", "event_id"])
+            .returning(table.c.id, table.c.event_type, table.c.event_id))
+    ids = {(event_type, event_id): analysis_id for analysis_id, event_type, event_id in db.execute(stmt)}
+
+    stored = []
+    for analysis, data in scored:
+        analysis_id = ids.pop((analysis.event_type, analysis.event_id), None)
+        if analysis_id is not None:
+            analysis.id = analysis_id
+            stored.append((analysis, data))
+    if len(stored) < len(scored):
+        logger.info(f"Skipped {len(scored) - len(stored)} analyses of events that were already analyzed")
+    entity_risk.record(db, stored)
+    outbox.ack(db, [(analysis.event_type, analysis.event_id) for analysis, _ in scored])
+    return len(stored)
+
+
+def record_failure(db: Session, payload: Dict[str, Any], error: str, attempts: int, transient: bool) -> None:
+    """
+    Record a failed dispatch and commit.
+
+    Transient failures stay in the outbox, with the error noted, for the
+    recovery worker to retry later; permanent ones are dead-lettered.
+    """
+    event_type, event_id = payload["type"], payload["data"]["id"]
+    try:
+        if transient:
+            outbox.note_failure(db, (event_type, event_id), error)
+        else:
+            deadletter.bury(db, [{"event_type": event_type, "event_id": event_id, "payload": payload,
+                                  "error": error, "attempts": attempts}])
+            logger.warning(f"Dead-lettered {event_type} event {event_id} after {attempts} attempt(s): {error}")
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to record dispatch failure of event {event_id}: {e}")
+
+
+# Fields sent to the agent for each event type
+EVENT_FIELDS = {
+    "login": ["username", "src_ip", "status", "timestamp", "local_hour", "device_id",
+              "auth_method", "is_burst_failure", "is_suspicious_ip", "is_admin", "is_credential_stuffing"],
+    "firewall": ["src_ip", "dst_ip", "action", "port", "protocol", "timestamp", "is_port_scan",
+                 "is_lateral_movement", "is_malicious_range", "is_connection_spike"],
+    "patch": ["device_id", "os", "last_patch_date", "missing_critical", "missing_high",
+              "update_failures", "is_unsupported"],
+}
+EVENT_TYPES = {LoginEvent: "login", FirewallLog: "firewall", PatchLevel: "patch"}
+
+
+def event_to_data(event: Any) -> Dict[str, Any]:
+    """Event id and payload fields as plain, JSON-compatible values (safe to pass across threads)."""
+    data = {"id": event.id}
+    for name in EVENT_FIELDS[EVENT_TYPES[type(event)]]:
+        value = getattr(event, name)
+        if isinstance(value, (datetime, date)):
+            value = value.isoformat()
+        data[name] = value
+    return data
+
+
+def build_analysis(event_type: str, event_id: int, result: Dict[str, Any]) -> Optional[EventAnalysis]:
+    """EventAnalysis row for an agent result, or None if the result is malformed."""
+    if not all(k in result for k in ["event_type", "risk_score", "severity", "reasoning", "recommended_action"]):
+        logger.error(f"Invalid response format from agent: {result}")
+        return None
+    return EventAnalysis(
+        event_type=event_type,
+        event_id=event_id,
+        risk_score=result["risk_score"],
+        severity=result["severity"],
+        reasoning=result["reasoning"],
+        recommended_action=result["recommended_action"],
+        analyzed_at=utcnow()
+    )
 
 
 class EventDispatcher:
@@ -33,11 +258,13 @@ class EventDispatcher:
                 "src_ip": event.src_ip,
                 "status": event.status,
                 "timestamp": event.timestamp.isoformat(),
+                "local_hour": event.local_hour,
                 "device_id": event.device_id,
                 "auth_method": event.auth_method,
                 "is_burst_failure": event.is_burst_failure,
                 "is_suspicious_ip": event.is_suspicious_ip,
-                "is_admin": event.is_admin
+                "is_admin": event.is_admin,
+                "is_credential_stuffing": event.is_credential_stuffing
             }
         }
         return self._send_event(payload, "login", event.id)
@@ -79,196 +306,106 @@ class EventDispatcher:
 
     def _send_event(self, payload: Dict[str, Any], event_type: str, event_id: int) -> Dict[str, Any]:
         """Send event to agent and store analysis result."""
-        try:
-            logger.info(f"Dispatching {event_type} event {event_id} to agent")
-            response = requests.post(AGENT_URL, json=payload, timeout=TIMEOUT)
-            response.raise_for_status()
-
-            result = response.json()
-            
-            # Validate response
-            if not all(k in result for k in ["event_type", "risk_score", "severity", "reasoning", "recommended_action"]):
-                logger.error(f"Invalid response format from agent: {result}")
-                return {"error": "Invalid response format"}
-
-            # Store analysis result
-            analysis = EventAnalysis(
-                event_type=event_type,
-                event_id=event_id,
-                risk_score=result["risk_score"],
-                severity=result["severity"],
-                reasoning=result["reasoning"],
-                recommended_action=result["recommended_action"],
-                analyzed_at=datetime.utcnow()
-            )
-            self.db.add(analysis)
-            self.db.commit()
+        return self._send_event_in(self.db, payload, event_type, event_id)
 
-            logger.info(f"Event {event_id} analyzed: severity={result['severity']}, score={result['risk_score']}")
-            return result
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to dispatch event {event_id}: {e}")
-            return {"error": str(e)}
-        except Exception as e:
-            logger.error(f"Unexpected error dispatching event {event_id}: {e}")
-            return {"error": str(e)}
-    
-    def _send_event_with_session(self, payload: Dict[str, Any], event_type: str, event_id: int) -> Dict[str, Any]:
+    def _send_event_with_session(self, payload: Dict[str, Any], event_type: str, event_id: int,
+                                 deadline: Optional[float] = None) -> Dict[str, Any]:
         """Send event to agent and store analysis result with a dedicated session."""
         db = SessionLocal()  # Create new session for this thread
+        try:
+            return self._send_event_in(db, payload, event_type, event_id, deadline)
+        finally:
+            db.close()  # Always close the session
+
+    @staticmethod
+    def _send_event_in(db: Session, payload: Dict[str, Any], event_type: str, event_id: int,
+                       deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Send event to agent and store analysis result in ``db``, rolling it back on error."""
         try:
             logger.info(f"Dispatching {event_type} event {event_id} to agent")
-            response = requests.post(AGENT_URL, json=payload, timeout=TIMEOUT)
-            response.raise_for_status()
+            result = request_analysis(payload, deadline)
 
-            result = response.json()
-            
             # Validate response
-            if not all(k in result for k in ["event_type", "risk_score", "severity", "reasoning", "recommended_action"]):
-                logger.error(f"Invalid response format from agent: {result}")
+            analysis = build_analysis(event_type, event_id, result)
+            if analysis is None:
+                record_failure(db, payload, f"Invalid response format: {result}", 1, transient=False)
                 return {"error": "Invalid response format"}
 
             # Store analysis result
-            analysis = EventAnalysis(
-                event_type=event_type,
-                event_id=event_id,
-                risk_score=result["risk_score"],
-                severity=result["severity"],
-                reasoning=result["reasoning"],
-                recommended_action=result["recommended_action"],
-                analyzed_at=datetime.utcnow()
-            )
-            db.add(analysis)
+            store_analyses(db, [(analysis, payload["data"])])
             db.commit()
 
             logger.info(f"Event {event_id} analyzed: severity={result['severity']}, score={result['risk_score']}")
             return result
 
+        except DispatchFailed as e:
+            logger.error(f"Failed to dispatch event {event_id} after {e.attempts} attempt(s): {e}")
+            record_failure(db, payload, str(e), e.attempts, e.transient)
+            return {"error": str(e)}
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to dispatch event {event_id}: {e}")
             return {"error": str(e)}
         except Exception as e:
+            db.rollback()  # Leave the session usable (it may be shared) after a database error
             logger.error(f"Unexpected error dispatching event {event_id}: {e}")
             return {"error": str(e)}
-        finally:
-            db.close()  # Always close the session
 
-    def dispatch_login_events_parallel(self, events: List[LoginEvent]) -> int:
-        """Dispatch multiple login events in parallel."""
+    def dispatch_with_session(self, event: Any, deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Dispatch one event of any type from a worker thread, using a dedicated session.
+
+        Pass the dispatch_deadline() taken when the event was inserted if it
+        may wait in an executor queue first.
+        """
+        event_type = EVENT_TYPES[type(event)]
+        data = event_to_data(event)
+        return self._send_event_with_session({"type": event_type, "data": data}, event_type, data["id"], deadline)
+
+    def dispatch_events_parallel(self, events: List[Any], executor: Optional[ThreadPoolExecutor] = None) -> int:
+        """
+        Dispatch events of any type in parallel and return how many succeeded.
+
+        Runs on ``executor`` if given (a pool shared by several callers),
+        otherwise on a pool of MAX_WORKERS threads for this call. Call right
+        after the events are inserted or claimed: their dispatch deadline
+        starts now, however long they then wait for a thread.
+        """
+        deadline = dispatch_deadline()
         # Convert events to dict to avoid lazy loading issues across threads
-        event_data = []
-        for event in events:
-            event_data.append({
-                'id': event.id,
-                'username': event.username,
-                'src_ip': event.src_ip,
-                'status': event.status,
-                'timestamp': event.timestamp.isoformat(),
-                'device_id': event.device_id,
-                'auth_method': event.auth_method,
-                'is_burst_failure': event.is_burst_failure,
-                'is_suspicious_ip': event.is_suspicious_ip,
-                'is_admin': event.is_admin
-            })
-        
+        event_data = [(EVENT_TYPES[type(event)], event_to_data(event)) for event in events]
+        if not event_data:
+            return 0
+
+        pool = executor or ThreadPoolExecutor(max_workers=MAX_WORKERS)
         successful = 0
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(self._dispatch_login_with_session, data): data for data in event_data}
+        try:
+            futures = {pool.submit(self._send_event_with_session, {"type": event_type, "data": data},
+                                   event_type, data["id"], deadline): (event_type, data)
+                       for event_type, data in event_data}
             for future in as_completed(futures):
                 try:
                     result = future.result()
                     if "error" not in result:
                         successful += 1
                 except Exception as e:
-                    data = futures[future]
-                    logger.error(f"Error dispatching login event {data['id']}: {e}")
+                    event_type, data = futures[future]
+                    logger.error(f"Error dispatching {event_type} event {data['id']}: {e}")
+        finally:
+            if executor is None:
+                pool.shutdown()
         return successful
-    
-    def _dispatch_login_with_session(self, event_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Dispatch a login event with its own database session."""
-        payload = {
-            "type": "login",
-            "data": event_data
-        }
-        return self._send_event_with_session(payload, "login", event_data['id'])
+
+    def dispatch_login_events_parallel(self, events: List[LoginEvent]) -> int:
+        """Dispatch multiple login events in parallel."""
+        return self.dispatch_events_parallel(events)
 
     def dispatch_firewall_events_parallel(self, events: List[FirewallLog]) -> int:
         """Dispatch multiple firewall events in parallel."""
-        # Convert events to dict to avoid lazy loading issues across threads
-        event_data = []
-        for event in events:
-            event_data.append({
-                'id': event.id,
-                'src_ip': event.src_ip,
-                'dst_ip': event.dst_ip,
-                'action': event.action,
-                'port': event.port,
-                'protocol': event.protocol,
-                'timestamp': event.timestamp.isoformat(),
-                'is_port_scan': event.is_port_scan,
-                'is_lateral_movement': event.is_lateral_movement,
-                'is_malicious_range': event.is_malicious_range,
-                'is_connection_spike': event.is_connection_spike
-            })
-        
-        successful = 0
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(self._dispatch_firewall_with_session, data): data for data in event_data}
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    if "error" not in result:
-                        successful += 1
-                except Exception as e:
-                    data = futures[future]
-                    logger.error(f"Error dispatching firewall event {data['id']}: {e}")
-        return successful
-    
-    def _dispatch_firewall_with_session(self, event_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Dispatch a firewall event with its own database session."""
-        payload = {
-            "type": "firewall",
-            "data": event_data
-        }
-        return self._send_event_with_session(payload, "firewall", event_data['id'])
+        return self.dispatch_events_parallel(events)
 
     def dispatch_patch_events_parallel(self, events: List[PatchLevel]) -> int:
         """Dispatch multiple patch events in parallel."""
-        # Convert events to dict to avoid lazy loading issues across threads
-        event_data = []
-        for event in events:
-            event_data.append({
-                'id': event.id,
-                'device_id': event.device_id,
-                'os': event.os,
-                'last_patch_date': event.last_patch_date.isoformat(),
-                'missing_critical': event.missing_critical,
-                'missing_high': event.missing_high,
-                'update_failures': event.update_failures,
-                'is_unsupported': event.is_unsupported
-            })
-        
-        successful = 0
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(self._dispatch_patch_with_session, data): data for data in event_data}
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    if "error" not in result:
-                        successful += 1
-                except Exception as e:
-                    data = futures[future]
-                    logger.error(f"Error dispatching patch event {data['id']}: {e}")
-        return successful
-    
-    def _dispatch_patch_with_session(self, event_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Dispatch a patch event with its own database session."""
-        payload = {
-            "type": "patch",
-            "data": event_data
-        }
-        return self._send_event_with_session(payload, "patch", event_data['id'])
+        return self.dispatch_events_parallel(events)
 
     def dispatch_all_pending(self):
         """Dispatch all events that haven't been analyzed yet."""
@@ -0,0 +1,210 @@
+"""Bulk ingest of event batches.
+
+On PostgreSQL, rows are written with COPY, which skips the ORM unit of work
+and per-row INSERT round trips. Ids are reserved up front from the table's
+sequence so callers get them back for dispatch. Other databases fall back to
+chunked multi-row INSERT ... RETURNING id.
+
+Batches arrive either as ORM objects (DataGenerator) or as ColumnBatch
+(LoadGenerator). Nothing here commits; callers commit so ingest can share
+their transaction.
+"""
+import io
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Iterator, List, Sequence
+
+import numpy as np
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .models import LoginEvent, FirewallLog
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 50_000  # Rows per COPY statement
+INSERT_CHUNK_SIZE = 1_000  # Rows per multi-row INSERT (non-PostgreSQL fallback)
+
+BATCH_MODELS = {"login": LoginEvent, "firewall": FirewallLog}
+
+
+@dataclass
+class ColumnBatch:
+    """A batch of events of one type stored column by column (timestamps as UTC epoch microseconds)."""
+    event_type: str  # "login" or "firewall"
+    columns: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    def rows(self) -> Iterator[Dict]:
+        """Iterate the batch row by row (slow; for small batches and tests)."""
+        names = list(self.columns)
+        for values in zip(*(self.columns[name].tolist() for name in names)):
+            yield dict(zip(names, values))
+
+
+def timestamp_strings(epoch_us: np.ndarray) -> np.ndarray:
+    """Format epoch-microsecond timestamps as ISO 8601 UTC strings."""
+    return np.datetime_as_string(epoch_us.astype("datetime64[us]"), unit="us", timezone="UTC")
+
+
+def _copy_value(value: Any) -> str:
+    """Render one value in COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bool, np.bool_)):
+        return "t" if value else "f"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+    return str(value)
+
+
+def _insert_columns(model) -> List[str]:
+    """Columns written on insert (everything except the primary key)."""
+    return [column.name for column in model.__table__.columns if not column.primary_key]
+
+
+def _column_default(model, name: str) -> Any:
+    """Python-side default of a column, as the ORM would apply it on flush."""
+    default = model.__table__.columns[name].default
+    if default is None:
+        return None
+    if default.is_callable:
+        return default.arg(None)
+    return default.arg
+
+
+def reserve_ids(db: Session, model, count: int) -> List[int]:
+    """Reserve ``count`` ids from the table's id sequence (PostgreSQL)."""
+    rows = db.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+        {"table": model.__tablename__, "count": count},
+    )
+    return [row[0] for row in rows]
+
+
+def copy_rows(db: Session, model, columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> None:
+    """Stream rows (values in ``columns`` order, id first) into the table with COPY."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    column_list = ", ".join(f'"{name}"' for name in columns)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY {model.__tablename__} ({column_list}) FROM STDIN', buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(db: Session, model, rows: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert row dicts (without ids) in bulk and return their new ids, in order.
+
+    Uses COPY with pre-reserved ids on PostgreSQL, chunked INSERT ... RETURNING
+    elsewhere.
+    """
+    if not rows:
+        return []
+
+    columns = _insert_columns(model)
+    defaults = {name: _column_default(model, name) for name in columns}
+    values = [[row[name] if row.get(name) is not None else defaults[name] for name in columns]
+              for row in rows]
+
+    if db.get_bind().dialect.name != "postgresql":
+        ids = []
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            chunk = [dict(zip(columns, row)) for row in values[start:start + INSERT_CHUNK_SIZE]]
+            ids.extend(db.scalars(
+                insert(model).returning(model.id, sort_by_parameter_order=True), chunk
+            ).all())
+        return ids
+
+    ids = []
+    for start in range(0, len(values), COPY_CHUNK_SIZE):
+        chunk = values[start:start + COPY_CHUNK_SIZE]
+        chunk_ids = reserve_ids(db, model, len(chunk))
+        copy_rows(db, model, ["id"] + columns, ([i] + row for i, row in zip(chunk_ids, chunk)))
+        ids.extend(chunk_ids)
+    return ids
+
+
+def dialect_insert(db: Session, model):
+    """INSERT construct of the session's dialect (supports ON CONFLICT on PostgreSQL and SQLite)."""
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+
+def upsert_rows(db: Session, model, rows: List[Dict[str, Any]], key: str) -> List[Any]:
+    """
+    Insert row dicts, overwriting existing rows with the same unique ``key``.
+
+    If ``rows`` repeats a key, the last row wins (one statement cannot update
+    a row twice). Returns the written rows as transient model objects with ids set.
+    """
+    if not rows:
+        return []
+    rows = list({row[key]: row for row in rows}.values())
+    table = model.__table__
+    stmt = dialect_insert(db, model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c[key]],
+        set_={name: stmt.excluded[name] for name in rows[0] if name != key},
+    ).returning(*table.c)
+    return [model(**row) for row in db.execute(stmt).mappings()]
+
+
+def insert_events(db: Session, events: List[Any]) -> List[int]:
+    """
+    Bulk insert ORM event objects of one model and assign their ids.
+
+    The objects are not added to the session; they stay transient with ``id``
+    set, which is all the dispatcher needs.
+    """
+    if not events:
+        return []
+    model = type(events[0])
+    columns = _insert_columns(model)
+    ids = insert_rows(db, model, [{name: getattr(event, name) for name in columns} for event in events])
+    for event, event_id in zip(events, ids):
+        event.id = event_id
+    logger.info(f"Bulk inserted {len(ids)} {model.__tablename__} rows")
+    return ids
+
+
+def insert_batch(db: Session, batch: ColumnBatch) -> np.ndarray:
+    """Bulk insert a columnar batch from LoadGenerator; returns the new ids."""
+    model = BATCH_MODELS[batch.event_type]
+    columns = list(batch.columns)
+    data = []
+    for name in columns:
+        column = batch.columns[name]
+        if name == "timestamp":
+            column = timestamp_strings(column)
+        data.append(column.tolist())
+
+    if db.get_bind().dialect.name != "postgresql":
+        rows = [dict(zip(columns, values)) for values in zip(*data)]
+        for row in rows:
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+        return np.array(insert_rows(db, model, rows))
+
+    ids = []
+    for start in range(0, len(batch), COPY_CHUNK_SIZE):
+        chunk = [column[start:start + COPY_CHUNK_SIZE] for column in data]
+        chunk_ids = reserve_ids(db, model, len(chunk[0]))
+        copy_rows(db, model, ["id"] + columns, zip(chunk_ids, *chunk))
+        ids.extend(chunk_ids)
+    logger.info(f"Bulk inserted {len(ids)} {model.__tablename__} rows")
+    return np.array(ids)
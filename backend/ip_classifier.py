@@ -0,0 +1,162 @@
+"""Classification of IP addresses against configurable address ranges.
+
+Ranges come from environment variables as comma-separated CIDR blocks,
+single addresses or inclusive ``first-last`` ranges:
+
+    INTERNAL_NETWORKS=192.168.1.0/24,10.0.0.0/8
+    EXTERNAL_NETWORKS=203.0.113.0/24
+    MALICIOUS_NETWORKS=198.51.100.1-198.51.100.49
+
+Membership is a frozenset lookup when a category is small enough to expand,
+otherwise a binary search over merged integer ranges, so the same classifier
+serves both synthetic generation and real ingested traffic.
+"""
+import bisect
+import ipaddress
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_INTERNAL_NETWORKS = "192.168.1.0/24"
+DEFAULT_EXTERNAL_NETWORKS = "203.0.113.0/24"
+DEFAULT_MALICIOUS_NETWORKS = "198.51.100.1-198.51.100.49"
+
+EXPAND_LIMIT = 65_536  # Largest category precomputed as a frozenset of address strings
+POOL_LIMIT = 4_096  # Most addresses per category used as a generator sampling pool
+
+
+def _format(version: int, value: int) -> str:
+    """Render an integer address of the given IP version."""
+    return str(ipaddress.IPv4Address(value) if version == 4 else ipaddress.IPv6Address(value))
+
+
+def _parse_spec(spec: str) -> List[Tuple[int, int, int, bool]]:
+    """Parse a range spec into (version, first, last, is_cidr) tuples."""
+    ranges = []
+    for part in (p.strip() for p in spec.split(",")):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = (ipaddress.ip_address(a.strip()) for a in part.split("-", 1))
+            if first.version != last.version or int(first) > int(last):
+                raise ValueError(f"Invalid address range: {part}")
+            ranges.append((first.version, int(first), int(last), False))
+        else:
+            network = ipaddress.ip_network(part, strict=False)
+            ranges.append((network.version, int(network.network_address),
+                           int(network.broadcast_address), True))
+    return ranges
+
+
+class AddressSet:
+    """A set of IP addresses defined by ranges, with fast membership tests."""
+
+    def __init__(self, spec: str):
+        """Build the set from a comma-separated spec (CIDR, address or first-last)."""
+        self.spec = spec
+        self._ranges = _parse_spec(spec)
+
+        # Merged, sorted ranges per IP version for binary search
+        self._starts: Dict[int, List[int]] = {}
+        self._ends: Dict[int, List[int]] = {}
+        for version, first, last, _ in sorted(self._ranges):
+            starts = self._starts.setdefault(version, [])
+            ends = self._ends.setdefault(version, [])
+            if starts and first <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], last)
+            else:
+                starts.append(first)
+                ends.append(last)
+
+        size = sum(last - first + 1 for version in self._starts
+                   for first, last in zip(self._starts[version], self._ends[version]))
+        self._exact: Optional[frozenset] = None
+        if size <= EXPAND_LIMIT:
+            self._exact = frozenset(
+                _format(version, value)
+                for version in self._starts
+                for first, last in zip(self._starts[version], self._ends[version])
+                for value in range(first, last + 1)
+            )
+
+    def __contains__(self, ip: str) -> bool:
+        """True if ``ip`` (a string) falls inside any range."""
+        if self._exact is not None:
+            return ip in self._exact
+        parsed = _parse_ip(ip)
+        if parsed is None:
+            return False
+        version, value = parsed
+        starts = self._starts.get(version)
+        if not starts:
+            return False
+        index = bisect.bisect_right(starts, value) - 1
+        return index >= 0 and value <= self._ends[version][index]
+
+    def hosts(self, limit: int = POOL_LIMIT) -> List[str]:
+        """
+        Addresses usable as a sampling pool, in spec order.
+
+        CIDR blocks contribute their usable hosts (no network/broadcast address),
+        explicit ranges every address. At most ``limit`` addresses are returned.
+        """
+        pool = []
+        for version, first, last, is_cidr in self._ranges:
+            if is_cidr and last - first >= 2:
+                first, last = first + 1, last - 1
+            for value in range(first, min(last, first + limit - len(pool) - 1) + 1):
+                pool.append(_format(version, value))
+            if len(pool) >= limit:
+                break
+        return pool
+
+
+@lru_cache(maxsize=65_536)
+def _parse_ip(ip: str) -> Optional[Tuple[int, int]]:
+    """Parse an address string to (version, integer), or None if invalid."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    return address.version, int(address)
+
+
+class IPClassifier:
+    """Classify addresses as internal, external or known-malicious."""
+
+    def __init__(self, internal: str, external: str, malicious: str):
+        """Build the classifier from range specs for each category."""
+        self.internal = AddressSet(internal)
+        self.external = AddressSet(external)
+        self.malicious = AddressSet(malicious)
+
+    @classmethod
+    def from_env(cls) -> "IPClassifier":
+        """Build the classifier from INTERNAL/EXTERNAL/MALICIOUS_NETWORKS."""
+        return cls(
+            os.getenv("INTERNAL_NETWORKS", DEFAULT_INTERNAL_NETWORKS),
+            os.getenv("EXTERNAL_NETWORKS", DEFAULT_EXTERNAL_NETWORKS),
+            os.getenv("MALICIOUS_NETWORKS", DEFAULT_MALICIOUS_NETWORKS),
+        )
+
+    def is_internal(self, ip: str) -> bool:
+        """True for addresses inside the organisation's networks."""
+        return ip in self.internal
+
+    def is_external(self, ip: str) -> bool:
+        """True for configured external addresses that are not internal."""
+        return ip in self.external and ip not in self.internal
+
+    def is_malicious(self, ip: str) -> bool:
+        """True for addresses in known-malicious ranges."""
+        return ip in self.malicious
+
+    def is_suspicious(self, ip: str) -> bool:
+        """Login source suspicion: external or known-malicious."""
+        return self.is_malicious(ip) or self.is_external(ip)
+
+
+@lru_cache(maxsize=1)
+def default_classifier() -> IPClassifier:
+    """Process-wide classifier configured from the environment."""
+    return IPClassifier.from_env()
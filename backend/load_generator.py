@@ -0,0 +1,308 @@
+"""High-volume, vectorized load generation for benchmarks.
+
+LoadGenerator reproduces the statistical patterns of DataGenerator (failure
+rate, night-time share, lateral movement, connection spikes, periodic
+brute-force bursts and port scans) for millions of events, sampling whole
+columns with numpy instead of building one ORM object per event.
+
+Events are emitted as columnar batches (one numpy array per table column).
+Behavioural flags (bursts, port scans, connection spikes) are sampled at
+DataGenerator's rates rather than set by backend.detection, which works on
+ORM objects, so loaded events carry no correlated incidents or heavy hitters.
+
+With --insert, every batch is added to the dispatch outbox in the transaction
+that inserts it, so a running backend (or ``python -m backend.outbox drain``)
+dispatches the loaded events; --no-outbox measures the inserts alone.
+
+Usage:
+    python -m backend.load_generator --logins 1000000 --firewall 2000000 --hours 24 --output /tmp/load
+    python -m backend.load_generator --logins 1000000 --firewall 0 --insert
+"""
+import argparse
+import csv
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from . import outbox
+from .data_generator import DataGenerator
+from .database import SessionLocal, init_db
+from .ingest import ColumnBatch, insert_batch, timestamp_strings
+from .reputation import default_reputation
+from .timeutils import SITE_TIMEZONE, utcnow
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100_000
+
+LOGIN_COLUMNS = [
+    "username", "src_ip", "status", "timestamp", "local_hour", "device_id",
+    "auth_method", "is_burst_failure", "is_suspicious_ip", "is_admin", "is_credential_stuffing",
+]
+FIREWALL_COLUMNS = [
+    "src_ip", "dst_ip", "action", "port", "protocol", "timestamp",
+    "is_port_scan", "is_lateral_movement", "is_malicious_range", "is_connection_spike",
+]
+
+
+class LoadGenerator:
+    """Generate production-scale event streams with DataGenerator's patterns."""
+
+    def __init__(self, seed: Optional[int] = None, patterns=DataGenerator):
+        """
+        Args:
+            seed: Seed for numpy's random generator (None for fresh entropy).
+            patterns: Class providing the data pools and rates (DataGenerator).
+        """
+        self.rng = np.random.default_rng(seed)
+        self.p = patterns
+
+        # Pools as arrays so sampling is a single vectorized index operation
+        self.usernames = np.array(patterns.USERNAMES, dtype=object)
+        self.is_admin_user = np.isin(self.usernames, list(patterns.ADMIN_USERS))
+        self.source_ips = np.array(patterns.SOURCE_IPS, dtype=object)
+        # Classify each pool address once; per-event flags are then index lookups
+        classifier = patterns.CLASSIFIER
+        self.source_is_internal = np.array([classifier.is_internal(ip) for ip in patterns.SOURCE_IPS])
+        self.source_is_suspicious = np.array([classifier.is_suspicious(ip) for ip in patterns.SOURCE_IPS])
+        reputation = default_reputation()
+        self.source_is_malicious = np.array([classifier.is_malicious(ip) or ip in reputation
+                                             for ip in patterns.SOURCE_IPS])
+        self.external_ips = np.array(patterns.EXTERNAL_IPS, dtype=object)
+        self.internal_ips = np.array(patterns.INTERNAL_IPS, dtype=object)
+        self.device_ids = np.array(patterns.DEVICE_IDS, dtype=object)
+        self.auth_methods = np.array(patterns.AUTH_METHODS, dtype=object)
+        self.protocols = np.array(patterns.PROTOCOLS, dtype=object)
+        self.ports = np.array(patterns.FIREWALL_PORTS)
+        self.lateral_ports = np.array(sorted(patterns.LATERAL_MOVEMENT_PORTS))
+
+    def _timestamps(self, n: int, start: datetime, end: datetime) -> np.ndarray:
+        """Uniform timestamps in [start, end) as UTC epoch microseconds."""
+        lo = int(start.timestamp() * 1_000_000)
+        hi = int(end.timestamp() * 1_000_000)
+        return self.rng.integers(lo, max(hi, lo + 1), size=n)
+
+    def _injections(self, start: datetime, end: datetime, interval_hours: int) -> np.ndarray:
+        """Epoch-microsecond times of periodic attack injections, one per interval in [start, end)."""
+        interval = interval_hours * 3600 * 1_000_000
+        lo = int(start.timestamp() * 1_000_000)
+        hi = int(end.timestamp() * 1_000_000)
+        count = (hi - lo) // interval
+        return lo + np.arange(count) * interval + self.rng.integers(0, interval, size=count)
+
+    @staticmethod
+    def _within(times: np.ndarray, t0: datetime, t1: datetime) -> np.ndarray:
+        """Injection times falling in the batch slice [t0, t1)."""
+        lo = int(t0.timestamp() * 1_000_000)
+        hi = int(t1.timestamp() * 1_000_000)
+        return times[(times >= lo) & (times < hi)]
+
+    @staticmethod
+    def _slices(total: int, start: datetime, end: datetime, batch_size: int):
+        """Split the time range into consecutive slices, one per batch."""
+        batches = max(1, -(-total // batch_size))
+        span = (end - start) / batches
+        for i in range(batches):
+            n = min(batch_size, total - i * batch_size)
+            yield n, start + span * i, start + span * (i + 1)
+
+    def login_batches(
+        self,
+        total: int,
+        start: datetime,
+        end: datetime,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> Iterator[ColumnBatch]:
+        """Yield login events covering [start, end), oldest slice first."""
+        p = self.p
+        # Fixed site offset for the run; DST shifts within a run move night hours by at most 1h
+        offset_us = int(start.astimezone(SITE_TIMEZONE).utcoffset().total_seconds() * 1_000_000)
+        day_us = 86400 * 1_000_000
+        all_bursts = self._injections(start, end, p.BRUTE_FORCE_INTERVAL_HOURS)
+
+        for n, t0, t1 in self._slices(total, start, end, batch_size):
+            rng = self.rng
+            user_idx = rng.integers(0, len(self.usernames), size=n)
+            src_idx = rng.integers(0, len(self.source_ips), size=n)
+
+            ts = self._timestamps(n, t0, t1)
+            # Night logins: move the time of day into 00:00-05:59 site time
+            night = rng.random(n) < p.NIGHT_LOGIN_RATE
+            local = ts + offset_us
+            local[night] = (local[night] // day_us) * day_us + rng.integers(0, 6 * 3600 * 1_000_000, size=night.sum())
+            ts = local - offset_us
+
+            failed = rng.random(n) < p.LOGIN_FAILURE_RATE
+            columns = {
+                "username": self.usernames[user_idx],
+                "src_ip": self.source_ips[src_idx],
+                "status": np.where(failed, "FAIL", "SUCCESS").astype(object),
+                "timestamp": ts,
+                "local_hour": ((local % day_us) // (3600 * 1_000_000)).astype(np.int16),
+                "device_id": self.device_ids[rng.integers(0, len(self.device_ids), size=n)],
+                "auth_method": self.auth_methods[rng.integers(0, len(self.auth_methods), size=n)],
+                "is_burst_failure": np.zeros(n, dtype=bool),
+                "is_suspicious_ip": self.source_is_suspicious[src_idx],
+                "is_admin": self.is_admin_user[user_idx],
+                "is_credential_stuffing": np.zeros(n, dtype=bool),
+            }
+
+            # Periodic brute-force bursts: repeated failures for one user/IP within 10 minutes
+            bursts = self._within(all_bursts, t0, t1)
+            if len(bursts):
+                k = p.BRUTE_FORCE_ATTEMPTS
+                burst_users = self.rng.integers(0, len(self.usernames), size=len(bursts)).repeat(k)
+                extra = {
+                    "username": self.usernames[burst_users],
+                    "src_ip": self.external_ips[self.rng.integers(0, len(self.external_ips), size=len(bursts))].repeat(k),
+                    "status": np.full(len(bursts) * k, "FAIL", dtype=object),
+                    "timestamp": bursts.repeat(k) + self.rng.integers(0, 600 * 1_000_000, size=len(bursts) * k),
+                    "device_id": self.device_ids[self.rng.integers(0, len(self.device_ids), size=len(bursts))].repeat(k),
+                    "auth_method": np.full(len(bursts) * k, "password", dtype=object),
+                    "is_burst_failure": np.ones(len(bursts) * k, dtype=bool),
+                    "is_suspicious_ip": np.ones(len(bursts) * k, dtype=bool),
+                    "is_admin": self.is_admin_user[burst_users],
+                    "is_credential_stuffing": np.zeros(len(bursts) * k, dtype=bool),
+                }
+                extra["local_hour"] = (((extra["timestamp"] + offset_us) % day_us) // (3600 * 1_000_000)).astype(np.int16)
+                columns = {name: np.concatenate([columns[name], extra[name]]) for name in LOGIN_COLUMNS}
+
+            yield ColumnBatch("login", {name: columns[name] for name in LOGIN_COLUMNS})
+
+    def firewall_batches(
+        self,
+        total: int,
+        start: datetime,
+        end: datetime,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> Iterator[ColumnBatch]:
+        """Yield firewall events covering [start, end), oldest slice first."""
+        p = self.p
+        all_scans = self._injections(start, end, p.PORT_SCAN_INTERVAL_HOURS)
+
+        for n, t0, t1 in self._slices(total, start, end, batch_size):
+            rng = self.rng
+            src_idx = rng.integers(0, len(self.source_ips), size=n)
+            ports = self.ports[rng.integers(0, len(self.ports), size=n)]
+            allow = rng.random(n) < p.FIREWALL_ALLOW_RATE
+
+            # Lateral movement: internal source (destinations are always internal) on admin ports
+            lateral = (
+                self.source_is_internal[src_idx]
+                & np.isin(ports, self.lateral_ports)
+                & (rng.random(n) < p.LATERAL_MOVEMENT_RATE)
+            )
+            spike = (rng.random(n) < p.CONNECTION_SPIKE_RATE) | (~allow & (rng.random(n) < p.DENY_SPIKE_RATE))
+
+            columns = {
+                "src_ip": self.source_ips[src_idx],
+                "dst_ip": self.internal_ips[rng.integers(0, len(self.internal_ips), size=n)],
+                "action": np.where(allow, "ALLOW", "DENY").astype(object),
+                "port": ports,
+                "protocol": self.protocols[rng.integers(0, len(self.protocols), size=n)],
+                "timestamp": self._timestamps(n, t0, t1),
+                "is_port_scan": np.zeros(n, dtype=bool),
+                "is_lateral_movement": lateral,
+                "is_malicious_range": self.source_is_malicious[src_idx],
+                "is_connection_spike": spike,
+            }
+
+            # Periodic port scans: one external source probing consecutive ports of one host
+            scans = self._within(all_scans, t0, t1)
+            if len(scans):
+                k = len(p.PORT_SCAN_PORTS)
+                m = len(scans) * k
+                extra = {
+                    "src_ip": self.external_ips[self.rng.integers(0, len(self.external_ips), size=len(scans))].repeat(k),
+                    "dst_ip": self.internal_ips[self.rng.integers(0, len(self.internal_ips), size=len(scans))].repeat(k),
+                    "action": np.full(m, "DENY", dtype=object),
+                    "port": np.tile(np.array(p.PORT_SCAN_PORTS), len(scans)),
+                    "protocol": np.full(m, "TCP", dtype=object),
+                    "timestamp": scans.repeat(k) + self.rng.integers(0, 300 * 1_000_000, size=m),
+                    "is_port_scan": np.ones(m, dtype=bool),
+                    "is_lateral_movement": np.zeros(m, dtype=bool),
+                    "is_malicious_range": np.zeros(m, dtype=bool),
+                    "is_connection_spike": np.ones(m, dtype=bool),
+                }
+                columns = {name: np.concatenate([columns[name], extra[name]]) for name in FIREWALL_COLUMNS}
+
+            yield ColumnBatch("firewall", columns)
+
+
+def write_csv(batches: Iterator[ColumnBatch], path: str, columns: List[str]) -> int:
+    """Write batches to a CSV file in the model_analysis export format; returns row count."""
+    written = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id"] + columns)
+        for batch in batches:
+            values = []
+            for name in columns:
+                column = batch.columns[name]
+                if name == "timestamp":
+                    column = timestamp_strings(column)
+                elif column.dtype == bool:
+                    column = np.where(column, "t", "f")
+                values.append(column.tolist())
+            ids = range(written + 1, written + len(batch) + 1)
+            writer.writerows(zip(ids, *values))
+            written += len(batch)
+    return written
+
+
+def main():
+    """Generate a load-test dataset and report throughput."""
+    parser = argparse.ArgumentParser(description="Generate high-volume synthetic security events")
+    parser.add_argument("--logins", type=int, default=1_000_000, help="Login events to generate")
+    parser.add_argument("--firewall", type=int, default=1_000_000, help="Firewall events to generate")
+    parser.add_argument("--hours", type=float, default=24, help="Time span covered, ending now")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--output", help="Directory for login_events.csv / firewall_logs.csv")
+    parser.add_argument("--insert", action="store_true", help="Bulk insert into the database (COPY)")
+    parser.add_argument("--no-outbox", action="store_true",
+                        help="With --insert, do not add the events to the dispatch outbox")
+    args = parser.parse_args()
+
+    if args.insert:
+        init_db()
+
+    generator = LoadGenerator(seed=args.seed)
+    end = utcnow()
+    start = end - timedelta(hours=args.hours)
+
+    for name, total, batches, columns in [
+        ("login_events", args.logins, generator.login_batches, LOGIN_COLUMNS),
+        ("firewall_logs", args.firewall, generator.firewall_batches, FIREWALL_COLUMNS),
+    ]:
+        started = time.perf_counter()
+        stream = batches(total, start, end, args.batch_size)
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+            count = write_csv(stream, os.path.join(args.output, f"{name}.csv"), columns)
+        elif args.insert:
+            count = 0
+            db = SessionLocal()
+            try:
+                for batch in stream:
+                    ids = insert_batch(db, batch)
+                    if not args.no_outbox:
+                        # Claimable at once: nothing else dispatches these events
+                        outbox.enqueue_keys(db, [(batch.event_type, int(event_id)) for event_id in ids], delay=0)
+                    db.commit()
+                    count += len(ids)
+            finally:
+                db.close()
+        else:
+            count = sum(len(batch) for batch in stream)
+        elapsed = time.perf_counter() - started
+        logger.info(f"{name}: {count} events in {elapsed:.2f}s ({count / max(elapsed, 1e-9):,.0f} events/s)")
+
+
+if __name__ == "__main__":
+    main()
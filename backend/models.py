@@ -1,7 +1,9 @@
 """Database models for cybersecurity events."""
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Date, Text
+from sqlalchemy import Column, Integer, SmallInteger, String, DateTime, Boolean, Date, Float, Text, UniqueConstraint
+from sqlalchemy.orm import validates
 from datetime import datetime
 from .database import Base
+from .timeutils import utcnow, to_utc, site_hour
 
 
 class LoginEvent(Base):
@@ -12,12 +14,21 @@ class LoginEvent(Base):
     username = Column(String(255), nullable=False)
     src_ip = Column(String(45), nullable=False)
     status = Column(String(20), nullable=False)  # SUCCESS or FAIL
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    local_hour = Column(SmallInteger, nullable=True)  # Hour of day in SITE_TIMEZONE
     device_id = Column(String(255), nullable=False)
     auth_method = Column(String(50), nullable=False)
     is_burst_failure = Column(Boolean, default=False)
     is_suspicious_ip = Column(Boolean, default=False)
     is_admin = Column(Boolean, default=False)
+    is_credential_stuffing = Column(Boolean, default=False)  # Many accounts failing from this source IP
+
+    @validates("timestamp")
+    def _normalize_timestamp(self, key, value):
+        """Store timestamps as UTC and precompute the site-local hour once."""
+        value = to_utc(value)
+        self.local_hour = site_hour(value)
+        return value
 
 
 class FirewallLog(Base):
@@ -30,12 +41,17 @@ class FirewallLog(Base):
     action = Column(String(20), nullable=False)  # ALLOW or DENY
     port = Column(Integer, nullable=False)
     protocol = Column(String(20), nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     is_port_scan = Column(Boolean, default=False)
     is_lateral_movement = Column(Boolean, default=False)
     is_malicious_range = Column(Boolean, default=False)
     is_connection_spike = Column(Boolean, default=False)
 
+    @validates("timestamp")
+    def _normalize_timestamp(self, key, value):
+        """Store timestamps as UTC."""
+        return to_utc(value)
+
 
 class PatchLevel(Base):
     """Patch level tracking model."""
@@ -55,6 +71,7 @@ class PatchLevel(Base):
 class EventAnalysis(Base):
     """Store AI analysis results."""
     __tablename__ = "event_analyses"
+    __table_args__ = (UniqueConstraint("event_type", "event_id"),)  # One analysis per event, however often it is dispatched
 
     id = Column(Integer, primary_key=True, index=True)
     event_type = Column(String(50), nullable=False)
@@ -63,7 +80,7 @@ class EventAnalysis(Base):
     severity = Column(String(20), nullable=False)
     reasoning = Column(Text, nullable=False)
     recommended_action = Column(Text, nullable=False)
-    analyzed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    analyzed_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
 
 
 class AnalystFeedback(Base):
@@ -99,3 +116,102 @@ class WhitelistedUser(Base):
     reason = Column(Text, nullable=True)
     added_by = Column(String(100), default="analyst", nullable=False)
     added_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class DispatchOutbox(Base):
+    """Events awaiting analysis; a row is deleted when its EventAnalysis is stored."""
+    __tablename__ = "dispatch_outbox"
+    __table_args__ = (UniqueConstraint("event_type", "event_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_type = Column(String(50), nullable=False)
+    event_id = Column(Integer, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)  # Times claimed by the recovery worker
+    available_at = Column(DateTime(timezone=True), nullable=False, index=True)  # Claimable from this time
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    last_error = Column(Text, nullable=True)  # Most recent dispatch failure
+
+
+class HeavyHitter(Base):
+    """Busiest firewall sources in the current detection window (rewritten on each ingest)."""
+    __tablename__ = "heavy_hitters"
+
+    id = Column(Integer, primary_key=True, index=True)
+    rank = Column(Integer, nullable=False)
+    src_ip = Column(String(45), unique=True, nullable=False)
+    connections = Column(Integer, nullable=False)  # Estimated, within the window
+    denies = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class CorrelatedIncident(Base):
+    """Multi-source incident: reconnaissance from an IP followed by failed logins from it on one device."""
+    __tablename__ = "correlated_incidents"
+
+    id = Column(Integer, primary_key=True, index=True)
+    src_ip = Column(String(45), nullable=False, index=True)
+    device_id = Column(String(255), nullable=False)
+    severity = Column(String(20), nullable=False)
+    summary = Column(Text, nullable=False)
+    firewall_events = Column(Integer, default=0, nullable=False)  # Scan/malicious-range events matched
+    failed_logins = Column(Integer, default=0, nullable=False)
+    accounts = Column(Integer, default=0, nullable=False)  # Distinct accounts that failed
+    admin_targeted = Column(Boolean, default=False)
+    unpatched_device = Column(Boolean, default=False)  # Missing critical patches or unsupported OS
+    login_succeeded = Column(Boolean, default=False)  # A later login from the IP on the device succeeded
+    evidence = Column(Text, nullable=False)  # JSON: sample firewall and login event ids
+    first_seen = Column(DateTime(timezone=True), nullable=False)
+    last_seen = Column(DateTime(timezone=True), nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class EntityRisk(Base):
+    """Rolling risk of a user, IP or device: event risk scores summed with exponential decay, plus patch risk."""
+    __tablename__ = "entity_risk"
+    __table_args__ = (UniqueConstraint("entity_type", "entity_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String(20), nullable=False)  # user, ip or device
+    entity_id = Column(String(255), nullable=False)
+    score = Column(Float, nullable=False)  # Decayed event risk as of updated_epoch
+    peak_risk = Column(Integer, nullable=False)  # Highest single risk score seen
+    events = Column(Integer, default=0, nullable=False)  # Event analyses counted (patch analyses are not)
+    patch_score = Column(Float, nullable=True)  # Devices: risk score of the latest patch analysis, not decayed
+    patch_epoch = Column(Float, nullable=True)  # When that patch analysis was made, as epoch seconds
+    last_event_type = Column(String(50), nullable=False)
+    last_event_id = Column(Integer, nullable=False)
+    last_severity = Column(String(20), nullable=False)
+    unpatched = Column(Boolean, nullable=True)  # Devices: missing critical patches or unsupported OS
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    updated_epoch = Column(Float, nullable=False)  # updated_at as epoch seconds, for decay in SQL
+
+
+class DispatchStatus(Base):
+    """Agent concurrency limit of one backend replica, refreshed while it runs."""
+    __tablename__ = "dispatch_status"
+
+    id = Column(Integer, primary_key=True, index=True)
+    replica = Column(String(255), unique=True, nullable=False)  # Host name of the backend container
+    concurrency_limit = Column(Integer, nullable=False)  # Requests currently allowed in flight
+    min_limit = Column(Integer, nullable=False)
+    max_limit = Column(Integer, nullable=False)
+    in_flight = Column(Integer, nullable=False)
+    baseline_latency_ms = Column(Float, nullable=True)  # Lowest recent agent latency
+    smoothed_latency_ms = Column(Float, nullable=True)
+    completed = Column(Integer, nullable=False)  # Requests finished since the replica started
+    errors = Column(Integer, nullable=False)  # Timeouts and overload errors among them
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class DeadLetterEvent(Base):
+    """Event that could not be scored; kept for inspection and re-drive."""
+    __tablename__ = "dead_letter_events"
+    __table_args__ = (UniqueConstraint("event_type", "event_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_type = Column(String(50), nullable=False)
+    event_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)  # JSON payload sent to the agent
+    error = Column(Text, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)  # Dispatch attempts before giving up
+    failed_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
@@ -0,0 +1,212 @@
+"""Durable dispatch outbox for at-least-once scoring.
+
+Every ingested event gets a dispatch_outbox row in the same transaction as
+the event itself. The row is deleted (acknowledged) in the same transaction
+that stores the event's EventAnalysis, so an event either has an analysis
+or is still in the outbox, whatever crashes in between.
+
+Rows become claimable only after a visibility timeout. The fast path (the
+dispatch that follows ingest right away) owns each event first. Events it
+does not finish, because the backend died or the agent failed, are claimed
+later by the recovery worker with SELECT ... FOR UPDATE SKIP LOCKED, so
+several backend processes can drain the outbox without claiming the same
+row twice. Each claim pushes the row's visibility out again; a claimer that
+dies simply lets the row become claimable once more. An event claimed more
+than OUTBOX_MAX_ATTEMPTS times is moved to the dead-letter table
+(backend.deadletter) instead of being dispatched again.
+
+Usage:
+    python -m backend.outbox status
+    python -m backend.outbox drain
+    python -m backend.outbox backfill   # Enqueue stored events that have no analysis
+"""
+import argparse
+import logging
+import os
+from datetime import timedelta
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import and_, delete, exists, func, literal, select, tuple_, update
+from sqlalchemy.orm import Session
+
+from .models import LoginEvent, FirewallLog, PatchLevel, EventAnalysis, DispatchOutbox
+from .ingest import dialect_insert
+from .timeutils import utcnow
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VISIBILITY_TIMEOUT = int(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", "120"))  # Seconds before an unacknowledged event is retried
+CLAIM_BATCH_SIZE = int(os.getenv("OUTBOX_CLAIM_BATCH_SIZE", "100"))  # Events claimed per round trip
+# Dispatch only through the outbox: events are claimable at once and every replica
+# drains them, instead of the ingesting process dispatching its own events first
+DISPATCH_VIA_OUTBOX = os.getenv("DISPATCH_VIA_OUTBOX", "false").lower() == "true"
+ENQUEUE_DELAY = 0 if DISPATCH_VIA_OUTBOX else VISIBILITY_TIMEOUT
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))  # Claims before an event is dead-lettered
+
+OUTBOX_MODELS = {"login": LoginEvent, "firewall": FirewallLog, "patch": PatchLevel}
+EVENT_TYPES = {model: event_type for event_type, model in OUTBOX_MODELS.items()}
+
+
+def enqueue(db: Session, events: List[Any], delay: int = ENQUEUE_DELAY) -> None:
+    """
+    Add inserted events (ids set) to the outbox, in the caller's transaction.
+
+    The rows become claimable after ``delay`` seconds, leaving the first
+    attempt to the caller's own dispatch (immediately with DISPATCH_VIA_OUTBOX).
+    Events already pending are left as they are.
+    """
+    enqueue_keys(db, [(EVENT_TYPES[type(event)], event.id) for event in events], delay)
+
+
+def enqueue_keys(db: Session, keys: Iterable[Tuple[str, int]], delay: int = ENQUEUE_DELAY) -> None:
+    """Add (event_type, event_id) pairs to the outbox, in the caller's transaction."""
+    available_at = utcnow() + timedelta(seconds=delay)
+    rows = [{"event_type": event_type, "event_id": event_id, "attempts": 0, "available_at": available_at}
+            for event_type, event_id in keys]
+    if rows:
+        db.execute(dialect_insert(db, DispatchOutbox).on_conflict_do_nothing(
+            index_elements=["event_type", "event_id"]), rows)
+
+
+def ack(db: Session, keys: Iterable[Tuple[str, int]]) -> None:
+    """Remove analyzed (event_type, event_id) pairs; call in the transaction that stores their analyses."""
+    keys = list(keys)
+    if keys:
+        db.execute(delete(DispatchOutbox).where(
+            tuple_(DispatchOutbox.event_type, DispatchOutbox.event_id).in_(keys)))
+
+
+def note_failure(db: Session, key: Tuple[str, int], error: str) -> None:
+    """Remember why an event's latest dispatch failed (kept for the dead-letter table)."""
+    event_type, event_id = key
+    db.execute(update(DispatchOutbox)
+               .where(DispatchOutbox.event_type == event_type, DispatchOutbox.event_id == event_id)
+               .values(last_error=error))
+
+
+def claim(db: Session, limit: int = CLAIM_BATCH_SIZE, timeout: int = VISIBILITY_TIMEOUT) -> List[Tuple[str, int, int]]:
+    """
+    Claim up to ``limit`` due events and commit.
+
+    Claimed rows stay invisible to other claimers for ``timeout`` seconds.
+    Returns (event_type, event_id, attempts).
+    """
+    now = utcnow()
+    due = (select(DispatchOutbox.id)
+           .where(DispatchOutbox.available_at <= now)
+           .order_by(DispatchOutbox.available_at)
+           .limit(limit)
+           .with_for_update(skip_locked=True))
+    claimed = db.execute(
+        update(DispatchOutbox)
+        .where(DispatchOutbox.id.in_(due))
+        .values(available_at=now + timedelta(seconds=timeout), attempts=DispatchOutbox.attempts + 1)
+        .returning(DispatchOutbox.event_type, DispatchOutbox.event_id, DispatchOutbox.attempts)
+    ).all()
+    db.commit()
+    return [tuple(row) for row in claimed]
+
+
+def load_claimed(db: Session, claimed: List[Tuple[str, int, int]]) -> List[Any]:
+    """Load the claimed events; rows whose event no longer exists are dropped from the outbox."""
+    events = []
+    missing = []
+    for event_type, model in OUTBOX_MODELS.items():
+        ids = {event_id for t, event_id, _ in claimed if t == event_type}
+        if not ids:
+            continue
+        found = db.query(model).filter(model.id.in_(ids)).all()
+        events.extend(found)
+        missing.extend((event_type, event_id) for event_id in ids - {event.id for event in found})
+    if missing:
+        ack(db, missing)
+        db.commit()
+        logger.warning(f"Dropped {len(missing)} outbox entries for deleted events")
+    return events
+
+
+def drain(db: Session, dispatch: Callable[[List[Any]], Any], max_batches: int = 0) -> int:
+    """
+    Claim and dispatch due events until none are left (or ``max_batches`` is reached).
+
+    ``dispatch`` receives each claimed batch of events and must ack the ones it
+    analyzes (EventDispatcher and EventStream do). Events claimed more than
+    MAX_ATTEMPTS times are dead-lettered instead. Returns the number of events claimed.
+    """
+    from .deadletter import bury_exhausted  # deadletter builds on this module
+
+    total = 0
+    batches = 0
+    while not max_batches or batches < max_batches:
+        claimed = claim(db)
+        if not claimed:
+            break
+        exhausted = [entry for entry in claimed if entry[2] > MAX_ATTEMPTS]
+        if exhausted:
+            bury_exhausted(db, exhausted)
+            claimed = [entry for entry in claimed if entry[2] <= MAX_ATTEMPTS]
+        events = load_claimed(db, claimed)
+        retries = sum(1 for *_, attempts in claimed if attempts > 1)
+        logger.info(f"Claimed {len(claimed) + len(exhausted)} outbox events "
+                    f"({retries} retries, {len(exhausted)} dead-lettered)")
+        if events:
+            dispatch(events)
+        total += len(claimed) + len(exhausted)
+        batches += 1
+    return total
+
+
+def status(db: Session) -> Dict[str, int]:
+    """Outbox size, due entries and entries already retried."""
+    now = utcnow()
+    pending, due, retried = db.execute(select(
+        func.count(),
+        func.count().filter(DispatchOutbox.available_at <= now),
+        func.count().filter(DispatchOutbox.attempts > 0),
+    ).select_from(DispatchOutbox)).one()
+    return {"pending": pending, "due": due, "retried": retried}
+
+
+def backfill(db: Session) -> int:
+    """Enqueue stored events that have neither an analysis nor an outbox entry (due immediately)."""
+    now = utcnow()
+    total = 0
+    for event_type, model in OUTBOX_MODELS.items():
+        unanalyzed = (
+            select(literal(event_type), model.id, literal(0), literal(now))
+            .where(~exists().where(and_(EventAnalysis.event_type == event_type, EventAnalysis.event_id == model.id)))
+            .where(~exists().where(and_(DispatchOutbox.event_type == event_type, DispatchOutbox.event_id == model.id)))
+        )
+        result = db.execute(dialect_insert(db, DispatchOutbox).from_select(
+            ["event_type", "event_id", "attempts", "available_at"], unanalyzed))
+        total += result.rowcount
+    db.commit()
+    return total
+
+
+def main() -> None:
+    """Inspect, drain or backfill the outbox."""
+    from .database import SessionLocal, init_db
+    from .event_dispatcher import EventDispatcher
+
+    parser = argparse.ArgumentParser(description="Dispatch outbox maintenance")
+    parser.add_argument("command", choices=["status", "drain", "backfill"])
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.command == "status":
+            logger.info(f"Outbox: {status(db)}")
+        elif args.command == "drain":
+            dispatcher = EventDispatcher(db)
+            logger.info(f"Drained {drain(db, dispatcher.dispatch_events_parallel)} outbox events")
+        else:
+            logger.info(f"Enqueued {backfill(db)} unanalyzed events")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
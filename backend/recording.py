@@ -0,0 +1,175 @@
+"""Record generation runs to JSON Lines files and load them back.
+
+Each line is one generated event:
+
+    {"generated_at": "...", "type": "login", "event": {...column values...}}
+
+Ids are not recorded; they are assigned again when a recording is replayed.
+With a fixed seed and a SimulatedClock, DataGenerator writes byte-identical
+recordings for the same time range and starting database.
+
+Usage:
+    python -m backend.recording record --seed 42 --start 2024-01-01T00:00:00 --cycles 48 --output run.jsonl
+    python -m backend.recording replay run.jsonl
+"""
+import argparse
+import itertools
+import json
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import Date, DateTime
+from sqlalchemy.orm import Session
+
+from .models import LoginEvent, FirewallLog, PatchLevel
+from .ingest import insert_events, upsert_rows
+from .detection import Detectors
+from . import outbox
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RECORD_MODELS = {"login": LoginEvent, "firewall": FirewallLog, "patch": PatchLevel}
+EVENT_TYPES = {model: event_type for event_type, model in RECORD_MODELS.items()}
+
+
+def serialize_event(event: Any) -> Dict[str, Any]:
+    """Column values of an event (without id) as JSON-compatible values."""
+    values = {}
+    for column in type(event).__table__.columns:
+        if column.primary_key:
+            continue
+        value = getattr(event, column.name)
+        if isinstance(value, (datetime, date)):
+            value = value.isoformat()
+        values[column.name] = value
+    return values
+
+
+def deserialize_event(event_type: str, values: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert recorded values back to column types (row dict, no id)."""
+    columns = RECORD_MODELS[event_type].__table__.columns
+    row = {}
+    for name, value in values.items():
+        if value is not None and isinstance(columns[name].type, DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and isinstance(columns[name].type, Date):
+            value = date.fromisoformat(value)
+        row[name] = value
+    return row
+
+
+class RunRecorder:
+    """Append generated events to a JSON Lines file."""
+
+    def __init__(self, path: str):
+        """Open ``path`` for appending."""
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()  # Event types are generated concurrently
+
+    def record(self, generated_at: datetime, events: List[Any]) -> None:
+        """Write one generation step's events."""
+        stamp = generated_at.isoformat()
+        lines = [json.dumps({"generated_at": stamp, "type": EVENT_TYPES[type(event)], "event": serialize_event(event)})
+                 for event in events]
+        with self._lock:
+            self._file.writelines(line + "\n" for line in lines)
+            self._file.flush()
+
+    def close(self) -> None:
+        """Close the file."""
+        self._file.close()
+
+
+def read_recording(path: str) -> Iterator[Tuple[datetime, str, Dict[str, Any]]]:
+    """Yield (generated_at, event_type, row) from a recording, in file order."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield (datetime.fromisoformat(record["generated_at"]), record["type"],
+                   deserialize_event(record["type"], record["event"]))
+
+
+def replay_recording(db: Session, path: str) -> Iterator[Tuple[datetime, str, List[Any]]]:
+    """
+    Write a recording back to the database one generation step at a time.
+
+    Yields (generated_at, event_type, events) after each step is committed, with
+    event ids assigned, ready for dispatch.
+    """
+    detectors = Detectors()
+    steps = itertools.groupby(read_recording(path), key=lambda record: (record[0], record[1]))
+    for (generated_at, event_type), records in steps:
+        rows = [row for _, _, row in records]
+        model = RECORD_MODELS[event_type]
+        if model is PatchLevel:
+            events = upsert_rows(db, model, rows, key="device_id")
+        else:
+            events = [model(**row) for row in rows]
+            detectors.inspect(events)
+            insert_events(db, events)
+        outbox.enqueue(db, events)
+        db.commit()
+        detectors.correlate(events)
+        detectors.save(db)
+        yield generated_at, event_type, events
+
+
+def main() -> None:
+    """Record a seeded run, or replay a recording through the dispatcher."""
+    from .database import SessionLocal, init_db
+    from .data_generator import DataGenerator
+    from .event_dispatcher import EventDispatcher
+    from .timeutils import SimulatedClock
+
+    parser = argparse.ArgumentParser(description="Record and replay generation runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="Generate a seeded run into the database and record it")
+    record.add_argument("--seed", required=True, help="Generator seed")
+    record.add_argument("--start", type=datetime.fromisoformat, required=True,
+                        help="Simulated start time (ISO 8601; naive is site-local)")
+    record.add_argument("--cycles", type=int, default=1, help="Generation cycles to run")
+    record.add_argument("--interval-minutes", type=int, default=30, help="Simulated time between cycles")
+    record.add_argument("--output", required=True, help="Recording file (JSON Lines, appended)")
+
+    replay = commands.add_parser("replay", help="Insert a recording and dispatch it to the agent")
+    replay.add_argument("path", help="Recording file")
+    replay.add_argument("--no-dispatch", action="store_true", help="Only insert, do not dispatch")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.command == "record":
+            clock = SimulatedClock(args.start)
+            recorder = RunRecorder(args.output)
+            generator = DataGenerator(seed=args.seed, clock=clock, recorder=recorder)
+            try:
+                for _ in range(args.cycles):
+                    generator.generate_login_events(db)
+                    generator.generate_firewall_events(db)
+                    generator.generate_patch_levels(db)
+                    clock.advance(timedelta(minutes=args.interval_minutes))
+            finally:
+                recorder.close()
+            logger.info(f"Recorded {args.cycles} cycles to {args.output}")
+        else:
+            dispatcher = EventDispatcher(db)
+            for generated_at, event_type, events in replay_recording(db, args.path):
+                if args.no_dispatch:
+                    continue
+                successful = dispatcher.dispatch_events_parallel(events)
+                logger.info(f"Replayed {event_type} step from {generated_at.isoformat()}: "
+                            f"{successful}/{len(events)} dispatched")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Replay recorded events into the pipeline for soak testing.
+
+Sources are database exports in the model_analysis CSV format
+(login_events.csv, firewall_logs.csv, and patch_levels.csv if present) or
+JSON Lines recordings from backend.recording. Events from all sources are
+merged in timestamp order and replayed at their original pace, N times
+faster, or as fast as possible. Each event is inserted, then dispatched to
+the agent. The latency from insert commit to stored analysis is reported.
+
+Exports of the original timestamp columns have no offset; like the schema
+upgrade that made those columns timezone-aware, replay reads them as UTC
+(--source-tz names another zone).
+
+Usage:
+    python -m backend.replay model_analysis/login_events.csv model_analysis/firewall_logs.csv --speed 60
+    python -m backend.replay run.jsonl --max-speed --retime
+"""
+import argparse
+import csv
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone, tzinfo
+from typing import Any, Dict, Iterator, List, Tuple
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import Boolean, Date, DateTime, Integer, SmallInteger
+from sqlalchemy.orm import Session
+
+from .models import PatchLevel
+from .detection import Detectors
+from .event_dispatcher import EventDispatcher, MAX_WORKERS, dispatch_deadline
+from .ingest import insert_events, upsert_rows
+from . import outbox
+from .recording import RECORD_MODELS, read_recording
+from .timeutils import to_utc, utcnow
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500  # Most events inserted per step
+MAX_IN_FLIGHT = 2_000  # Dispatched events awaiting analysis before replay pauses
+
+# A column that identifies each export's event type
+CSV_SIGNATURES = {"username": "login", "dst_ip": "firewall", "missing_critical": "patch"}
+
+ReplayEvent = Tuple[datetime, str, Dict[str, Any]]  # (event time, event type, row)
+
+
+def _csv_value(column, value: str, source_tz: tzinfo = timezone.utc) -> Any:
+    """Convert one exported CSV value to the column's Python type (naive timestamps are in ``source_tz``)."""
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        return value.lower() in ("t", "true", "1")
+    if isinstance(column_type, (Integer, SmallInteger)):
+        return int(float(value))
+    if isinstance(column_type, DateTime):
+        parsed = datetime.fromisoformat(value)
+        return parsed.replace(tzinfo=source_tz) if parsed.tzinfo is None else parsed
+    if isinstance(column_type, Date):
+        return date.fromisoformat(value)
+    return value
+
+
+def _event_time(event_type: str, row: Dict[str, Any], fallback: datetime) -> datetime:
+    """Time an event happened, as aware UTC."""
+    value = row.get("timestamp") or row.get("updated_at") or fallback
+    return to_utc(value)
+
+
+def read_csv_events(path: str, source_tz: tzinfo = timezone.utc) -> Iterator[ReplayEvent]:
+    """Yield events from a database CSV export; the event type is detected from its header."""
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        event_type = next((t for name, t in CSV_SIGNATURES.items() if name in reader.fieldnames), None)
+        if event_type is None:
+            raise ValueError(f"{path}: not a login, firewall or patch export")
+        columns = RECORD_MODELS[event_type].__table__.columns
+        loaded_at = utcnow()
+        for record in reader:
+            # Exported ids are dropped (new ones are assigned); empty values fall back to defaults
+            row = {name: _csv_value(columns[name], value, source_tz) for name, value in record.items()
+                   if name in columns and name != "id" and value not in ("", None)}
+            yield _event_time(event_type, row, loaded_at), event_type, row
+
+
+def load_events(paths: List[str], source_tz: tzinfo = timezone.utc) -> List[ReplayEvent]:
+    """Read every source and merge the events in timestamp order (naive CSV timestamps in ``source_tz``)."""
+    events: List[ReplayEvent] = []
+    for path in paths:
+        if path.endswith(".jsonl"):
+            events.extend((_event_time(event_type, row, generated_at), event_type, row)
+                          for generated_at, event_type, row in read_recording(path))
+        else:
+            events.extend(read_csv_events(path, source_tz))
+        logger.info(f"Loaded {path}")
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+@dataclass
+class ReplayStats:
+    """Outcome and latency of a replay."""
+    dispatched: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    max_lag: float = 0.0  # Worst delay behind the replay schedule, in seconds
+    latencies: List[float] = field(default_factory=list)  # Insert commit to stored analysis, seconds
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, ok: bool, latency: float) -> None:
+        """Record one finished dispatch."""
+        with self.lock:
+            if ok:
+                self.succeeded += 1
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+
+    def percentile(self, q: float) -> float:
+        """Latency percentile (0-100) over successful events, in seconds."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def _insert_step(db: Session, step: List[ReplayEvent], detectors: Detectors) -> List[Any]:
+    """Run detection on one step's events, insert them (grouped per type), correlate and commit; returns them with ids."""
+    inserted = []
+    for event_type, model in RECORD_MODELS.items():
+        rows = [row for _, t, row in step if t == event_type]
+        if not rows:
+            continue
+        if model is PatchLevel:
+            inserted.extend(upsert_rows(db, model, rows, key="device_id"))
+        else:
+            events = [model(**row) for row in rows]
+            detectors.inspect(events)
+            insert_events(db, events)
+            inserted.extend(events)
+    outbox.enqueue(db, inserted)
+    db.commit()
+    detectors.correlate(inserted)
+    detectors.save(db)
+    return inserted
+
+
+def replay(
+    db: Session,
+    events: List[ReplayEvent],
+    speed: float = 1.0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    retime: bool = False,
+    dispatch: bool = True,
+) -> ReplayStats:
+    """
+    Replay events in order and wait until every dispatched event is analyzed.
+
+    Args:
+        events: Events sorted by time (see load_events).
+        speed: Pace relative to the original timing (1.0 = real time, 60 = an
+            hour per minute); 0 replays as fast as possible.
+        batch_size: Most events inserted per step.
+        retime: Shift timestamps so the replay appears to happen now.
+        dispatch: Send events to the agent (False only inserts them).
+    """
+    stats = ReplayStats()
+    if not events:
+        return stats
+
+    dispatcher = EventDispatcher(db)
+    detectors = Detectors()
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    first_time = events[0][0]
+    shift = utcnow() - first_time if retime else None
+    started = time.monotonic()
+
+    def finished(future, inserted_at: float) -> None:
+        in_flight.release()
+        try:
+            ok = "error" not in future.result()
+        except Exception:
+            ok = False
+        stats.record(ok, time.monotonic() - inserted_at)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        i = 0
+        while i < len(events):
+            j = min(len(events), i + batch_size)
+            if speed > 0:
+                # Wait for the next event's slot, then take everything else already due
+                due = started + (events[i][0] - first_time).total_seconds() / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                stats.max_lag = max(stats.max_lag, time.monotonic() - due)
+                elapsed = (time.monotonic() - started) * speed
+                k = i + 1
+                while k < j and (events[k][0] - first_time).total_seconds() <= elapsed:
+                    k += 1
+                j = k
+
+            step = events[i:j]
+            if shift is not None:
+                step = [(t, event_type, {**row, "timestamp": row["timestamp"] + shift}
+                         if "timestamp" in row else row) for t, event_type, row in step]
+            inserted = _insert_step(db, step, detectors)
+            inserted_at = time.monotonic()
+
+            if dispatch:
+                deadline = dispatch_deadline()  # Waits for in-flight slots and pool threads count against it
+                for event in inserted:
+                    in_flight.acquire()  # Backpressure when the agent falls behind
+                    future = executor.submit(dispatcher.dispatch_with_session, event, deadline)
+                    future.add_done_callback(lambda f, t=inserted_at: finished(f, t))
+                stats.dispatched += len(inserted)
+            i = j
+
+    return stats
+
+
+def main() -> None:
+    """Replay exports or recordings and report end-to-end latency."""
+    from .database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Replay recorded events into the pipeline")
+    parser.add_argument("paths", nargs="+", help="CSV exports and/or .jsonl recordings")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier (default: 1.0, real time)")
+    pace.add_argument("--max-speed", action="store_true", help="Replay as fast as possible")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Most events inserted per step")
+    parser.add_argument("--retime", action="store_true", help="Shift timestamps so the replay happens now")
+    parser.add_argument("--no-dispatch", action="store_true", help="Only insert, do not dispatch")
+    parser.add_argument("--source-tz", default="UTC",
+                        help="IANA timezone of CSV timestamps without an offset (default: UTC, as exported)")
+    args = parser.parse_args()
+
+    events = load_events(args.paths, ZoneInfo(args.source_tz))
+    span = (events[-1][0] - events[0][0]).total_seconds() if events else 0
+    speed = 0 if args.max_speed else args.speed
+    logger.info(f"Replaying {len(events)} events spanning {span / 3600:.1f}h "
+                f"at {'max speed' if speed == 0 else f'{speed:g}x'}")
+
+    init_db()
+    db = SessionLocal()
+    try:
+        started = time.monotonic()
+        stats = replay(db, events, speed=speed, batch_size=args.batch_size,
+                       retime=args.retime, dispatch=not args.no_dispatch)
+        elapsed = time.monotonic() - started
+    finally:
+        db.close()
+
+    logger.info(f"=== Replay finished in {elapsed:.1f}s: {len(events)} events "
+                f"({len(events) / max(elapsed, 1e-9):.0f}/s), "
+                f"{stats.succeeded}/{stats.dispatched} analyzed, {stats.failed} failed ===")
+    if stats.latencies:
+        logger.info(f"Insert-to-analysis latency: p50={stats.percentile(50) * 1000:.0f}ms "
+                    f"p95={stats.percentile(95) * 1000:.0f}ms p99={stats.percentile(99) * 1000:.0f}ms "
+                    f"max={max(stats.latencies) * 1000:.0f}ms")
+    if speed > 0:
+        logger.info(f"Max lag behind schedule: {stats.max_lag:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Threat-intelligence IP reputation from local blocklist feeds.
+
+Feeds are plain-text files in the usual blocklist formats, one entry per
+line: an IPv4 address, a CIDR block or a ``first - last`` range, with ``#``
+and ``;`` starting comments. REPUTATION_FEEDS lists them (files or
+directories, comma-separated); no network access is needed, and updating a
+feed means replacing its file.
+
+The feeds are compiled into one sorted array of merged, non-overlapping
+[start, end] ranges (8 bytes per range) and saved in REPUTATION_CACHE_DIR
+under a name derived from the feeds' paths, sizes and modification times.
+Every process memory-maps the compiled file read-only: once any process has
+compiled the current feeds, others start in milliseconds and share one copy
+in the page cache instead of each holding its own. A lookup is one binary
+search, O(log n).
+
+Parsing is vectorized with numpy over newline-aligned blocks, so compiling
+costs seconds per several million lines rather than minutes. IPv6 entries
+are not indexed; they are counted with other unparseable lines and skipped
+(MALICIOUS_NETWORKS accepts IPv6 ranges).
+
+Usage:
+    python -m backend.reputation compile
+    python -m backend.reputation lookup 198.51.100.7 [...]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from .ip_classifier import _parse_ip
+
+logger = logging.getLogger(__name__)
+
+REPUTATION_FEEDS = os.getenv("REPUTATION_FEEDS", "")  # Comma-separated feed files or directories
+REPUTATION_CACHE_DIR = os.getenv("REPUTATION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "reputation"))
+
+FORMAT_VERSION = 1  # Part of the cache key; bump when the compiled layout changes
+BLOCK_SIZE = 1 << 22  # Bytes parsed per vectorized step
+
+# Bytes that may appear on a valid line (anything else, e.g. letters or ':', makes it unparseable)
+_JUNK = np.ones(256, np.uint8)
+_JUNK[list(b"0123456789./- \t\r\n")] = 0
+# Separator expected after the k-th number of a line with n numbers: address, CIDR block or range
+_EXPECTED = np.zeros((9, 8), np.uint8)
+for _count, _separators in {4: b"...\n", 5: b".../\n", 8: b"...-...\n"}.items():
+    _EXPECTED[_count, :_count] = list(_separators)
+
+
+def feed_files(spec: str) -> List[str]:
+    """Feed file paths from a comma-separated list of files and directories (directories non-recursively)."""
+    paths = []
+    for part in (p.strip() for p in spec.split(",")):
+        if not part:
+            continue
+        if os.path.isdir(part):
+            paths.extend(sorted(os.path.join(part, name) for name in os.listdir(part)
+                                if not name.startswith(".") and os.path.isfile(os.path.join(part, name))))
+        else:
+            paths.append(part)
+    return paths
+
+
+def _parse_block(data: bytes) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Parse a block of whole lines (ending with a newline); returns (starts, ends, unparseable lines)."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+
+    # Blank out comments, from the first marker on a line to its end
+    marks = np.flatnonzero((buf == 35) | (buf == 59))
+    if len(marks):
+        buf = buf.copy()
+        mark_line = np.searchsorted(newlines, marks)
+        first = np.r_[True, mark_line[1:] != mark_line[:-1]]
+        depth = np.zeros(len(buf) + 1, np.int32)
+        np.add.at(depth, marks[first], 1)
+        np.add.at(depth, newlines[mark_line[first]], -1)
+        buf[np.cumsum(depth[:-1], dtype=np.int32) > 0] = 32
+
+    bad = np.zeros(len(newlines), bool)
+    content = np.zeros(len(newlines), bool)
+    junk_lines = np.searchsorted(newlines, np.flatnonzero(np.take(_JUNK, buf)))
+    bad[junk_lines] = True
+    content[junk_lines] = True
+
+    # Numbers are runs of digits; their value from up to three digits
+    digit = (buf - 48) < 10
+    edges = np.flatnonzero(digit[1:] != digit[:-1]) + 1
+    if digit[0]:
+        edges = np.r_[0, edges]
+    starts, ends = edges[0::2], edges[1::2] - 1
+    length = ends - starts + 1
+    value = buf[ends].astype(np.int64) - 48
+    for place, scale in ((1, 10), (2, 100)):
+        longer = length > place
+        value[longer] += (buf[ends[longer] - place].astype(np.int64) - 48) * scale
+
+    # The separator after each number is the next byte that is not blank
+    position = ends + 1
+    separator = buf[position]
+    while True:
+        blank = np.flatnonzero((separator == 32) | (separator == 9) | (separator == 13))
+        if not len(blank):
+            break
+        position[blank] += 1
+        separator[blank] = buf[position[blank]]
+
+    # A line is valid if its numbers and separators form one of the three shapes
+    line = np.searchsorted(newlines, starts)
+    count = np.bincount(line, minlength=len(newlines))
+    content |= count > 0
+    first_number = np.cumsum(count) - count
+    k = np.arange(len(starts)) - first_number[line]
+    n = count[line]
+    shaped = (n <= 8) & (length <= 3) & (_EXPECTED[np.minimum(n, 8), np.minimum(k, 7)] == separator)
+    bad[line[~shaped]] = True
+    bad |= ~np.isin(count, (4, 5, 8))
+
+    lines = np.flatnonzero(~bad)
+    first, count = first_number[lines], count[lines]
+
+    def address(offset) -> Tuple[np.ndarray, np.ndarray]:
+        octets = [value[first + offset + i] for i in range(4)]
+        return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3], np.maximum.reduce(octets) <= 255
+
+    start, ok = address(0)
+    cidr = count == 5
+    prefix = np.where(cidr, value[np.minimum(first + 4, len(value) - 1)], 32)
+    ok &= prefix <= 32
+    host_mask = (np.int64(1) << (32 - np.minimum(prefix, 32))) - 1
+    start = np.where(cidr, start & ~host_mask, start)
+    end = start | np.where(cidr, host_mask, 0)
+    is_range = count == 8
+    if is_range.any():
+        last, last_ok = address(np.where(is_range, 4, 0))
+        end = np.where(is_range, last, end)
+        ok &= ~is_range | (last_ok & (last >= start))
+    return start[ok], end[ok], int(content.sum()) - int(ok.sum())
+
+
+def _blocks(path: str) -> Iterator[bytes]:
+    """A file's contents in blocks of whole lines, each ending with a newline."""
+    with open(path, "rb") as f:
+        carry = b""
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            data = carry + data
+            cut = data.rfind(b"\n") + 1
+            carry = data[cut:]
+            if cut:
+                yield data[:cut]
+        if carry.strip():
+            yield carry + b"\n"
+
+
+def parse_feed(path: str) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Ranges of one feed as (starts, ends) integer arrays, and how many lines were skipped."""
+    starts, ends, skipped = [np.empty(0, np.int64)], [np.empty(0, np.int64)], 0
+    for block in _blocks(path):
+        block_starts, block_ends, block_skipped = _parse_block(block)
+        starts.append(block_starts)
+        ends.append(block_ends)
+        skipped += block_skipped
+    return np.concatenate(starts), np.concatenate(ends), skipped
+
+
+def merge_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Sorted, non-overlapping, non-adjacent ranges as a (2, n) uint32 array of [starts, ends]."""
+    if not len(starts):
+        return np.empty((2, 0), np.uint32)
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)  # Furthest address covered so far
+    begins = np.flatnonzero(np.r_[True, starts[1:] > reach[:-1] + 1])
+    finishes = np.r_[begins[1:] - 1, len(starts) - 1]
+    return np.vstack([starts[begins], reach[finishes]]).astype(np.uint32)
+
+
+def cache_path(paths: List[str], cache_dir: str = REPUTATION_CACHE_DIR) -> str:
+    """Compiled-index file for the feeds' current contents (by path, size and modification time)."""
+    digest = hashlib.sha256(str(FORMAT_VERSION).encode())
+    for path in sorted(os.path.abspath(p) for p in paths):
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return os.path.join(cache_dir, f"reputation-{digest.hexdigest()[:16]}.npy")
+
+
+class ReputationIndex:
+    """Known-bad IPv4 ranges with O(log n) membership tests."""
+
+    def __init__(self, ranges: np.ndarray):
+        """Wrap a (2, n) array of sorted, merged [starts, ends] (typically memory-mapped)."""
+        self.ranges = ranges
+        self._starts, self._ends = ranges[0], ranges[1]
+
+    @classmethod
+    def empty(cls) -> "ReputationIndex":
+        """An index that matches nothing."""
+        return cls(np.empty((2, 0), np.uint32))
+
+    @classmethod
+    def from_feeds(cls, paths: List[str], cache_dir: str = REPUTATION_CACHE_DIR) -> "ReputationIndex":
+        """Memory-map the compiled index of ``paths``, compiling it first if the feeds changed."""
+        if not paths:
+            return cls.empty()
+        path = cache_path(paths, cache_dir)
+        if not os.path.exists(path):
+            cls.compile(paths, path)
+        return cls(np.load(path, mmap_mode="r"))
+
+    @staticmethod
+    def compile(paths: List[str], path: str) -> None:
+        """Parse and merge the feeds and write the compiled index to ``path`` atomically."""
+        started = time.monotonic()
+        starts, ends, skipped = [], [], 0
+        for feed in paths:
+            feed_starts, feed_ends, feed_skipped = parse_feed(feed)
+            starts.append(feed_starts)
+            ends.append(feed_ends)
+            skipped += feed_skipped
+            if feed_skipped:
+                logger.warning(f"Skipped {feed_skipped} unparseable or IPv6 lines in {feed}")
+        ranges = merge_ranges(np.concatenate(starts), np.concatenate(ends))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique name: compilers in other containers on a shared volume may have the same pid
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, ranges)
+        os.chmod(partial, 0o644)  # mkstemp creates it private; every process maps it
+        os.replace(partial, path)  # Concurrent compilers each write their own file; the last one wins
+        logger.info(f"Compiled {sum(len(s) for s in starts)} entries from {len(paths)} feeds into "
+                    f"{ranges.shape[1]} ranges in {time.monotonic() - started:.2f}s ({path})")
+
+    def __len__(self) -> int:
+        """Number of merged ranges."""
+        return self.ranges.shape[1]
+
+    def __contains__(self, ip: str) -> bool:
+        """True if ``ip`` (a string) falls inside a listed range."""
+        if not len(self):
+            return False
+        parsed = _parse_ip(ip)
+        if parsed is None or parsed[0] != 4:
+            return False
+        value = parsed[1]
+        # A Python int would make numpy convert the whole (memory-mapped) array to compare; match its dtype
+        index = int(np.searchsorted(self._starts, np.uint32(value), side="right")) - 1
+        return index >= 0 and value <= int(self._ends[index])
+
+
+@lru_cache(maxsize=1)
+def default_reputation() -> ReputationIndex:
+    """Process-wide index of the feeds in REPUTATION_FEEDS."""
+    paths = feed_files(REPUTATION_FEEDS)
+    try:
+        index = ReputationIndex.from_feeds(paths)
+    except OSError as e:
+        logger.error(f"Failed to load reputation feeds {paths}: {e}")
+        return ReputationIndex.empty()
+    if paths:
+        logger.info(f"Loaded IP reputation index: {len(index)} ranges from {len(paths)} feeds")
+    return index
+
+
+def main() -> None:
+    """Compile the configured feeds or look up addresses."""
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="IP reputation feeds")
+    parser.add_argument("command", choices=["compile", "lookup"])
+    parser.add_argument("ips", nargs="*", help="Addresses to look up")
+    args = parser.parse_args()
+
+    paths = feed_files(REPUTATION_FEEDS)
+    if args.command == "compile":
+        if not paths:
+            parser.error("REPUTATION_FEEDS lists no feeds")
+        ReputationIndex.compile(paths, cache_path(paths))
+    else:
+        index = default_reputation()
+        for ip in args.ips:
+            print(f"{ip}\t{'listed' if ip in index else 'not listed'}")
+
+
+if __name__ == "__main__":
+    main()
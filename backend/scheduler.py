@@ -1,50 +1,93 @@
 """Scheduler for running data generation every 30 minutes."""
 import logging
+import os
+import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional, Tuple
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from .database import SessionLocal, init_db
 from .data_generator import DataGenerator
-from .event_dispatcher import EventDispatcher
+from .event_dispatcher import EventDispatcher, MAX_WORKERS, limiter
+from .ingest import upsert_rows
+from .models import DispatchStatus
+from .timeutils import utcnow
+from .recording import RunRecorder
+from .streaming import EventStream
+from .coordination import LeaderLock
+from . import outbox
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GENERATOR_SEED = os.getenv("GENERATOR_SEED") or None  # Fixed seed for reproducible workloads
+GENERATOR_RECORD_PATH = os.getenv("GENERATOR_RECORD_PATH") or None  # JSON Lines file to record every run to
+# "batch": each cycle generates then dispatches; "stream": generated events go straight
+# to a continuously running EventStream and are scored as soon as they exist
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "batch").lower()
+# How often the outbox is drained: a safety net normally, the main dispatch path with DISPATCH_VIA_OUTBOX
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "1" if outbox.DISPATCH_VIA_OUTBOX else "30"))
+# "all": generate (when holding the leader lock) and dispatch; "worker": only drain the outbox
+BACKEND_ROLE = os.getenv("BACKEND_ROLE", "all").lower()
+DISPATCH_STATUS_SECONDS = int(os.getenv("DISPATCH_STATUS_SECONDS", "15"))  # How often the limiter state is published
 
-def generate_and_dispatch_events():
-    """Generate new events and dispatch them to AI agent."""
+
+def _run_stage(name: str, generate, dispatcher: EventDispatcher, pool: ThreadPoolExecutor) -> Tuple[int, int, float, float]:
+    """Generate one event type with its own session, then dispatch it on the shared pool."""
+    db = SessionLocal()
+    try:
+        stage_start = time.monotonic()
+        events = generate(db)
+        generated_at = time.monotonic()
+        logger.info(f"Dispatching {len(events)} {name} events to agent (in parallel)...")
+        successful = dispatcher.dispatch_events_parallel(events, executor=pool)
+        return len(events), successful, generated_at - stage_start, time.monotonic() - generated_at
+    finally:
+        db.close()
+
+
+def generate_and_dispatch_events(generator: DataGenerator):
+    """
+    Generate new events and dispatch them to AI agent.
+
+    The three event types run as concurrent stages: each generates its events
+    and feeds them into one shared dispatch pool, so the agent is kept busy
+    while other types are still being generated and the cycle takes about as
+    long as its slowest stage.
+    """
     start_time = datetime.now()
     logger.info(f"=== Starting event generation cycle at {start_time.isoformat()} ===")
-    
+
     db = SessionLocal()
     try:
-        generator = DataGenerator()
         dispatcher = EventDispatcher(db)
+        stages = {
+            "login": generator.generate_login_events,
+            "firewall": generator.generate_firewall_events,
+            "patch": generator.generate_patch_levels,
+        }
 
-        # Generate login events
-        login_start = datetime.now()
-        login_events = generator.generate_login_events(db)
-        logger.info(f"Dispatching {len(login_events)} login events to agent (in parallel)...")
-        successful = dispatcher.dispatch_login_events_parallel(login_events)
-        logger.info(f"Login events completed: {successful}/{len(login_events)} successful in {(datetime.now() - login_start).total_seconds():.1f}s")
-
-        # Generate firewall events
-        firewall_start = datetime.now()
-        firewall_events = generator.generate_firewall_events(db)
-        logger.info(f"Dispatching {len(firewall_events)} firewall events to agent (in parallel)...")
-        successful = dispatcher.dispatch_firewall_events_parallel(firewall_events)
-        logger.info(f"Firewall events completed: {successful}/{len(firewall_events)} successful in {(datetime.now() - firewall_start).total_seconds():.1f}s")
-
-        # Generate/update patch levels
-        patch_start = datetime.now()
-        patch_events = generator.generate_patch_levels(db)
-        logger.info(f"Dispatching {len(patch_events)} patch events to agent (in parallel)...")
-        successful = dispatcher.dispatch_patch_events_parallel(patch_events)
-        logger.info(f"Patch events completed: {successful}/{len(patch_events)} successful in {(datetime.now() - patch_start).total_seconds():.1f}s")
+        stage_time = 0.0
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool, \
+                ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="stage") as stage_pool:
+            futures = {name: stage_pool.submit(_run_stage, name, generate, dispatcher, pool)
+                       for name, generate in stages.items()}
+            for name, future in futures.items():
+                try:
+                    total, successful, generate_s, dispatch_s = future.result()
+                except Exception as e:
+                    logger.error(f"Error in {name} stage: {e}", exc_info=True)
+                    continue
+                stage_time += generate_s + dispatch_s
+                logger.info(f"{name.capitalize()} events completed: {successful}/{total} successful "
+                            f"(generate {generate_s:.1f}s, dispatch {dispatch_s:.1f}s)")
 
         total_time = (datetime.now() - start_time).total_seconds()
-        logger.info(f"=== Event generation cycle completed successfully in {total_time:.1f}s ({total_time/60:.1f} minutes) ===")
+        logger.info(f"=== Event generation cycle completed successfully in {total_time:.1f}s ({total_time/60:.1f} minutes); "
+                    f"stages took {stage_time:.1f}s combined ===")
+        logger.info(f"Dispatch concurrency: {limiter.snapshot()}")
 
     except Exception as e:
         logger.error(f"Error in event generation cycle: {e}", exc_info=True)
@@ -52,33 +95,159 @@ def generate_and_dispatch_events():
         db.close()
 
 
+def generate_events(generator: DataGenerator, stream: Optional[EventStream] = None):
+    """
+    Generate new events without waiting for their analyses.
+
+    Each batch goes to the event stream as soon as it is inserted, or, without
+    a stream, is left in the outbox for the replicas' outbox workers.
+    """
+    start_time = datetime.now()
+    logger.info(f"=== Starting event generation at {start_time.isoformat()} "
+                f"({'stream' if stream else 'outbox'} dispatch) ===")
+
+    db = SessionLocal()
+    try:
+        for generate in (generator.generate_login_events,
+                         generator.generate_firewall_events,
+                         generator.generate_patch_levels):
+            events = generate(db)
+            if stream:
+                stream.submit(events)  # Blocks while the stream is full (backpressure)
+
+        total_time = (datetime.now() - start_time).total_seconds()
+        queued = f"{stream.depth()} events queued for scoring" if stream else "events left to the outbox workers"
+        logger.info(f"=== Event generation completed in {total_time:.1f}s; {queued} ===")
+
+    except Exception as e:
+        logger.error(f"Error in event generation: {e}", exc_info=True)
+    finally:
+        db.close()
+
+
+def run_as_leader(leader: LeaderLock, job, *args):
+    """Run a generation job only on the replica holding the leader lock."""
+    try:
+        is_leader = leader.is_leader()
+    except Exception as e:
+        logger.error(f"Could not check the leader lock: {e}")
+        return
+    if not is_leader:
+        logger.info("Another replica holds the generation lock; skipping this cycle")
+        return
+    job(*args)
+
+
+def recover_outbox(stream: Optional[EventStream] = None):
+    """Re-dispatch events whose first dispatch never stored an analysis (crash, agent error)."""
+    db = SessionLocal()
+    try:
+        dispatch = stream.submit if stream else EventDispatcher(db).dispatch_events_parallel
+        recovered = outbox.drain(db, dispatch)
+        if recovered:
+            logger.info(f"Recovered {recovered} events from the dispatch outbox "
+                        f"(concurrency limit {limiter.limit})")
+    except Exception as e:
+        logger.error(f"Error recovering outbox events: {e}", exc_info=True)
+    finally:
+        db.close()
+
+
+def publish_dispatch_status():
+    """Store this replica's concurrency limit and latency statistics for the dashboard."""
+    snapshot = limiter.snapshot()
+    db = SessionLocal()
+    try:
+        upsert_rows(db, DispatchStatus, [{
+            "replica": socket.gethostname(),
+            "concurrency_limit": snapshot.pop("limit"),
+            **snapshot,
+            "updated_at": utcnow(),
+        }], key="replica")
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error publishing dispatch status: {e}")
+    finally:
+        db.close()
+
+
 def start_scheduler():
     """Start the APScheduler to run every 30 minutes."""
     logger.info("Initializing database...")
     init_db()
 
-    logger.info("Starting scheduler...")
+    stream = None
+    if SCHEDULER_MODE == "stream":
+        stream = EventStream()
+        stream.start()
+
+    recorder = None
+    leader = LeaderLock()
+    logger.info(f"Starting scheduler ({SCHEDULER_MODE} mode, {BACKEND_ROLE} role)...")
     scheduler = BackgroundScheduler()
-    
-    # Run every 30 minutes
-    # Set max_instances=1 to prevent overlapping jobs
-    # Set coalesce=True to combine missed runs into one execution
+
+    if BACKEND_ROLE != "worker":
+        # One generator for the scheduler's lifetime, so its seeded streams, attack
+        # intervals and failed-login window carry across cycles
+        recorder = RunRecorder(GENERATOR_RECORD_PATH) if GENERATOR_RECORD_PATH else None
+        generator = DataGenerator(seed=GENERATOR_SEED, recorder=recorder)
+        if GENERATOR_SEED is not None:
+            logger.info(f"Generator seeded with {GENERATOR_SEED!r}")
+        if recorder:
+            logger.info(f"Recording generated events to {GENERATOR_RECORD_PATH}")
+
+        if outbox.DISPATCH_VIA_OUTBOX:
+            job_args = [leader, generate_events, generator, None]  # Outbox workers dispatch
+        elif stream:
+            job_args = [leader, generate_events, generator, stream]
+        else:
+            job_args = [leader, generate_and_dispatch_events, generator]
+
+        # Run every 30 minutes
+        # Set max_instances=1 to prevent overlapping jobs
+        # Set coalesce=True to combine missed runs into one execution
+        scheduler.add_job(
+            run_as_leader,
+            trigger=IntervalTrigger(minutes=30),
+            args=job_args,
+            id="event_generation",
+            name="Generate and dispatch cybersecurity events",
+            replace_existing=True,
+            max_instances=1,  # Prevent overlapping executions
+            coalesce=True,    # Combine multiple missed runs into one
+            misfire_grace_time=300  # Allow up to 5 minutes grace for missed runs
+        )
+
+        # Run immediately on startup
+        scheduler.add_job(
+            run_as_leader,
+            args=job_args,
+            id="initial_generation",
+            name="Initial event generation"
+        )
+
+    # Pick up events left unanalyzed by earlier cycles, crashes or agent errors
+    # (with DISPATCH_VIA_OUTBOX, this is how every replica gets its share of events)
     scheduler.add_job(
-        generate_and_dispatch_events,
-        trigger=IntervalTrigger(minutes=30),
-        id="event_generation",
-        name="Generate and dispatch cybersecurity events",
+        recover_outbox,
+        trigger=IntervalTrigger(seconds=OUTBOX_POLL_SECONDS),
+        args=[stream],
+        id="outbox_recovery",
+        name="Recover unacknowledged events from the dispatch outbox",
         replace_existing=True,
-        max_instances=1,  # Prevent overlapping executions
-        coalesce=True,    # Combine multiple missed runs into one
-        misfire_grace_time=300  # Allow up to 5 minutes grace for missed runs
+        max_instances=1,
+        coalesce=True,
     )
 
-    # Run immediately on startup
     scheduler.add_job(
-        generate_and_dispatch_events,
-        id="initial_generation",
-        name="Initial event generation"
+        publish_dispatch_status,
+        trigger=IntervalTrigger(seconds=DISPATCH_STATUS_SECONDS),
+        id="dispatch_status",
+        name="Publish the dispatch concurrency limit",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
     )
 
     scheduler.start()
@@ -92,6 +261,11 @@ def start_scheduler():
     except (KeyboardInterrupt, SystemExit):
         logger.info("Shutting down scheduler...")
         scheduler.shutdown()
+        leader.release()
+        if stream:
+            stream.stop()
+        if recorder:
+            recorder.close()
 
 
 if __name__ == "__main__":
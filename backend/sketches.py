@@ -0,0 +1,261 @@
+"""Probabilistic sketches for streaming statistics in fixed memory.
+
+Exact per-key sets grow with the traffic (every distinct port or host seen
+from every source); these sketches answer approximately in memory that does
+not depend on how many keys or values appear. Values are hashed with BLAKE2b rather than Python's hash(), which
+is salted per process, so estimates (and the flags derived from them) are the
+same in every run.
+"""
+import hashlib
+import math
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+def hash64(value: Hashable) -> int:
+    """Stable 64-bit hash of a value's string form."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter.
+
+    2**precision one-byte registers (256 bytes at the default precision 8)
+    give about 6.5% standard error on large sets; small sets, which are what
+    scan thresholds look at, use linear counting and are close to exact.
+    """
+
+    def __init__(self, precision: int = 8):
+        """Create an empty sketch with 2**precision registers."""
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, value: Hashable) -> bool:
+        """Add a value; returns True if the sketch changed (the estimate may have grown)."""
+        h = hash64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1  # Position of the first 1 bit
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    @staticmethod
+    def estimate(registers: np.ndarray) -> float:
+        """Distinct count estimated from a register array (one sketch or a union)."""
+        m = len(registers)
+        zeros = int(np.count_nonzero(registers == 0))
+        if zeros:
+            linear = m * math.log(m / zeros)
+            if linear <= 2.5 * m:
+                return linear
+        alpha = 0.7213 / (1 + 1.079 / m)
+        return alpha * m * m / float(np.sum(np.ldexp(1.0, -registers.astype(np.int32))))
+
+    def count(self) -> float:
+        """Estimated number of distinct values added."""
+        return self.estimate(self.registers)
+
+
+class WindowedHyperLogLog:
+    """
+    Approximate distinct count over a trailing time window.
+
+    The window is split into ``buckets`` time slices, each with its own
+    HyperLogLog. The window's count is the estimate of the slices' union
+    (element-wise max of their registers), recomputed only when a register
+    changes or a slice expires. Values older than the window, relative to
+    the newest value seen, are not counted (add returns 0), and a late value
+    within it gets the count of the window ending at its own slice.
+
+    Register collisions make small counts read low (10 distinct values
+    estimate below 10 about 15% of the time), so with ``exact_limit`` each
+    slice also keeps its values in a set until it holds more than
+    ``exact_limit`` of them; while the union of the sets is that small, the
+    count is exact. Set ``exact_limit`` above any threshold compared against.
+    """
+
+    def __init__(self, window: timedelta, buckets: int = 5, precision: int = 8, exact_limit: int = 0):
+        """Create an empty windowed sketch."""
+        self.width = window.total_seconds() / buckets
+        self.buckets = buckets
+        self.precision = precision
+        self.exact_limit = exact_limit
+        self._slices: Deque[list] = deque()  # [slice number, sketch, exact values or None], oldest first
+        self._count = 0.0
+
+    def add(self, value: Hashable, timestamp: datetime) -> float:
+        """Add a value seen at ``timestamp``; returns the distinct count of the window ending at it."""
+        number = int(timestamp.timestamp() // self.width)
+        changed = False
+
+        if not self._slices or number > self._slices[-1][0]:
+            self._slices.append([number, HyperLogLog(self.precision), set() if self.exact_limit else None])
+            while self._slices[0][0] <= number - self.buckets:
+                self._slices.popleft()
+                changed = True
+        elif number <= self._slices[-1][0] - self.buckets:
+            return 0.0  # Older than the window
+
+        entry = self._entry(number)
+        values = entry[2]
+        if values is not None and value not in values:
+            values.add(value)
+            if len(values) > self.exact_limit:
+                entry[2] = None  # Too many to keep; the sketch takes over
+            changed = True
+        if entry[1].add(value):
+            changed = True
+
+        if number < self._slices[-1][0]:
+            return self._window_count([e for e in self._slices if e[0] <= number])  # Late value
+        if changed:
+            self._count = self._window_count(self._slices)
+        return self._count
+
+    def _entry(self, number: int) -> list:
+        """Slice ``number``, created in place for late values that fall in a gap."""
+        for i, entry in enumerate(self._slices):
+            if entry[0] == number:
+                return entry
+            if entry[0] > number:
+                entry = [number, HyperLogLog(self.precision), set() if self.exact_limit else None]
+                self._slices.insert(i, entry)
+                return entry
+        raise AssertionError("slice outside the window")
+
+    def _window_count(self, entries: List[list]) -> float:
+        """Distinct count of the union of slices: exact while their sets are small, else estimated."""
+        if all(values is not None for _, _, values in entries):
+            union = set().union(*(values for _, _, values in entries))
+            if len(union) <= self.exact_limit:
+                return float(len(union))
+        return HyperLogLog.estimate(np.maximum.reduce([sketch.registers for _, sketch, _ in entries]))
+
+
+class WindowedCountMin:
+    """
+    Approximate per-key counts over a trailing time window, in fixed memory.
+
+    A count-min sketch of ``depth`` rows by ``width`` counters per time slice,
+    plus a running total of the live slices, so adding and estimating touch
+    ``depth`` counters whatever the number of keys. Estimates never undercount
+    and overcount by at most about e/width of the window's total, so size
+    ``width`` to the traffic a window holds. The window ends at the newest
+    timestamp seen; events older than it are not counted (add returns 0), and
+    a late event within it gets the count of the window ending at its own slice.
+    """
+
+    def __init__(self, window: timedelta, slices: int = 5, width: int = 1 << 16, depth: int = 4):
+        """Create an empty windowed sketch ((4 * slices + 8) * width * depth bytes; 7.3 MB by default)."""
+        self.width = width
+        self.depth = depth
+        self.slice_seconds = window.total_seconds() / slices
+        self.slices = slices
+        # Counters are numpy arrays for whole-slice arithmetic and memoryviews for fast single-cell access
+        self._slices: Deque[Tuple[int, np.ndarray, memoryview]] = deque()  # Oldest first
+        self._total = np.zeros(depth * width, dtype=np.int64)
+        self._total_cells = memoryview(self._total)
+
+    def _cells(self, key: Hashable) -> List[int]:
+        """Flat index of ``key``'s counter in each row (double hashing from one 64-bit hash)."""
+        h = hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key: Hashable, timestamp: datetime, count: int = 1) -> int:
+        """Count ``key`` at ``timestamp``; returns its estimated count within the window ending at it."""
+        number = int(timestamp.timestamp() // self.slice_seconds)
+        if not self._slices or number > self._slices[-1][0]:
+            self._append_slice(number)
+        elif number <= self._slices[-1][0] - self.slices:
+            return 0  # Older than the window
+
+        cells = self._cells(key)
+        counters = self._slice(number)
+        total = self._total_cells
+        for cell in cells:
+            counters[cell] += count
+            total[cell] += count
+        return self._count(cells, number)
+
+    def estimate(self, key: Hashable, timestamp: Optional[datetime] = None) -> int:
+        """Estimated count of ``key`` within the window (ending at ``timestamp``, by default the newest)."""
+        cells = self._cells(key)
+        if timestamp is None or not self._slices:
+            total = self._total_cells
+            return min(total[cell] for cell in cells)
+        return self._count(cells, int(timestamp.timestamp() // self.slice_seconds))
+
+    def _count(self, cells: List[int], number: int) -> int:
+        """Estimate from ``cells`` over the window ending at slice ``number``."""
+        first = number - self.slices  # Newest slice before the window
+        if number >= self._slices[-1][0] and self._slices[0][0] > first:
+            total = self._total_cells  # Every live slice is in the window
+            return min(total[cell] for cell in cells)
+        live = [counters for slice_number, _, counters in self._slices if first < slice_number <= number]
+        if not live:
+            return 0
+        return min(sum(counters[cell] for counters in live) for cell in cells)
+
+    def _new_slice(self, number: int) -> Tuple[int, np.ndarray, memoryview]:
+        """Empty counters for one slice."""
+        counters = np.zeros(self.depth * self.width, dtype=np.int32)
+        return number, counters, memoryview(counters)
+
+    def _append_slice(self, number: int) -> None:
+        """Start a newer slice and expire the ones that fall out of the window."""
+        self._slices.append(self._new_slice(number))
+        while self._slices[0][0] <= number - self.slices:
+            self._total -= self._slices.popleft()[1]
+
+    def _slice(self, number: int) -> memoryview:
+        """Counters of one live slice, created in place for late events that fall in a gap."""
+        for i, (slice_number, _, counters) in enumerate(self._slices):
+            if slice_number == number:
+                return counters
+            if slice_number > number:
+                created = self._new_slice(number)
+                self._slices.insert(i, created)
+                return created[2]
+        raise AssertionError("slice outside the window")
+
+
+class TopK:
+    """
+    The ``k`` keys with the largest estimated counts (heavy hitters).
+
+    Keys are offered with their current estimate from a sketch; a key enters
+    when there is room or it beats the smallest tracked count. Stored counts
+    go stale as the window slides, so readers refresh them from the sketch.
+    """
+
+    def __init__(self, k: int = 20):
+        """Track at most ``k`` keys."""
+        self.k = k
+        self._counts: Dict[Hashable, int] = {}
+        self._floor = 0  # Smallest tracked count once full
+
+    def offer(self, key: Hashable, count: int) -> None:
+        """Consider ``key`` with estimated ``count``."""
+        if key in self._counts or len(self._counts) < self.k:
+            self._counts[key] = count
+        elif count > self._floor:
+            del self._counts[min(self._counts, key=self._counts.get)]
+            self._counts[key] = count
+        else:
+            return
+        if len(self._counts) >= self.k:
+            self._floor = min(self._counts.values())
+
+    def refresh(self, estimate: Callable[[Hashable], int]) -> List[Tuple[Hashable, int]]:
+        """Re-estimate the tracked keys, drop those that left the window, and return them largest first."""
+        self._counts = {key: estimate(key) for key in self._counts}
+        self._counts = {key: count for key, count in self._counts.items() if count > 0}
+        self._floor = min(self._counts.values()) if len(self._counts) >= self.k else 0
+        return sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
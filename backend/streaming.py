@@ -0,0 +1,177 @@
+"""Continuous event scoring (SCHEDULER_MODE=stream).
+
+Producers put inserted events on a bounded queue as soon as they exist.
+Dispatch workers take them off, score them with the agent and hand the
+results to one writer thread, which stores them in batches. When the agent
+falls behind, the queues fill and producers block, which is the
+backpressure. Events are scored seconds after they are produced, however
+generation is triggered.
+
+    producers -> [event queue] -> dispatch workers -> [result queue] -> result writer
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from .database import SessionLocal
+from .event_dispatcher import (EVENT_TYPES, MAX_WORKERS, DispatchFailed, build_analysis, dispatch_deadline,
+                               event_to_data, limiter, record_failure, request_analysis, store_analyses)
+
+logger = logging.getLogger(__name__)
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "1000"))  # Events waiting for a dispatch worker
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "200"))  # Most analyses stored per write
+RESULT_FLUSH_SECONDS = float(os.getenv("RESULT_FLUSH_SECONDS", "1.0"))  # Longest a result waits to be stored
+
+_STOP = object()  # Queue sentinel
+
+
+class EventStream:
+    """Bounded queue of events with dispatch workers and a batching result writer."""
+
+    def __init__(
+        self,
+        workers: int = MAX_WORKERS,
+        queue_size: int = STREAM_QUEUE_SIZE,
+        batch_size: int = RESULT_BATCH_SIZE,
+        flush_seconds: float = RESULT_FLUSH_SECONDS,
+    ):
+        """Create the stream; call start() before submitting events."""
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._events: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._results: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = []
+        self._writer: Optional[threading.Thread] = None
+        self.stored = 0
+        self.failed = 0
+        self._failed_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the dispatch workers and the result writer."""
+        self._writer = threading.Thread(target=self._write_results, name="stream-writer", daemon=True)
+        self._writer.start()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._dispatch, name=f"stream-dispatch-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Event stream started with {self.workers} dispatch workers")
+
+    def submit(self, events: List[Any]) -> None:
+        """
+        Queue inserted or claimed events (ids set) for scoring; blocks while the queue is full.
+
+        Their dispatch deadline starts now, so time spent waiting here and in
+        the queue counts against it.
+        """
+        deadline = dispatch_deadline()
+        for event in events:
+            # Serialize now: workers must not touch the producer's ORM objects
+            self._events.put((EVENT_TYPES[type(event)], event_to_data(event), time.monotonic(), deadline))
+
+    def depth(self) -> int:
+        """Events waiting for a dispatch worker."""
+        return self._events.qsize()
+
+    def stop(self) -> None:
+        """Score everything already queued, store the results and stop the threads."""
+        for _ in self._threads:
+            self._events.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._results.put(_STOP)
+        if self._writer:
+            self._writer.join()
+        logger.info(f"Event stream stopped: {self.stored} analyses stored, {self.failed} failed")
+
+    def _dispatch(self) -> None:
+        """Worker loop: score queued events and pass results to the writer."""
+        while True:
+            item = self._events.get()
+            if item is _STOP:
+                return
+            event_type, data, queued_at, deadline = item
+            payload = {"type": event_type, "data": data}
+            try:
+                result = request_analysis(payload, deadline)
+                analysis = build_analysis(event_type, data["id"], result)
+                if analysis is None:
+                    self._record_failure(payload, f"Invalid response format: {result}", 1, transient=False)
+            except DispatchFailed as e:
+                logger.error(f"Failed to dispatch event {data['id']} after {e.attempts} attempt(s): {e}")
+                self._record_failure(payload, str(e), e.attempts, e.transient)
+                analysis = None
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to dispatch event {data['id']}: {e}")
+                analysis = None
+            except Exception as e:
+                logger.error(f"Unexpected error dispatching event {data['id']}: {e}")
+                analysis = None
+
+            if analysis is None:
+                with self._failed_lock:
+                    self.failed += 1
+            else:
+                self._results.put((analysis, data, queued_at))
+
+    def _record_failure(self, payload: Dict[str, Any], error: str, attempts: int, transient: bool) -> None:
+        """Note a transient failure in the outbox or dead-letter a permanent one."""
+        db = SessionLocal()
+        try:
+            record_failure(db, payload, error, attempts, transient)
+        finally:
+            db.close()
+
+    def _write_results(self) -> None:
+        """Writer loop: store analyses in batches of up to batch_size or every flush_seconds."""
+        db = SessionLocal()
+        pending: List[Tuple[Any, Dict[str, Any], float]] = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._results.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    self._flush(db, pending)
+                    return
+                if item is not None:
+                    pending.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_seconds
+                if len(pending) >= self.batch_size or (pending and time.monotonic() >= deadline):
+                    self._flush(db, pending)
+                    pending = []
+                    deadline = None
+        finally:
+            db.close()
+
+    def _flush(self, db, pending: List[Tuple[Any, Dict[str, Any], float]]) -> None:
+        """Store a batch of analyses in one transaction."""
+        if not pending:
+            return
+        try:
+            store_analyses(db, [(analysis, data) for analysis, data, _ in pending])  # Acks in the same transaction
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            with self._failed_lock:
+                self.failed += len(pending)
+            logger.error(f"Failed to store {len(pending)} analyses: {e}")
+            return
+
+        self.stored += len(pending)
+        now = time.monotonic()
+        latencies = sorted(now - queued_at for _, _, queued_at in pending)
+        logger.info(f"Stored {len(pending)} analyses (queued: {self.depth()}, "
+                    f"queue-to-store p50={latencies[len(latencies) // 2]:.2f}s max={latencies[-1]:.2f}s, "
+                    f"concurrency limit {limiter.limit})")
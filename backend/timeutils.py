@@ -0,0 +1,49 @@
+"""Timestamp normalization shared by ingest, storage and dispatch.
+
+All event timestamps are stored as timezone-aware UTC. Night-time rules are
+evaluated in the site's local time (SITE_TIMEZONE), so the local hour of day
+is computed once at ingest and stored next to the timestamp.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+SITE_TIMEZONE = ZoneInfo(os.getenv("SITE_TIMEZONE", "UTC"))
+
+
+def utcnow() -> datetime:
+    """Current time as a timezone-aware UTC datetime."""
+    return datetime.now(timezone.utc)
+
+
+def to_utc(value: datetime) -> datetime:
+    """
+    Normalize a datetime to timezone-aware UTC.
+
+    Naive values are taken to be site-local time, which is what log sources
+    without an offset emit.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=SITE_TIMEZONE)
+    return value.astimezone(timezone.utc)
+
+
+def site_hour(value: datetime) -> int:
+    """Hour of day (0-23) of a timestamp in the site timezone."""
+    return to_utc(value).astimezone(SITE_TIMEZONE).hour
+
+
+class SimulatedClock:
+    """A clock that stands still until advanced, for reproducible generation runs."""
+
+    def __init__(self, start: datetime):
+        """Start the clock at ``start`` (naive values are site-local)."""
+        self.now = to_utc(start)
+
+    def __call__(self) -> datetime:
+        """Current simulated time as aware UTC."""
+        return self.now
+
+    def advance(self, delta: timedelta) -> None:
+        """Move the clock forward."""
+        self.now += delta
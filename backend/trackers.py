@@ -0,0 +1,200 @@
+"""Bounded, time-windowed event trackers for streaming detection."""
+import bisect
+import math
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class SlidingWindowCounter:
+    """
+    Count events per key within a trailing time window, with bounded memory.
+
+    Each key keeps a deque of recent timestamps; entries older than the window
+    (relative to the newest timestamp for that key) are dropped as new ones
+    arrive, so in-order streams cost amortized O(1) per event. A late event is
+    counted against the window ending at its own time, not the newest one; the
+    entries already dropped are not counted, so late counts can only be low.
+    Keys are kept in LRU order and the least recently seen key is evicted
+    beyond ``max_keys``; each key keeps at most ``max_events_per_key`` timestamps.
+    """
+
+    def __init__(
+        self,
+        window: timedelta = timedelta(minutes=10),
+        max_keys: int = 100_000,
+        max_events_per_key: int = 1_000,
+    ):
+        """Initialize an empty tracker."""
+        self.window = window
+        self.max_keys = max_keys
+        self.max_events_per_key = max_events_per_key
+        self._events: "OrderedDict[Hashable, Deque[datetime]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Number of keys currently tracked."""
+        return len(self._events)
+
+    def record(self, key: Hashable, timestamp: datetime) -> int:
+        """Record an event for ``key`` and return the key's count within the window ending at ``timestamp``."""
+        events = self._events.get(key)
+        if events is None:
+            events = deque(maxlen=self.max_events_per_key)
+            self._events[key] = events
+            if len(self._events) > self.max_keys:
+                self._events.popitem(last=False)
+        else:
+            self._events.move_to_end(key)
+
+        if not events or timestamp >= events[-1]:
+            events.append(timestamp)
+            late_count = None
+        else:
+            # Late arrival: keep the deque ordered (rare, bounded by max_events_per_key)
+            if len(events) == events.maxlen:
+                events.popleft()
+            bisect.insort(events, timestamp)
+            late_count = bisect.bisect_right(events, timestamp) - bisect.bisect_right(events, timestamp - self.window)
+
+        cutoff = events[-1] - self.window
+        while events[0] <= cutoff:
+            events.popleft()
+        return len(events) if late_count is None else late_count
+
+    def count(self, key: Hashable) -> int:
+        """Events currently held for ``key`` (without recording one)."""
+        events = self._events.get(key)
+        return len(events) if events else 0
+
+
+class FailedLoginTracker(SlidingWindowCounter):
+    """Failed logins per user/source IP; three or more within ten minutes is a burst."""
+
+    BURST_THRESHOLD = 3
+
+    def record_failure(self, username: str, src_ip: str, timestamp: datetime) -> bool:
+        """Record a failed login and return True if it is part of a burst."""
+        return self.record((username, src_ip), timestamp) >= self.BURST_THRESHOLD
+
+
+class SlidingWindowDistinct:
+    """
+    Count distinct values per key within a trailing time window, with bounded memory.
+
+    Each key keeps a deque of recent (timestamp, value) pairs and a count per
+    value, so recording and expiring cost amortized O(1). Late events are
+    counted against the window ending at their own time, as in
+    SlidingWindowCounter. Keys are kept in LRU order with the same bounds as
+    SlidingWindowCounter.
+    """
+
+    def __init__(
+        self,
+        window: timedelta = timedelta(minutes=10),
+        max_keys: int = 100_000,
+        max_events_per_key: int = 1_000,
+    ):
+        """Initialize an empty tracker."""
+        self.window = window
+        self.max_keys = max_keys
+        self.max_events_per_key = max_events_per_key
+        self._events: "OrderedDict[Hashable, Tuple[Deque[Tuple[datetime, Hashable]], Counter]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Number of keys currently tracked."""
+        return len(self._events)
+
+    def record(self, key: Hashable, value: Hashable, timestamp: datetime) -> int:
+        """Record ``value`` for ``key`` and return the key's distinct values within the window ending at ``timestamp``."""
+        entry = self._events.get(key)
+        if entry is None:
+            entry = (deque(), Counter())
+            self._events[key] = entry
+            if len(self._events) > self.max_keys:
+                self._events.popitem(last=False)
+        else:
+            self._events.move_to_end(key)
+        events, counts = entry
+
+        if len(events) >= self.max_events_per_key:
+            self._drop(counts, events.popleft())
+        if not events or timestamp >= events[-1][0]:
+            events.append((timestamp, value))
+            late_count = None
+        else:
+            # Late arrival: keep the deque ordered by time (rare, bounded by max_events_per_key)
+            bisect.insort(events, (timestamp, value))
+            start = timestamp - self.window
+            late_count = len({v for t, v in events if start < t <= timestamp})
+        counts[value] += 1
+
+        cutoff = events[-1][0] - self.window
+        while events[0][0] <= cutoff:
+            self._drop(counts, events.popleft())
+        return len(counts) if late_count is None else late_count
+
+    @staticmethod
+    def _drop(counts: Counter, event: Tuple[datetime, Hashable]) -> None:
+        """Forget one expired (timestamp, value) pair."""
+        value = event[1]
+        counts[value] -= 1
+        if not counts[value]:
+            del counts[value]
+
+
+class TimeBucketIndex:
+    """
+    Recent entries per key in fixed-width time buckets, for time-range joins.
+
+    Entries are grouped by bucket number (timestamp // bucket width) and then
+    by key, so the entries of one key in a time range are found by visiting
+    only the buckets the range spans. Buckets older than ``retention`` before
+    the newest timestamp seen are dropped whole, and entries that would land
+    in them are refused; each key keeps at most ``max_entries_per_key``
+    entries per bucket.
+    """
+
+    def __init__(
+        self,
+        bucket: timedelta = timedelta(minutes=5),
+        retention: timedelta = timedelta(hours=1),
+        max_entries_per_key: int = 1_000,
+    ):
+        """Initialize an empty index."""
+        self.bucket_seconds = bucket.total_seconds()
+        self.retention_buckets = math.ceil(retention / bucket)
+        self.max_entries_per_key = max_entries_per_key
+        self._buckets: Dict[int, Dict[Hashable, List[Any]]] = {}
+        self._newest: Optional[int] = None
+
+    def __len__(self) -> int:
+        """Number of live buckets."""
+        return len(self._buckets)
+
+    def _number(self, timestamp: datetime) -> int:
+        """Bucket number of a timestamp."""
+        return int(timestamp.timestamp() // self.bucket_seconds)
+
+    def add(self, key: Hashable, timestamp: datetime, entry: Any) -> bool:
+        """Index ``entry`` under ``key`` at ``timestamp``; returns False if it is older than the retention."""
+        number = self._number(timestamp)
+        if self._newest is None or number > self._newest:
+            self._newest = number
+            cutoff = number - self.retention_buckets
+            for expired in [n for n in self._buckets if n <= cutoff]:
+                del self._buckets[expired]
+        elif number <= self._newest - self.retention_buckets:
+            return False
+
+        entries = self._buckets.setdefault(number, {}).setdefault(key, [])
+        if len(entries) >= self.max_entries_per_key:
+            return False
+        entries.append(entry)
+        return True
+
+    def query(self, key: Hashable, start: datetime, end: datetime) -> Iterator[Any]:
+        """Entries of ``key`` in the buckets spanning [start, end] (callers filter exact times)."""
+        for number in range(self._number(start), self._number(end) + 1):
+            bucket = self._buckets.get(number)
+            if bucket:
+                yield from bucket.get(key, ())
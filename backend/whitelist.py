@@ -0,0 +1,184 @@
+"""Analyst whitelist, enforced before events are scored.
+
+Analysts whitelist source IPs (addresses or CIDR blocks) and usernames from
+the dashboard. Events they match are not sent to the agent: the dispatcher
+stores a zero-risk analysis that names the whitelist entry, so the event is
+still accounted for (and leaves the outbox) without an LLM call.
+
+Lookups never touch the database. The index keeps usernames in a hash set
+and networks in one hash set per prefix length, so an IP is checked with at
+most 33 (IPv4) or 129 (IPv6) probes however many entries there are. It is
+loaded on first use and kept current from change notifications: the
+dashboard sends NOTIFY on WHITELIST_CHANNEL in the transaction that adds an
+entry, and a listener thread applies each entry as it arrives (reloading
+everything whenever it reconnects, so nothing sent while it was away is
+missed). Databases without LISTEN/NOTIFY are re-read every
+WHITELIST_REFRESH_SECONDS instead.
+"""
+import ipaddress
+import json
+import logging
+import os
+import select
+import threading
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import select as sql_select, text
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal, engine
+from .models import WhitelistedIP, WhitelistedUser
+
+logger = logging.getLogger(__name__)
+
+WHITELIST_ENFORCED = os.getenv("WHITELIST_ENFORCED", "true").lower() == "true"
+WHITELIST_REFRESH_SECONDS = float(os.getenv("WHITELIST_REFRESH_SECONDS", "60"))  # Reload interval without NOTIFY
+WHITELIST_CHANNEL = "whitelist_changed"
+
+
+class PrefixSet:
+    """IP networks with fast membership tests for single addresses."""
+
+    def __init__(self):
+        """Create an empty set."""
+        self._networks: Dict[Tuple[int, int], Set[int]] = {}  # (version, prefix length) -> network prefixes
+        self._lengths: Dict[int, Tuple[int, ...]] = {}  # version -> prefix lengths present
+
+    def __len__(self) -> int:
+        """Number of networks held."""
+        return sum(len(prefixes) for prefixes in self._networks.values())
+
+    def add(self, network) -> None:
+        """Add an ipaddress network (a single address is a /32 or /128)."""
+        bits = network.max_prefixlen
+        key = (network.version, network.prefixlen)
+        self._networks.setdefault(key, set()).add(int(network.network_address) >> (bits - network.prefixlen))
+        self._lengths[network.version] = tuple(sorted(length for version, length in self._networks
+                                                      if version == network.version))
+
+    def match(self, address: str) -> Optional[str]:
+        """The network (as CIDR text) containing ``address``, or None; unparseable addresses match nothing."""
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        value, bits = int(ip), ip.max_prefixlen
+        for length in self._lengths.get(ip.version, ()):
+            prefix = value >> (bits - length)
+            if prefix in self._networks[(ip.version, length)]:
+                return str(ipaddress.ip_network((prefix << (bits - length), length)))
+        return None
+
+
+class WhitelistIndex:
+    """In-memory whitelist of usernames and IP networks, refreshed from change notifications."""
+
+    def __init__(self):
+        """Create an empty index; it loads itself on first use."""
+        self.users: Set[str] = set()
+        self.ips = PrefixSet()
+        self.loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+
+    def _ensure_current(self) -> None:
+        """Load on first use, then keep current (listener thread on PostgreSQL, periodic reload elsewhere)."""
+        if engine.dialect.name == "postgresql":
+            if self._listener is None:
+                with self._lock:
+                    if self._listener is None:
+                        self._reload()
+                        self._listener = threading.Thread(target=self._listen, name="whitelist-listener",
+                                                          daemon=True)
+                        self._listener.start()
+        elif self.loaded_at is None or time.monotonic() - self.loaded_at >= WHITELIST_REFRESH_SECONDS:
+            with self._lock:
+                if self.loaded_at is None or time.monotonic() - self.loaded_at >= WHITELIST_REFRESH_SECONDS:
+                    self._reload()
+
+    def _reload(self) -> None:
+        """Replace the index with the whitelist tables' contents."""
+        db = SessionLocal()
+        try:
+            users = set(db.execute(sql_select(WhitelistedUser.username)).scalars())
+            addresses = list(db.execute(sql_select(WhitelistedIP.ip_address)).scalars())
+        except Exception as e:
+            logger.error(f"Failed to load whitelist: {e}")
+            return
+        finally:
+            db.close()
+
+        ips = PrefixSet()
+        for address in addresses:
+            network = self._parse(address)
+            if network is not None:
+                ips.add(network)
+        self.users, self.ips = users, ips  # Swapped whole: lookups see the old or the new index
+        self.loaded_at = time.monotonic()
+        logger.info(f"Loaded whitelist: {len(users)} users, {len(ips)} IP networks")
+
+    @staticmethod
+    def _parse(address: str):
+        """Network for a whitelisted address or CIDR block, or None if it is not one."""
+        try:
+            return ipaddress.ip_network(address.strip(), strict=False)
+        except ValueError:
+            logger.warning(f"Ignoring whitelisted IP that is not an address or network: {address!r}")
+            return None
+
+    def apply(self, kind: str, value: str) -> None:
+        """Add one entry (kind "user" or "ip") without reloading."""
+        with self._lock:
+            if kind == "user":
+                self.users.add(value)
+            elif kind == "ip":
+                network = self._parse(value)
+                if network is not None:
+                    self.ips.add(network)
+
+    def _listen(self) -> None:
+        """Listener thread: apply whitelist notifications as they arrive, reconnecting on errors."""
+        while True:
+            conn = None
+            try:
+                conn = engine.raw_connection()
+                dbapi = conn.driver_connection
+                dbapi.autocommit = True
+                dbapi.cursor().execute(f"LISTEN {WHITELIST_CHANNEL}")
+                with self._lock:
+                    self._reload()  # Catch up on anything added before LISTEN took effect
+                while True:
+                    if select.select([dbapi], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi.poll()
+                    while dbapi.notifies:
+                        change = json.loads(dbapi.notifies.pop(0).payload)
+                        self.apply(change["kind"], change["value"])
+                        logger.info(f"Whitelisted {change['kind']} {change['value']}")
+            except Exception as e:
+                logger.warning(f"Whitelist listener error, reconnecting: {e}")
+                if conn is not None:
+                    conn.invalidate()
+                time.sleep(5)
+
+    def match(self, event_type: str, data: Dict[str, Any]) -> Optional[str]:
+        """Why an event is whitelisted ("user jdoe", "IP 10.0.0.0/8"), or None if it is not."""
+        self._ensure_current()
+        if event_type == "login" and data.get("username") in self.users:
+            return f"user {data['username']}"
+        if event_type in ("login", "firewall"):
+            network = self.ips.match(data.get("src_ip", ""))
+            if network is not None:
+                return f"IP {network}"
+        return None
+
+
+def notify_change(db: Session, kind: str, value: str) -> None:
+    """Announce a new whitelist entry to running indexes when the caller's transaction commits."""
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_notify(:channel, :payload)"),
+                   {"channel": WHITELIST_CHANNEL, "payload": json.dumps({"kind": kind, "value": value})})
+
+
+whitelist = WhitelistIndex()
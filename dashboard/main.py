@@ -1,5 +1,6 @@
 """Cybersecurity Dashboard Web Server."""
 import os
+import json
 import logging
 from datetime import datetime, timedelta
 from typing import List, Optional
@@ -16,8 +17,10 @@ sys.path.append('/app')
 from backend.models import (
     LoginEvent, FirewallLog, PatchLevel, EventAnalysis, 
     AnalystFeedback as AnalystFeedbackModel,
-    WhitelistedIP, WhitelistedUser, Base
+    WhitelistedIP, WhitelistedUser, HeavyHitter, CorrelatedIncident, EntityRisk, DispatchStatus, Base
 )
+from backend import entity_risk
+from backend.whitelist import notify_change
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -38,7 +41,11 @@ async def startup_event():
         Base.metadata.create_all(bind=engine, tables=[
             AnalystFeedbackModel.__table__,
             WhitelistedIP.__table__,
-            WhitelistedUser.__table__
+            WhitelistedUser.__table__,
+            HeavyHitter.__table__,
+            CorrelatedIncident.__table__,
+            EntityRisk.__table__,
+            DispatchStatus.__table__
         ])
         logger.info("✅ Feedback and whitelist tables initialized")
     except Exception as e:
@@ -129,6 +136,118 @@ async def get_stats():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/heavy-hitters")
+async def get_heavy_hitters():
+    """Get the busiest firewall sources in the current detection window."""
+    db = next(get_db())
+
+    try:
+        hitters = db.query(HeavyHitter).order_by(HeavyHitter.rank).all()
+        return [
+            {
+                "rank": hitter.rank,
+                "src_ip": hitter.src_ip,
+                "connections": hitter.connections,
+                "denies": hitter.denies,
+                "updated_at": hitter.updated_at.isoformat()
+            }
+            for hitter in hitters
+        ]
+    except Exception as e:
+        logger.error(f"Error fetching heavy hitters: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/dispatch-status")
+async def get_dispatch_status():
+    """Get each backend replica's agent concurrency limit and latency statistics."""
+    db = next(get_db())
+
+    try:
+        replicas = db.query(DispatchStatus).order_by(DispatchStatus.replica).all()
+        return [
+            {
+                "replica": status.replica,
+                "limit": status.concurrency_limit,
+                "min_limit": status.min_limit,
+                "max_limit": status.max_limit,
+                "in_flight": status.in_flight,
+                "baseline_latency_ms": status.baseline_latency_ms,
+                "smoothed_latency_ms": status.smoothed_latency_ms,
+                "completed": status.completed,
+                "errors": status.errors,
+                "updated_at": status.updated_at.isoformat()
+            }
+            for status in replicas
+        ]
+    except Exception as e:
+        logger.error(f"Error fetching dispatch status: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/incidents")
+async def get_incidents(limit: int = Query(20, description="Maximum number of incidents to return")):
+    """Get the most recently active correlated incidents."""
+    db = next(get_db())
+
+    try:
+        incidents = db.query(CorrelatedIncident).order_by(desc(CorrelatedIncident.last_seen)).limit(limit).all()
+        return [
+            {
+                "id": incident.id,
+                "src_ip": incident.src_ip,
+                "device_id": incident.device_id,
+                "severity": incident.severity,
+                "summary": incident.summary,
+                "firewall_events": incident.firewall_events,
+                "failed_logins": incident.failed_logins,
+                "accounts": incident.accounts,
+                "admin_targeted": incident.admin_targeted,
+                "unpatched_device": incident.unpatched_device,
+                "login_succeeded": incident.login_succeeded,
+                "evidence": json.loads(incident.evidence),
+                "first_seen": incident.first_seen.isoformat(),
+                "last_seen": incident.last_seen.isoformat()
+            }
+            for incident in incidents
+        ]
+    except Exception as e:
+        logger.error(f"Error fetching incidents: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/entity-risk")
+async def get_riskiest_entities(
+    entity_type: Optional[str] = Query(None, description="user, ip or device"),
+    limit: int = Query(20, description="Maximum number of entities to return")
+):
+    """Get the entities with the highest current rolling risk."""
+    db = next(get_db())
+
+    try:
+        return entity_risk.riskiest(db, entity_type, limit)
+    except Exception as e:
+        logger.error(f"Error fetching entity risk: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/entity-risk/{entity_type}/{entity_id}")
+async def get_entity_risk(entity_type: str, entity_id: str):
+    """Get the current rolling risk of one user, IP or device."""
+    if entity_type not in entity_risk.ENTITY_TYPES:
+        raise HTTPException(status_code=400, detail=f"entity_type must be one of {', '.join(entity_risk.ENTITY_TYPES)}")
+    db = next(get_db())
+
+    try:
+        risk = entity_risk.current_risk(db, entity_type, entity_id)
+    except Exception as e:
+        logger.error(f"Error fetching entity risk: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if risk is None:
+        raise HTTPException(status_code=404, detail=f"No risk recorded for {entity_type} {entity_id}")
+    return risk
+
+
 @app.get("/api/alerts")
 async def get_alerts(
     severity: Optional[str] = Query(None, description="Filter by severity"),
@@ -172,7 +291,8 @@ async def get_alerts(
                         "auth_method": event.auth_method,
                         "is_admin": event.is_admin,
                         "is_suspicious_ip": event.is_suspicious_ip,
-                        "is_burst_failure": event.is_burst_failure
+                        "is_burst_failure": event.is_burst_failure,
+                        "is_credential_stuffing": event.is_credential_stuffing
                     }
             elif analysis.event_type == "firewall":
                 event = db.query(FirewallLog).filter(FirewallLog.id == analysis.event_id).first()
@@ -272,7 +392,8 @@ async def get_alert_details(alert_id: int):
                     "auth_method": event.auth_method,
                     "is_admin": event.is_admin,
                     "is_suspicious_ip": event.is_suspicious_ip,
-                    "is_burst_failure": event.is_burst_failure
+                    "is_burst_failure": event.is_burst_failure,
+                    "is_credential_stuffing": event.is_credential_stuffing
                 }
         elif analysis.event_type == "firewall":
             event = db.query(FirewallLog).filter(FirewallLog.id == analysis.event_id).first()
@@ -355,6 +476,7 @@ async def submit_feedback(feedback: AnalystFeedback):
                     added_by="analyst"
                 )
                 db.add(whitelist_entry)
+                notify_change(db, "ip", feedback.whitelist_value)  # Delivered to the dispatchers on commit
                 logger.info(f"Added IP {feedback.whitelist_value} to whitelist")
             else:
                 logger.info(f"IP {feedback.whitelist_value} already whitelisted")
@@ -372,6 +494,7 @@ async def submit_feedback(feedback: AnalystFeedback):
                     added_by="analyst"
                 )
                 db.add(whitelist_entry)
+                notify_change(db, "user", feedback.whitelist_value)
                 logger.info(f"Added user {feedback.whitelist_value} to whitelist")
             else:
                 logger.info(f"User {feedback.whitelist_value} already whitelisted")
@@ -17,6 +17,9 @@ show_help() {
     echo "  logs-backend  Show backend logs"
     echo "  logs-agent    Show agent logs"
     echo "  logs-db       Show database logs"
+    echo "  restart-agent-workers  Gracefully restart agent workers (no code reload; see below)"
+    echo "  scale-workers N  Run N extra backend dispatch replicas"
+    echo "  redrive [TYPE]   Re-dispatch dead-lettered events (all, or login/firewall/patch)"
     echo "  db            Connect to database"
     echo "  stats         Show event statistics"
     echo "  critical      Show critical events"
@@ -24,6 +27,10 @@ show_help() {
     echo "  clean         Stop and remove all data"
     echo "  help          Show this help message"
     echo ""
+    echo "The agent's code is baked into its image and imported once before its"
+    echo "workers fork, so restart-agent-workers (alias: reload-agent) runs the same"
+    echo "code and settings. After changing them: docker-compose up -d --build agent"
+    echo ""
 }
 
 case "$1" in
@@ -71,6 +78,28 @@ case "$1" in
         docker logs -f cyber-events-db
         ;;
     
+    restart-agent-workers|reload-agent)
+        echo "🔄 Gracefully restarting agent workers..."
+        docker kill -s HUP cyber-agent
+        echo "✅ Agent workers restarting (same code; rebuild the agent image to change it)"
+        ;;
+    
+    scale-workers)
+        count=${2:-2}
+        echo "📈 Scaling backend dispatch workers to $count..."
+        if [ "${DISPATCH_VIA_OUTBOX:-false}" != "true" ]; then
+            echo "⚠️  Set DISPATCH_VIA_OUTBOX=true so the leader leaves dispatch to the outbox"
+        fi
+        docker-compose --profile scale up -d --scale backend-worker="$count" backend backend-worker
+        echo "✅ $count backend workers running"
+        ;;
+    
+    redrive)
+        echo "🔁 Re-driving dead-lettered events..."
+        docker exec cyber-backend python -m backend.deadletter redrive --drain ${2:+--type "$2"}
+        echo "✅ Dead-lettered events re-dispatched"
+        ;;
+    
     db)
         echo "🔗 Connecting to database..."
         docker exec -it cyber-events-db psql -U postgres -d cyber_events